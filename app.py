@@ -3,27 +3,146 @@
 
 import sqlite3
 import os
+import io
+import csv
+import gzip
+import json
+import mimetypes
+import posixpath
+import queue
+import random
+import shutil
+import signal
+import re
+import logging
+import zlib
+import base64
+import bisect
+import hashlib
 import secrets
-from datetime import datetime
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import closing, contextmanager
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from types import SimpleNamespace
+from urllib import request as urllib_request
 
+import click
 from flask import (
-    Flask, render_template, request, redirect,
-    url_for, g, session, abort
+    Flask, Blueprint, render_template, request, redirect,
+    url_for, g, session, abort, Response, stream_with_context, send_file
 )
+from markupsafe import Markup, escape
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+from werkzeug.utils import safe_join
+
+# اختياريين: build-assets من غيرهم بيعمل hash + gzip بس (من غير webp/avif/br)
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # ============================================
 # إعدادات أساسية + خيارات الفورم
 # ============================================
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-DB_PATH = os.path.join(BASE_DIR, "approval_requests.db")
+DB_PATH = os.environ.get("APPROVAL_DB_PATH", os.path.join(BASE_DIR, "approval_requests.db"))
+# الطلبات اللي خلصت من زمان بتتنقل هنا (archive-requests) وبتتقري منها بـ ATTACH ... AS archive
+ARCHIVE_DB_PATH = os.environ.get(
+    "APPROVAL_ARCHIVE_DB_PATH", os.path.splitext(DB_PATH)[0] + "_archive.db"
+)
 
 app = Flask(__name__)
 # IMPORTANT: غيّر السر قبل تشغيله على سيرفر حقيقي
 app.config["SECRET_KEY"] = "CHANGE_THIS_SECRET_KEY_123"
 app.config["SESSION_COOKIE_HTTPONLY"] = True
 app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
+# الـ migrations بتسجّل في اللوج (INFO) اللي اتعمل
+app.logger.setLevel(logging.INFO)
+# عدد الصفوف في صفحة الداشبورد (ممكن يتغير من ?per_page= لحد الـ MAX)
+app.config["DASHBOARD_PAGE_SIZE"] = int(os.environ.get("DASHBOARD_PAGE_SIZE", 50))
+app.config["DASHBOARD_MAX_PAGE_SIZE"] = 500
+
+# إعدادات SQLite (بتتطبق مرة واحدة لما الـ connection يتفتح)
+app.config["SQLITE_BUSY_TIMEOUT_MS"] = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+app.config["SQLITE_CACHE_SIZE_KB"] = 20000          # page cache لكل connection
+app.config["SQLITE_MMAP_SIZE"] = 256 * 1024 * 1024
+app.config["SQLITE_CACHED_STATEMENTS"] = 512        # prepared statements محفوظة لكل connection
+
+# archive-requests: Approved / Rejected آخر تعديل فيها أقدم من كده => قاعدة الأرشيف
+# (القاعدة الأساسية بتفضل صغيرة وكلها في الـ page cache)، بدفعات بالحجم ده
+app.config["ARCHIVE_AFTER_DAYS"] = int(os.environ.get("ARCHIVE_AFTER_DAYS", 180))
+app.config["ARCHIVE_BATCH_SIZE"] = int(os.environ.get("ARCHIVE_BATCH_SIZE", 500))
+
+# البحث النصي بالـ relevance بيرتّب (bm25) أحدث العدد ده من النتائج بعد الفلاتر
+# (أي فرز تاني بيعرض كل النتائج)
+app.config["SEARCH_MAX_CANDIDATES"] = 2000
+
+# التصدير بيقرا الصفوف دفعات بالحجم ده (الذاكرة ثابتة مهما كان عدد الصفوف)
+app.config["EXPORT_BATCH_SIZE"] = 1000
+
+# بيدخل في كل ETag => deploy جديد (تمبليتات جديدة) ما يرجّعش 304 لنسخة قديمة
+app.config["ETAG_SALT"] = os.environ.get("RENDER_GIT_COMMIT", "")
+
+# كاش الـ HTML المترندر (لكل process)، 0 = مقفول
+app.config["PAGE_CACHE_MAX_BYTES"] = int(os.environ.get("PAGE_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+
+# /metrics (Prometheus): استعلام أبطأ من SLOW_QUERY_MS بيتكتب في اللوج بالـ SQL
+# METRICS_TOKEN => Prometheus يقرا بـ Authorization: Bearer <token> (وإلا لازم staff login)
+app.config["SLOW_QUERY_MS"] = float(os.environ.get("SLOW_QUERY_MS", 100))
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN", "")
+
+# ضغط الـ responses النصية (br لو brotli متسطب، وإلا gzip)
+app.config["COMPRESS_MIN_SIZE"] = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))   # أصغر من كده مش مستاهل
+app.config["COMPRESS_GZIP_LEVEL"] = int(os.environ.get("COMPRESS_GZIP_LEVEL", 6))  # 1..9
+app.config["COMPRESS_BR_QUALITY"] = int(os.environ.get("COMPRESS_BR_QUALITY", 4))  # 0..11 (فوق 6 تقيل على HTML ديناميك)
+
+# أحداث الداشبورد اللحظية (SSE): thread واحد لكل process بيقرا request_events كل INTERVAL ثانية
+app.config["SSE_POLL_INTERVAL"] = float(os.environ.get("SSE_POLL_INTERVAL", 1.0))
+app.config["SSE_KEEPALIVE_SECONDS"] = 15     # تعليق فاضي عشان الـ proxies ما تقفلش الاتصال
+# كل stream ماسك thread من threads الـ worker طول ما هو مفتوح => حد أقصى لكل process (الزيادة 503
+# والمتصفح بيحاول تاني بعد شوية)، و gunicorn.conf.py بيزوّد الـ threads بنفس العدد فوق threads الطلبات
+app.config["SSE_MAX_STREAMS"] = int(os.environ.get("SSE_MAX_STREAMS", 4))
+# الـ stream بيتقفل بعد المدة دي والمتصفح بيرجع لوحده (retry + Last-Event-ID) => الـ threads بتلف
+# على الـ workers ومفيش stream عايش لحد max_requests / restart
+app.config["SSE_STREAM_SECONDS"] = int(os.environ.get("SSE_STREAM_SECONDS", 300))
+
+# Outbox: إشعارات ما بعد القرار بيبعتها outbox-worker (process منفصل)، مش الـ request
+# OUTBOX_SINKS مفصولة بفاصلة: file:<path> / webhook:<url> / log
+app.config["OUTBOX_SINKS"] = os.environ.get(
+    "OUTBOX_SINKS", "file:" + os.path.join(BASE_DIR, "outbox_deliveries.jsonl")
+)
+app.config["OUTBOX_BATCH_SIZE"] = int(os.environ.get("OUTBOX_BATCH_SIZE", 100))
+app.config["OUTBOX_POLL_INTERVAL"] = float(os.environ.get("OUTBOX_POLL_INTERVAL", 2.0))
+app.config["OUTBOX_MAX_ATTEMPTS"] = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 8))
+app.config["OUTBOX_BACKOFF_SECONDS"] = 5          # 5, 10, 20, 40 ... لحد الـ MAX
+app.config["OUTBOX_BACKOFF_MAX_SECONDS"] = 3600
+# worker وقع في النص => الرسايل ترجع بعد كده (والـ worker الشغال بيجدده كل نص المدة طول الدفعة)
+app.config["OUTBOX_LEASE_SECONDS"] = 300
+app.config["OUTBOX_KEEP_DAYS"] = 7                # المتسلّم بيتمسح بعدها
+app.config["OUTBOX_WEBHOOK_TIMEOUT"] = 10
+
+# توكنات الـ JSON API (/api/v1) مفصولة بفاصلة:
+# API_TOKENS => قراءة + إنشاء طلبات، API_DECIDE_L1_TOKENS / API_DECIDE_L2_TOKENS => كمان قرار
+# المستوى ده بس (زي mgr1 / mgr2 في الواجهة: توكن واحد ما يسجلش القرارين على نفس الطلب)
+app.config["API_TOKENS"] = [t.strip() for t in os.environ.get("API_TOKENS", "").split(",") if t.strip()]
+app.config["API_DECIDE_L1_TOKENS"] = [
+    t.strip() for t in os.environ.get("API_DECIDE_L1_TOKENS", "").split(",") if t.strip()
+]
+app.config["API_DECIDE_L2_TOKENS"] = [
+    t.strip() for t in os.environ.get("API_DECIDE_L2_TOKENS", "").split(",") if t.strip()
+]
+# أقصى عدد عناصر في أي batch (إنشاء / قراءة / قرارات / صفحة changes)
+app.config["API_BATCH_MAX"] = 500
 
 # كلمات سر المديرين (يفضل لاحقاً من Environment Variables)
 MANAGER1_PASSWORD = "manager1"
@@ -53,145 +172,1114 @@ PROJECT_CHOICES = [
 # هنا مثلاً من 1 إلى 300، عدّل حسب نظامك
 UNIT_CHOICES = [str(i) for i in range(1, 301)]
 
+# الحالات اللي بتظهر عدّاداتها في الداشبورد (status -> اسم العدّاد)
+STATUS_COUNTERS = {
+    "Pending L1": "pending_l1",
+    "Pending L2": "pending_l2",
+    "Approved": "approved",
+    "Rejected": "rejected",
+}
+
 
 # ============================================
 # قاعدة البيانات
 # ============================================
 
+class ThreadState(threading.local):
+    """
+    connection واحد لكل thread في كل worker، بيتعاد استخدامه بين الطلبات
+    + عدّاد الاستعلامات ووقتها للطلب الحالي (بيتصفّر في before_request بتاع /metrics)
+    """
+    db = None
+    read_db = None              # للقراية بس (mode=ro) => الداشبوردات والتقارير
+    pid = None
+    read_pid = None
+    endpoint = "-"              # برّه طلب (CLI / change feed / outbox-worker)
+    request_started = None
+    queries = 0
+    query_seconds = 0.0
+
+
+_local = ThreadState()
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """execute / executemany بيتحسب وقتها (record_query) => عدّاد لكل طلب + slow query log"""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Connection.execute الأصلي بيعمل cursor من C (مش من cursor()) => بيتقاس هنا كمان
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+
+def sqlite_ro_uri(path):
+    return "file:" + urllib_request.pathname2url(os.path.abspath(path)) + "?mode=ro"
+
+
+def open_db(path=None, readonly=False, archive=None):
+    """
+    يفتح connection جديد ويظبط الـ PRAGMAs مرة واحدة (WAL, busy_timeout, cache, mmap)
+    readonly => mode=ro + query_only: أي كتابة بالغلط بتطلع error بدل ما تاخد الـ write lock
+    archive => ATTACH لقاعدة الأرشيف باسم archive (افتراضياً connections القراية بس:
+    BEGIN IMMEDIATE بياخد lock على كل القواعد الـ attached، فالكتابة العادية مش محتاجاه)
+    """
+    cfg = app.config
+    path = path or DB_PATH
+    if archive is None:
+        archive = readonly
+    if readonly:
+        path = sqlite_ro_uri(path)
+    db = sqlite3.connect(
+        path,
+        timeout=cfg["SQLITE_BUSY_TIMEOUT_MS"] / 1000,
+        check_same_thread=False,
+        cached_statements=cfg["SQLITE_CACHED_STATEMENTS"],
+        factory=InstrumentedConnection,
+        uri=readonly,
+    )
+    db.row_factory = sqlite3.Row
+    if readonly:
+        # الـ WAL اتظبط من connection الكتابة (متخزن في الملف)
+        db.execute("PRAGMA query_only = ON")
+    else:
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")
+    db.execute(f"PRAGMA busy_timeout = {int(cfg['SQLITE_BUSY_TIMEOUT_MS'])}")
+    db.execute(f"PRAGMA cache_size = -{int(cfg['SQLITE_CACHE_SIZE_KB'])}")
+    db.execute(f"PRAGMA mmap_size = {int(cfg['SQLITE_MMAP_SIZE'])}")
+    if archive:
+        # الأرشيف بيتقري نادراً => الـ cache الافتراضي الصغير كفاية (الـ cache_size فوق لـ main بس)
+        db.execute("ATTACH DATABASE ? AS archive",
+                   (sqlite_ro_uri(ARCHIVE_DB_PATH) if readonly else ARCHIVE_DB_PATH,))
+        if not readonly:
+            db.execute("PRAGMA archive.journal_mode = WAL")
+            db.execute("PRAGMA archive.synchronous = NORMAL")
+    return db
+
+
 def get_db():
-    if "db" not in g:
-        g.db = sqlite3.connect(DB_PATH, check_same_thread=False)
-        g.db.row_factory = sqlite3.Row
-    return g.db
+    """connection الـ thread الحالي (بيتفتح أول مرة بس)"""
+    db = _local.db
+    # بعد fork (gunicorn) الـ connection الموروث من الأب ما ينفعش يتستخدم
+    if db is None or _local.pid != os.getpid():
+        db = open_db()
+        _local.db = db
+        _local.pid = os.getpid()
+    return db
+
+
+def get_read_db():
+    """connection القراية بتاع الـ thread الحالي (mode=ro)، منفصل عن بتاع الكتابة"""
+    db = _local.read_db
+    if db is None or _local.read_pid != os.getpid():
+        db = open_db(readonly=True)
+        _local.read_db = db
+        _local.read_pid = os.getpid()
+    return db
+
+
+@contextmanager
+def read_snapshot():
+    """
+    كذا SELECT على نفس الـ snapshot (WAL): الـ read transaction بيبدأ مع أول SELECT
+    وبيفضل شايف نفس النسخة لحد الآخر، والكتابة في الطلبات التانية ماشية عادي
+    (عدّادات + listing + قوايم الفلاتر + الـ ETag كلهم متطابقين)
+    """
+    db = get_read_db()
+    db.execute("BEGIN")
+    try:
+        yield db
+    finally:
+        db.rollback()   # مفيش حاجة تتعمل commit، بس بيقفل الـ snapshot
+
+
+def close_thread_db():
+    """يقفل connections الـ thread الحالي (مثلاً قبل fork في gunicorn)"""
+    pid = os.getpid()
+    for conn, owner in ((_local.db, _local.pid), (_local.read_db, _local.read_pid)):
+        if conn is not None and owner == pid:
+            conn.close()
+    _local.db = _local.read_db = None
 
 
 @app.teardown_appcontext
 def close_db(exception):
-    db = g.pop("db", None)
-    if db is not None:
-        db.close()
+    # الـ connection بيفضل مفتوح للطلب الجاي، بس أي transaction مفتوح بيتلغى
+    db = _local.db
+    if db is not None and db.in_transaction:
+        db.rollback()
+
+
+@contextmanager
+def write_transaction(db, lock="IMMEDIATE"):
+    """
+    BEGIN IMMEDIATE => الـ write lock بيتاخد من الأول (والـ busy_timeout بيستنى عليه)
+    بدل ما الـ transaction يترقّى من read لـ write ويطلع "database is locked"
+    lock="DEFERRED" => الـ lock على القاعدة اللي بيتكتب فيها بس (النسخ للأرشيف)
+    """
+    db.execute(f"BEGIN {lock}")
+    try:
+        yield db
+    except BaseException:
+        db.rollback()
+        raise
+    else:
+        db.commit()
+
+
+# ---------- تعريف حقول الطلب (الفورم + الـ validation + الـ SQL كلهم بيتبنوا منه) ----------
+# kind: text / amount (بيتوحّد + request_amounts) / date (ISO) / number
+# required: الحقل العام إجباري دايماً، وحقول النوع إجبارية لما النوع يتختار
+Field = namedtuple("Field", ("name", "kind", "required", "label"), defaults=("text", False, None))
+# key = اسم القسم جوه details، و flag = الـ checkbox بتاعه في الفورم
+# required: الحقول الإجبارية لما النوع يتختار (None = كل حقوله)
+RequestType = namedtuple("RequestType", ("flag", "key", "fields", "required"), defaults=(None,))
+
+# حقول عامة (أعمدة في requests)
+REQUEST_FIELDS = (
+    Field("project_name", "text", True, "Project Name"),
+    Field("unit_number", "text", True, "Unit Number"),
+    Field("paid_amount", "amount", True, "Paid Amount"),
+    Field("buyer_name", "text", True, "Buyer Name"),
+    Field("agent_name", "text", True, "Agent Name"),
+    Field("agency_name", "text", True, "Agency Name"),
+    Field("agent_contact", "text", True, "Agent Contact Number"),
+    # others_text فاضل عمود عادي (البحث النصي بيقرا منه)
+    Field("others_text"),
+    Field("doc_kyc"),
+    Field("doc_reservation_agreement"),
+    Field("doc_spa"),
+    Field("doc_others"),
+    Field("comments"),
+    Field("requested_by_signature", "text", True, "Agent Signature (Requested By)"),
+    Field("requested_by_date", "date", True, "Requested By Date"),
+)
+
+# ترتيب الأنواع ثابت: bit رقم i في type_mask = النوع رقم i (ما تغيّرش الترتيب، ضيف في الآخر)
+# نوع جديد = entry واحدة هنا (الحقول بتتخزن في details => من غير تغيير في الجدول)
+REQUEST_TYPES = (
+    RequestType("price_reduction_selected", "pr", (
+        Field("pr_listed_price", "amount"),
+        Field("pr_discount_amount", "amount"),
+        Field("pr_selling_price", "amount"),
+        Field("pr_discount_percent", "number"),
+    )),
+    RequestType("bulk_discount_selected", "bd", (
+        Field("bd_listed_price", "amount"),
+        Field("bd_discount_amount", "amount"),
+        Field("bd_selling_price", "amount"),
+        Field("bd_discount_percent", "number"),
+        Field("bd_units", "number"),
+    )),
+    RequestType("change_payment_plan_selected", "cpp", (
+        Field("cpp_down_payment_percent", "number"),
+        Field("cpp_down_payment_date", "date"),
+        Field("cpp_2nd_payment_percent", "number"),
+        Field("cpp_2nd_payment_date", "date"),
+        Field("cpp_3rd_payment_percent", "number"),
+        Field("cpp_3rd_payment_date", "date"),
+        Field("cpp_4th_payment_percent", "number"),
+        Field("cpp_4th_payment_date", "date"),
+        Field("cpp_5th_payment_percent", "number"),
+        Field("cpp_5th_payment_date", "date"),
+        Field("cpp_6th_payment_percent", "number"),
+        Field("cpp_6th_payment_date", "date"),
+        Field("cpp_completion_percent", "number"),
+        Field("cpp_completion_date", "date"),
+    )),
+    RequestType("unit_switch_selected", "us", (
+        Field("us_booked_unit"),
+        Field("us_new_unit"),
+        Field("us_new_unit_selling_price", "amount"),
+    )),
+    RequestType("unit_cancellation_selected", "uc", (
+        Field("uc_amount_paid", "amount"),
+    )),
+    RequestType("refund_selected", "rf", (
+        Field("rf_booking_fees_amount", "amount"),
+        Field("rf_payment_amount", "amount"),
+        Field("rf_refund_amount", "amount"),
+    )),
+    RequestType("late_payment_selected", "lp", (
+        Field("lp_payment_schedule_no"),
+        Field("lp_initial_due_date", "date"),
+        Field("lp_new_payment_date", "date"),
+        Field("lp_penalty_amount", "amount"),
+        Field("lp_overdue_period"),
+    )),
+    RequestType("waiver_late_fee_selected", "wl", (
+        Field("wl_downpayment_spa_date", "date"),
+        Field("wl_2nd_payment_spa_date", "date"),
+        Field("wl_3rd_payment_spa_date", "date"),
+        Field("wl_4th_payment_spa_date", "date"),
+        Field("wl_5th_payment_spa_date", "date"),
+        Field("wl_6th_payment_spa_date", "date"),
+        Field("wl_penalty_amount", "amount"),
+        Field("wl_waiver_amount", "amount"),
+    ), required=("wl_penalty_amount", "wl_waiver_amount")),
+    RequestType("issuance_spa_selected", "spa", (
+        Field("spa_down_payment_received", "amount"),
+        Field("spa_percent", "number"),
+    )),
+    RequestType("registration_dld_selected", "dld", (
+        Field("dld_down_payment_received", "amount"),
+        Field("dld_percent", "number"),
+    )),
+    # others_text عمود عام (REQUEST_FIELDS) بس إجباري مع النوع ده
+    RequestType("others_selected", "others", (), required=("others_text",)),
+)
+
+# مشتقات الـ registry (بتتحسب مرة واحدة وقت الـ import)
+REQUEST_TYPE_FIELDS = {t.flag: tuple(f.name for f in t.fields) for t in REQUEST_TYPES}
+REQUEST_TYPE_BITS = {t.flag: 1 << i for i, t in enumerate(REQUEST_TYPES)}
+DETAIL_FIELDS = tuple(f.name for t in REQUEST_TYPES for f in t.fields)
+# القسم جوه details = list بالقيم بنفس ترتيب الحقول
+DETAIL_SECTIONS = {t.key: tuple(f.name for f in t.fields) for t in REQUEST_TYPES if t.fields}
+REQUIRED_FIELDS = tuple(f for f in REQUEST_FIELDS if f.required)
+REQUEST_TYPE_REQUIRED = {
+    t.flag: tuple(f.name for f in t.fields) if t.required is None else t.required
+    for t in REQUEST_TYPES
+}
+ALL_FIELDS = REQUEST_FIELDS + tuple(f for t in REQUEST_TYPES for f in t.fields)
+
+# المبالغ بتتوحّد وقت الكتابة ("1,250.50" -> "1250.5") وبتتخزن كمان في request_amounts بالـ minor units
+AMOUNT_SCALE = 100
+AMOUNT_FIELDS = tuple(f.name for f in ALL_FIELDS if f.kind == "amount")
+# التواريخ بتتخزن ISO (YYYY-MM-DD) => بتتقارن وتتفرز كـ TEXT ومع date() في SQLite
+DATE_FIELDS = tuple(f.name for f in ALL_FIELDS if f.kind == "date")
+DATE_INPUT_FORMATS = ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%Y/%m/%d", "%d.%m.%Y")
+
+# {name} => نفس التعريف بيتستخدم في init_db وفي rebuild الـ migration رقم 4
+REQUESTS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS {name} (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TEXT,
+    updated_at TEXT,
+    status TEXT,            -- Pending L1, Pending L2, Approved, Rejected
+    current_step INTEGER,   -- 1, 2, 0
+    edit_token TEXT,
+
+    project_name TEXT,
+    unit_number TEXT,
+    paid_amount TEXT,
+    buyer_name TEXT,
+    agent_name TEXT,
+    agency_name TEXT,
+    agent_contact TEXT,
+
+    type_mask INTEGER NOT NULL DEFAULT 0,   -- bit لكل نوع طلب (REQUEST_TYPE_BITS)
+    details TEXT,                           -- JSON: قسم لكل نوع فيه قيم ("pr" -> list ...) (DETAIL_SECTIONS)
+
+    others_text TEXT,
+
+    doc_kyc TEXT,
+    doc_reservation_agreement TEXT,
+    doc_spa TEXT,
+    doc_others TEXT,
+    comments TEXT,
+
+    requested_by_signature TEXT,
+    requested_by_date TEXT
+)
+"""
+
+APPROVALS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS approvals (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    request_id INTEGER,
+    level INTEGER,              -- 1 أو 2
+    approver_name TEXT,
+    decision TEXT,              -- Approved / Rejected
+    comments TEXT,
+    decided_at TEXT,
+    FOREIGN KEY(request_id) REFERENCES requests(id)
+)
+"""
+
+# ملخص العدادات: صف لكل status (scope='all') ولكل project+status (scope='project')
+# بيتحدّث من REQUEST_STATS_TRIGGERS
+REQUEST_STATS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS request_stats (
+    scope TEXT NOT NULL,            -- all / project
+    project_name TEXT NOT NULL,     -- '' لما scope = all
+    status TEXT NOT NULL,
+    n INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (scope, project_name, status)
+) WITHOUT ROWID
+"""
+
+# الـ triggers اللي بتحدّث request_stats مع كل insert/update/delete على requests
+REQUEST_STATS_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_request_stats_insert
+    AFTER INSERT ON requests
+    BEGIN
+        INSERT INTO request_stats (scope, project_name, status, n)
+        VALUES ('all', '', COALESCE(NEW.status, ''), 1)
+        ON CONFLICT (scope, project_name, status) DO UPDATE SET n = n + 1;
+
+        INSERT INTO request_stats (scope, project_name, status, n)
+        VALUES ('project', COALESCE(NEW.project_name, ''), COALESCE(NEW.status, ''), 1)
+        ON CONFLICT (scope, project_name, status) DO UPDATE SET n = n + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_request_stats_delete
+    AFTER DELETE ON requests
+    BEGIN
+        UPDATE request_stats SET n = n - 1
+        WHERE scope = 'all' AND project_name = '' AND status = COALESCE(OLD.status, '');
+
+        UPDATE request_stats SET n = n - 1
+        WHERE scope = 'project' AND project_name = COALESCE(OLD.project_name, '')
+          AND status = COALESCE(OLD.status, '');
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_request_stats_update
+    AFTER UPDATE OF status, project_name ON requests
+    WHEN OLD.status IS NOT NEW.status OR OLD.project_name IS NOT NEW.project_name
+    BEGIN
+        UPDATE request_stats SET n = n - 1
+        WHERE scope = 'all' AND project_name = '' AND status = COALESCE(OLD.status, '');
+
+        UPDATE request_stats SET n = n - 1
+        WHERE scope = 'project' AND project_name = COALESCE(OLD.project_name, '')
+          AND status = COALESCE(OLD.status, '');
+
+        INSERT INTO request_stats (scope, project_name, status, n)
+        VALUES ('all', '', COALESCE(NEW.status, ''), 1)
+        ON CONFLICT (scope, project_name, status) DO UPDATE SET n = n + 1;
+
+        INSERT INTO request_stats (scope, project_name, status, n)
+        VALUES ('project', COALESCE(NEW.project_name, ''), COALESCE(NEW.status, ''), 1)
+        ON CONFLICT (scope, project_name, status) DO UPDATE SET n = n + 1;
+    END
+    """,
+]
 
 
 def init_db():
     db = get_db()
     cur = db.cursor()
 
+    cur.execute(REQUESTS_TABLE_SQL.format(name="requests"))
+
+    cur.execute(APPROVALS_TABLE_SQL)
+    cur.execute(REQUEST_STATS_TABLE_SQL)
+
+    for sql in REQUEST_STATS_TRIGGERS:
+        cur.execute(sql)
+
+    db.commit()
+
+    # قاعدة قديمة فيها طلبات بس الجدول لسه فاضي -> نحسبه مرة واحدة
+    if cur.execute("SELECT 1 FROM request_stats LIMIT 1").fetchone() is None:
+        rebuild_request_stats(db)
+
+    migrate_db(db)
+
+    # connection منفصل فيه الأرشيف (بيعمل الملف لو مش موجود عشان connections القراية تعمله ATTACH)
+    with closing(open_db(archive=True)) as adb:
+        migrate_db(adb, ARCHIVE_MIGRATIONS, "archive")
+
+
+# --------------------------------------------
+# Migrations: كل إصدار بيتطبق مرة واحدة حسب PRAGMA user_version
+# (ما تعدّل إصدار اتطبق قبل كده، ضيف إصدار جديد تحت)
+# الخطوة يا SQL يا function بتاخد الـ connection (لتحويلات مش بتتكتب SQL بس)
+# --------------------------------------------
+# indexes على requests (الـ migration رقم 1، وبتتعمل تاني بعد rebuild الجدول في رقم 4)
+REQUEST_INDEXES = [
+    # edit_request بيدور بالـ token
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_requests_edit_token ON requests(edit_token)",
+    # فلاتر الداشبورد + الفرز (rowid بيتضاف ضمنياً في آخر كل index => ORDER BY id مغطى)
+    "CREATE INDEX IF NOT EXISTS idx_requests_status ON requests(status)",
+    "CREATE INDEX IF NOT EXISTS idx_requests_status_project ON requests(status, project_name)",
+    "CREATE INDEX IF NOT EXISTS idx_requests_status_unit ON requests(status, unit_number)",
+    "CREATE INDEX IF NOT EXISTS idx_requests_project ON requests(project_name)",
+    "CREATE INDEX IF NOT EXISTS idx_requests_project_unit ON requests(project_name, unit_number)",
+    "CREATE INDEX IF NOT EXISTS idx_requests_unit ON requests(unit_number)",
+]
+
+UNIT_PROJECT_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS idx_requests_unit_project ON requests(unit_number, project_name)"
+)
+
+# indexes الداشبورد على نفس تعبير الفلاتر والفرز (sort_key_sql: NULL = '') بنفس الأسماء القديمة
+LISTING_INDEX_COLUMNS = {
+    "idx_requests_status_project": "status, COALESCE(project_name, '')",
+    "idx_requests_status_unit": "status, COALESCE(unit_number, '')",
+    "idx_requests_project": "COALESCE(project_name, '')",
+    "idx_requests_project_unit": "COALESCE(project_name, ''), COALESCE(unit_number, '')",
+    "idx_requests_unit": "COALESCE(unit_number, '')",
+    "idx_requests_unit_project": "COALESCE(unit_number, ''), COALESCE(project_name, '')",
+}
+
+
+def listing_index_sql(schema):
+    """يبدّل indexes الأعمدة بتاعة الداشبورد بنسخة الـ COALESCE (migration على main أو الأرشيف)"""
+    steps = []
+    for name, columns in LISTING_INDEX_COLUMNS.items():
+        steps.append(f"DROP INDEX IF EXISTS {schema}.{name}")
+        steps.append(f"CREATE INDEX {schema}.{name} ON requests({columns})")
+    return steps
+
+
+# approvals لطلب معيّن بالترتيب
+APPROVALS_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS idx_approvals_request_level ON approvals(request_id, level, decided_at)"
+)
+
+# الـ triggers اللي بتمشّي requests_fts مع requests (رقم 3، وبتتعمل تاني في رقم 4)
+REQUEST_FTS_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_requests_fts_insert
+    AFTER INSERT ON requests
+    BEGIN
+        INSERT INTO requests_fts (rowid, buyer_name, agent_name, agency_name, agent_contact,
+                                  comments, others_text, approval_comments)
+        VALUES (NEW.id, NEW.buyer_name, NEW.agent_name, NEW.agency_name, NEW.agent_contact,
+                NEW.comments, NEW.others_text, '');
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_requests_fts_update
+    AFTER UPDATE OF buyer_name, agent_name, agency_name, agent_contact, comments, others_text
+    ON requests
+    BEGIN
+        UPDATE requests_fts
+        SET buyer_name = NEW.buyer_name, agent_name = NEW.agent_name,
+            agency_name = NEW.agency_name, agent_contact = NEW.agent_contact,
+            comments = NEW.comments, others_text = NEW.others_text
+        WHERE rowid = NEW.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_requests_fts_delete
+    AFTER DELETE ON requests
+    BEGIN
+        DELETE FROM requests_fts WHERE rowid = OLD.id;
+    END
+    """,
+]
+
+# بحث نصي (FTS5) على المشتري/الوكيل/الوكالة/التعليقات، rowid = requests.id
+REQUESTS_FTS_TABLE_SQL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS requests_fts USING fts5(
+    buyer_name, agent_name, agency_name, agent_contact,
+    comments, others_text, approval_comments,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+)
+"""
+
+# تعليقات الـ approvals بتتجمع في approval_comments بتاع الطلب
+APPROVAL_FTS_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_approvals_fts_insert
+    AFTER INSERT ON approvals
+    BEGIN
+        UPDATE requests_fts
+        SET approval_comments = (
+            SELECT group_concat(comments, ' ') FROM approvals WHERE request_id = NEW.request_id
+        )
+        WHERE rowid = NEW.request_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_approvals_fts_delete
+    AFTER DELETE ON approvals
+    BEGIN
+        UPDATE requests_fts
+        SET approval_comments = COALESCE((
+            SELECT group_concat(comments, ' ') FROM approvals WHERE request_id = OLD.request_id
+        ), '')
+        WHERE rowid = OLD.request_id;
+    END
+    """,
+]
+
+
+def amount_values_sql(row):
+    """json_object بكل مبلغ في الصف (row = NEW في trigger أو alias الجدول) عشان json_each يفرده"""
+    pairs = [f"'paid_amount', {row}.paid_amount"]
+    for key, fields in DETAIL_SECTIONS.items():
+        for i, f in enumerate(fields):
+            if f in AMOUNT_FIELDS:
+                pairs.append(f"'{f}', json_extract({row}.details, '$.{key}[{i}]')")
+    return f"json_object({', '.join(pairs)})"
+
+
+def request_amounts_insert_sql(row, source=""):
+    """INSERT لـ request_amounts من صف requests (القيم اتوحّدت وقت الكتابة => CAST مضبوط)"""
+    return f"""
+        INSERT INTO request_amounts (request_id, field, project_name, month, amount_minor)
+        SELECT {row}.id, f.key, COALESCE({row}.project_name, ''), substr({row}.created_at, 1, 7),
+               CAST(ROUND(CAST(f.value AS REAL) * {AMOUNT_SCALE}) AS INTEGER)
+        FROM {source}json_each({amount_values_sql(row)}) AS f
+        WHERE f.value <> '' AND f.value NOT GLOB '*[^0-9.]*' AND f.value GLOB '*[0-9]*'
+    """
+
+
+# المبالغ بالـ minor units (صف لكل مبلغ غير فاضي) للتقارير في SQL
+REQUEST_AMOUNTS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS request_amounts (
+    request_id INTEGER NOT NULL,
+    field TEXT NOT NULL,            -- paid_amount / pr_discount_amount / ...
+    project_name TEXT NOT NULL,
+    month TEXT NOT NULL,            -- YYYY-MM من created_at
+    amount_minor INTEGER NOT NULL,  -- المبلغ * AMOUNT_SCALE
+    PRIMARY KEY (request_id, field)
+) WITHOUT ROWID
+"""
+# تقرير لـ field معيّن على فترة شهور: range على month والباقي من الـ index نفسه
+REQUEST_AMOUNTS_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS idx_request_amounts_report "
+    "ON request_amounts(field, month, project_name, amount_minor)"
+)
+
+# request_amounts بيمشي مع requests زي request_stats (أي كتابة = نفس الـ transaction)
+REQUEST_AMOUNTS_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_request_amounts_insert
+    AFTER INSERT ON requests
+    BEGIN
+        {request_amounts_insert_sql("NEW").strip()};
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_request_amounts_update
+    AFTER UPDATE OF paid_amount, details, project_name, created_at ON requests
+    BEGIN
+        DELETE FROM request_amounts WHERE request_id = OLD.id;
+        {request_amounts_insert_sql("NEW").strip()};
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_request_amounts_delete
+    AFTER DELETE ON requests
+    BEGIN
+        DELETE FROM request_amounts WHERE request_id = OLD.id;
+    END
+    """,
+]
+
+
+# عدّاد عام بيزيد مع أي كتابة على requests / approvals (validator الداشبورد بدل ما نشغّل الاستعلامات)
+CHANGE_COUNTER_BUMP = """
+        UPDATE change_counter
+        SET version = version + 1, changed_at = strftime('%Y-%m-%dT%H:%M:%f', 'now')
+        WHERE id = 1;
+"""
+CHANGE_COUNTER_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_change_counter_{table}_{event.lower()}
+    AFTER {event} ON {table}
+    BEGIN{CHANGE_COUNTER_BUMP}    END
+    """
+    for table, events in (("requests", ("INSERT", "UPDATE", "DELETE")), ("approvals", ("INSERT", "DELETE")))
+    for event in events
+]
+
+
+# سجل تغييرات الطلبات للـ SSE (seq = Last-Event-ID)؛ بنحتفظ بآخر REQUEST_EVENTS_KEEP بس
+REQUEST_EVENTS_KEEP = 10000
+REQUEST_EVENT_COLUMNS = (
+    "request_id, status, old_status, project_name, unit_number, buyer_name, created_at"
+)
+REQUEST_EVENTS_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_request_events_insert
+    AFTER INSERT ON requests
+    BEGIN
+        INSERT INTO request_events (kind, {REQUEST_EVENT_COLUMNS})
+        VALUES ('created', NEW.id, NEW.status, NULL, NEW.project_name, NEW.unit_number,
+                NEW.buyer_name, NEW.created_at);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_request_events_update
+    AFTER UPDATE ON requests
+    BEGIN
+        INSERT INTO request_events (kind, {REQUEST_EVENT_COLUMNS})
+        VALUES (CASE WHEN OLD.status IS NEW.status THEN 'updated' ELSE 'status' END,
+                NEW.id, NEW.status, OLD.status, NEW.project_name, NEW.unit_number,
+                NEW.buyer_name, NEW.created_at);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_request_events_delete
+    AFTER DELETE ON requests
+    BEGIN
+        INSERT INTO request_events (kind, {REQUEST_EVENT_COLUMNS})
+        VALUES ('deleted', OLD.id, NULL, OLD.status, OLD.project_name, OLD.unit_number,
+                OLD.buyer_name, OLD.created_at);
+    END
+    """,
+    # range delete على الـ primary key (غالباً صف واحد) بدل job تنضيف
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_request_events_prune
+    AFTER INSERT ON request_events
+    BEGIN
+        DELETE FROM request_events WHERE seq <= NEW.seq - {REQUEST_EVENTS_KEEP};
+    END
+    """,
+]
+
+
+# طلب بيرجع من الأرشيف (restore_archived_request) مش طلب جديد => صف هنا طول الـ INSERT
+# بيمنع حدث 'created' (الـ trigger بيشوف جدول الـ schema بتاعته بس، فمفيش flag على الـ connection)
+REQUEST_EVENTS_MUTED_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS request_events_muted (
+    request_id INTEGER PRIMARY KEY
+)
+"""
+REQUEST_EVENTS_INSERT_TRIGGER_SQL = f"""
+    CREATE TRIGGER IF NOT EXISTS trg_request_events_insert
+    AFTER INSERT ON requests
+    WHEN NOT EXISTS (SELECT 1 FROM request_events_muted WHERE request_id = NEW.id)
+    BEGIN
+        INSERT INTO request_events (kind, {REQUEST_EVENT_COLUMNS})
+        VALUES ('created', NEW.id, NEW.status, NULL, NEW.project_name, NEW.unit_number,
+                NEW.buyer_name, NEW.created_at);
+    END
+    """
+
+
+def table_size_bytes(db, name):
+    """حجم الجدول على الديسك (dbstat)، None لو SQLite متبني من غير dbstat"""
+    try:
+        return db.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = ?", (name,)).fetchone()[0] or 0
+    except sqlite3.OperationalError:
+        return None
+
+
+def migrate_pack_request_details(db):
+    """
+    v4: أعمدة الأنواع (pr_*, bd_*, cpp_* ...) بتتنقل لـ details (JSON بالقيم غير الفاضية بس)
+    والـ *_selected بتتجمع في type_mask => rebuild للجدول بنفس الـ ids
+    """
+    columns = [r[1] for r in db.execute("PRAGMA table_info(requests)")]
+    if "details" in columns:
+        # قاعدة اتعملت من init_db بالشكل الجديد
+        return
+
+    size_before = table_size_bytes(db, "requests")
+    seq = db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'requests'").fetchone()
+
+    db.execute(REQUESTS_TABLE_SQL.format(name="requests_packed"))
+    kept = [r[1] for r in db.execute("PRAGMA table_info(requests_packed)")
+            if r[1] not in ("type_mask", "details")]
+    mask_sql = " | ".join(
+        f"(CASE WHEN {flag} THEN {bit} ELSE 0 END)" for flag, bit in REQUEST_TYPE_BITS.items()
+    )
+    # قسم لكل نوع: list بالقيم لو أي حقل فيه قيمة، وإلا NULL (وبيتشال من الـ object)
+    sections = []
+    for key, fields in DETAIL_SECTIONS.items():
+        filled = " OR ".join(f"{f} <> ''" for f in fields)
+        values = ", ".join(f"COALESCE({f}, '')" for f in fields)
+        sections.append(f"'{key}', CASE WHEN {filled} THEN json_array({values}) END")
+    details_sql = (
+        "NULLIF((SELECT json_group_object(key, json(value)) "
+        f"FROM json_each(json_object({', '.join(sections)})) WHERE value IS NOT NULL), '{{}}')"
+    )
+    db.execute(
+        f"INSERT INTO requests_packed ({', '.join(kept)}, type_mask, details) "
+        f"SELECT {', '.join(kept)}, {mask_sql}, {details_sql} FROM requests ORDER BY id"
+    )
+    # DROP TABLE ما بيشغّلش الـ delete triggers => request_stats و requests_fts زي ما هم
+    db.execute("DROP TABLE requests")
+    db.execute("ALTER TABLE requests_packed RENAME TO requests")
+    if seq is not None:
+        db.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'requests'", (seq[0],))
+
+    for sql in REQUEST_INDEXES + REQUEST_STATS_TRIGGERS + REQUEST_FTS_TRIGGERS:
+        db.execute(sql)
+
+    size_after = table_size_bytes(db, "requests")
+    if size_before and size_after is not None:
+        app.logger.info(
+            "requests packed: %.1f MiB -> %.1f MiB (%+.0f%%)",
+            size_before / 2**20, size_after / 2**20, 100 * (size_after / size_before - 1),
+        )
+
+
+def migrate_normalize_amounts_dates(db):
+    """
+    v5: يوحّد المبالغ والتواريخ في الطلبات القديمة بنفس normalize_amount / normalize_date
+    القيمة اللي ما اتفهمتش ("TBD" / "1.250,00") بتفضل زي ما هي ومش بتدخل request_amounts
+    => عددها والـ ids بتطلع في الـ log عشان تتصلح يدوي
+    """
+    changed, unparsed = [], []
+    for row in db.execute("SELECT id, paid_amount, requested_by_date, details FROM requests"):
+        values = {"paid_amount": row[1] or "", "requested_by_date": row[2] or ""}
+        values.update(unpack_details(row[3]))
+        fixed = normalize_request_values(values)
+        if fixed != values:
+            packed = pack_request_data(fixed)
+            changed.append((fixed["paid_amount"], fixed["requested_by_date"], packed["details"], row[0]))
+        if (any(fixed.get(f) and normalize_amount(fixed[f]) is None for f in AMOUNT_FIELDS)
+                or any(fixed.get(f) and normalize_date(fixed[f]) is None for f in DATE_FIELDS)):
+            unparsed.append(row[0])
+    db.executemany(
+        "UPDATE requests SET paid_amount = ?, requested_by_date = ?, details = ? WHERE id = ?", changed
+    )
+    app.logger.info("normalized amounts/dates in %s requests", len(changed))
+    if unparsed:
+        app.logger.warning(
+            "%s requests have amounts/dates that could not be normalized (left as is, not in the "
+            "amounts report): ids %s%s", len(unparsed), unparsed[:50], " ..." if len(unparsed) > 50 else ""
+        )
+
+
+SCHEMA_MIGRATIONS = [
+    (1, REQUEST_INDEXES + [APPROVALS_INDEX_SQL]),
+    (2, [
+        # تقدّم import-requests لكل ملف (بيتحدث في نفس transaction الدفعة => --resume مضبوط)
+        """
+        CREATE TABLE IF NOT EXISTS import_progress (
+            source TEXT PRIMARY KEY,
+            position INTEGER NOT NULL DEFAULT 0,    -- عدد الصفوف اللي خلصت من الملف
+            imported INTEGER NOT NULL DEFAULT 0,
+            rejected INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT
+        )
+        """,
+    ]),
+    (3, [REQUESTS_FTS_TABLE_SQL] + REQUEST_FTS_TRIGGERS + APPROVAL_FTS_TRIGGERS + [
+        # الطلبات الموجودة قبل الـ migration
+        """
+        INSERT INTO requests_fts (rowid, buyer_name, agent_name, agency_name, agent_contact,
+                                  comments, others_text, approval_comments)
+        SELECT r.id, r.buyer_name, r.agent_name, r.agency_name, r.agent_contact,
+               r.comments, r.others_text,
+               COALESCE((SELECT group_concat(a.comments, ' ') FROM approvals a WHERE a.request_id = r.id), '')
+        FROM requests r
+        """,
+    ]),
+    (4, [
+        migrate_pack_request_details,
+        # فلترة حسب نوع الطلب: WHERE type_mask & ? != 0
+        "CREATE INDEX IF NOT EXISTS idx_requests_type_mask ON requests(type_mask)",
+    ]),
+    (5, [
+        REQUEST_AMOUNTS_TABLE_SQL,
+        migrate_normalize_amounts_dates,
+        request_amounts_insert_sql("r", source="requests r, "),
+        REQUEST_AMOUNTS_INDEX_SQL,
+    ] + REQUEST_AMOUNTS_TRIGGERS),
+    (6, [
+        # صف واحد (id = 1) => ETag / Last-Modified للداشبورد من lookup واحد
+        """
+        CREATE TABLE IF NOT EXISTS change_counter (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            changed_at TEXT NOT NULL        -- UTC ISO
+        )
+        """,
+        "INSERT OR IGNORE INTO change_counter (id, version, changed_at) "
+        "VALUES (1, 0, strftime('%Y-%m-%dT%H:%M:%f', 'now'))",
+    ] + CHANGE_COUNTER_TRIGGERS),
+    (7, [
+        # /api/v1/requests/changes: keyset على (updated_at, id) (الـ id جوه الـ index ضمني)
+        "CREATE INDEX IF NOT EXISTS idx_requests_updated_at ON requests(updated_at)",
+    ]),
+    (8, [
+        # AUTOINCREMENT => الـ seq عمره ما بيتكرر بعد التنضيف (المتصفح بيكمّل من Last-Event-ID)
+        """
+        CREATE TABLE IF NOT EXISTS request_events (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,             -- created / status / updated / deleted
+            request_id INTEGER NOT NULL,
+            status TEXT,
+            old_status TEXT,
+            project_name TEXT,
+            unit_number TEXT,
+            buyer_name TEXT,
+            created_at TEXT
+        )
+        """,
+    ] + REQUEST_EVENTS_TRIGGERS),
+    (9, [
+        # رسايل بتتكتب في نفس transaction القرار، و outbox-worker بيسلّمها بعدين
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            topic TEXT NOT NULL,                    -- decision.recorded
+            idempotency_key TEXT NOT NULL UNIQUE,   -- الـ sink بيستخدمه عشان ما يكررش
+            payload TEXT NOT NULL,                  -- JSON
+            created_at TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending', -- pending / delivered / dead
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TEXT NOT NULL,          -- الـ backoff وكمان الـ lease بتاع الـ worker
+            delivered_at TEXT,
+            last_error TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(next_attempt_at) WHERE status = 'pending'",
+    ]),
+    (10, [
+        # فلتر unit + sort=project (idx_requests_unit بيفضل: فلتر unit مترتب بالـ id)
+        UNIT_PROJECT_INDEX_SQL,
+    ]),
+    # فرز project / unit بيعامل NULL كـ '' (الـ keyset كان بيقع عنده)
+    (11, listing_index_sql("main")),
+    (12, [
+        # archive-requests: كل status لوحده range على updated_at بالترتيب (ARCHIVE_CANDIDATES_SQL)
+        "CREATE INDEX IF NOT EXISTS idx_requests_status_updated_at ON requests(status, updated_at)",
+    ]),
+    (13, [
+        # الطلب اللي بيرجع من الأرشيف ما يظهرش في الداشبورد كطلب جديد
+        REQUEST_EVENTS_MUTED_TABLE_SQL,
+        "DROP TRIGGER IF EXISTS trg_request_events_insert",
+        REQUEST_EVENTS_INSERT_TRIGGER_SQL,
+    ]),
+]
+
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+
+def in_schema(sql, schema):
+    """
+    نفس الـ CREATE ... IF NOT EXISTS (table / index / trigger) جوه schema تانية (attached)
+    الـ trigger اللي مش TEMP بيشوف جداول الـ schema بتاعته بس => نفس الـ body من غير تعديل
+    """
+    return sql.replace("IF NOT EXISTS ", f"IF NOT EXISTS {schema}.", 1)
+
+
+# قاعدة الأرشيف (PRAGMA archive.user_version لوحده): نفس جداول الطلب + المشتقات اللي
+# الداشبورد بيقرا منها مع "include archived" (العدادات / البحث / تقرير المبالغ)
+# change_counter و request_events في main بس: النقل نفسه بيحدّثهم من الـ delete على main
+ARCHIVE_MIGRATIONS = [
+    (1, [
+        in_schema(sql, "archive") for sql in [
+            REQUESTS_TABLE_SQL.format(name="requests"),
+            APPROVALS_TABLE_SQL,
+            REQUEST_STATS_TABLE_SQL,
+            REQUESTS_FTS_TABLE_SQL,
+            REQUEST_AMOUNTS_TABLE_SQL,
+            APPROVALS_INDEX_SQL,
+            REQUEST_AMOUNTS_INDEX_SQL,
+        ] + REQUEST_INDEXES + REQUEST_STATS_TRIGGERS + REQUEST_FTS_TRIGGERS
+          + APPROVAL_FTS_TRIGGERS + REQUEST_AMOUNTS_TRIGGERS
+    ]),
+    (2, [
+        in_schema(UNIT_PROJECT_INDEX_SQL, "archive"),
+    ]),
+    (3, listing_index_sql("archive")),
+    (4, [
+        # /api/v1/requests/changes بيقرا الأرشيف كمان (API_CHANGES_SQL)
+        "CREATE INDEX IF NOT EXISTS archive.idx_requests_updated_at ON requests(updated_at)",
+    ]),
+]
+
+
+def migrate_db(db, migrations=SCHEMA_MIGRATIONS, schema="main"):
+    """يطبق الـ migrations الناقصة على ملف القاعدة (آمن لو أكتر من worker بدأ في نفس الوقت)"""
+    target = migrations[-1][0]
+    if db.execute(f"PRAGMA {schema}.user_version").fetchone()[0] >= target:
+        return
+
+    # BEGIN IMMEDIATE => worker واحد بس يطبق، والباقي يستنى ويلاقي الإصدار اتحدث
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        current = db.execute(f"PRAGMA {schema}.user_version").fetchone()[0]
+        for version, statements in migrations:
+            if version <= current:
+                continue
+            for step in statements:
+                if callable(step):
+                    step(db)
+                else:
+                    db.execute(step)
+            db.execute(f"PRAGMA {schema}.user_version = {version}")
+            app.logger.info("%s schema migrated to version %s", schema, version)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    # يحدّث إحصائيات الـ planner بعد إضافة indexes جديدة
+    db.execute(f"PRAGMA {schema}.optimize")
+
+
+def rebuild_request_stats(db):
+    """يعيد حساب request_stats من الصفر (لو العدادات انحرفت لأي سبب)"""
+    cur = db.cursor()
+    cur.execute("DELETE FROM request_stats")
     cur.execute("""
-    CREATE TABLE IF NOT EXISTS requests (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        created_at TEXT,
-        updated_at TEXT,
-        status TEXT,            -- Pending L1, Pending L2, Approved, Rejected
-        current_step INTEGER,   -- 1, 2, 0
-        edit_token TEXT,
-
-        project_name TEXT,
-        unit_number TEXT,
-        paid_amount TEXT,
-        buyer_name TEXT,
-        agent_name TEXT,
-        agency_name TEXT,
-        agent_contact TEXT,
-
-        price_reduction_selected INTEGER,
-        bulk_discount_selected INTEGER,
-        change_payment_plan_selected INTEGER,
-        unit_switch_selected INTEGER,
-        unit_cancellation_selected INTEGER,
-        refund_selected INTEGER,
-        late_payment_selected INTEGER,
-        waiver_late_fee_selected INTEGER,
-        issuance_spa_selected INTEGER,
-        registration_dld_selected INTEGER,
-        others_selected INTEGER,
-
-        pr_listed_price TEXT,
-        pr_discount_amount TEXT,
-        pr_selling_price TEXT,
-        pr_discount_percent TEXT,
-
-        bd_listed_price TEXT,
-        bd_discount_amount TEXT,
-        bd_selling_price TEXT,
-        bd_discount_percent TEXT,
-        bd_units TEXT,
-
-        cpp_down_payment_percent TEXT,
-        cpp_down_payment_date TEXT,
-        cpp_2nd_payment_percent TEXT,
-        cpp_2nd_payment_date TEXT,
-        cpp_3rd_payment_percent TEXT,
-        cpp_3rd_payment_date TEXT,
-        cpp_4th_payment_percent TEXT,
-        cpp_4th_payment_date TEXT,
-        cpp_5th_payment_percent TEXT,
-        cpp_5th_payment_date TEXT,
-        cpp_6th_payment_percent TEXT,
-        cpp_6th_payment_date TEXT,
-        cpp_completion_percent TEXT,
-        cpp_completion_date TEXT,
-
-        us_booked_unit TEXT,
-        us_new_unit TEXT,
-        us_new_unit_selling_price TEXT,
-
-        uc_amount_paid TEXT,
-
-        rf_booking_fees_amount TEXT,
-        rf_payment_amount TEXT,
-        rf_refund_amount TEXT,
-
-        lp_payment_schedule_no TEXT,
-        lp_initial_due_date TEXT,
-        lp_new_payment_date TEXT,
-        lp_penalty_amount TEXT,
-        lp_overdue_period TEXT,
-
-        wl_downpayment_spa_date TEXT,
-        wl_2nd_payment_spa_date TEXT,
-        wl_3rd_payment_spa_date TEXT,
-        wl_4th_payment_spa_date TEXT,
-        wl_5th_payment_spa_date TEXT,
-        wl_6th_payment_spa_date TEXT,
-
-        wl_penalty_amount TEXT,
-        wl_waiver_amount TEXT,
-
-        spa_down_payment_received TEXT,
-        spa_percent TEXT,
-
-        dld_down_payment_received TEXT,
-        dld_percent TEXT,
-
-        others_text TEXT,
-
-        doc_kyc TEXT,
-        doc_reservation_agreement TEXT,
-        doc_spa TEXT,
-        doc_others TEXT,
-        comments TEXT,
-
-        requested_by_signature TEXT,
-        requested_by_date TEXT
-    );
+        INSERT INTO request_stats (scope, project_name, status, n)
+        SELECT 'all', '', COALESCE(status, ''), COUNT(*)
+        FROM requests
+        GROUP BY COALESCE(status, '')
     """)
-
     cur.execute("""
-    CREATE TABLE IF NOT EXISTS approvals (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        request_id INTEGER,
-        level INTEGER,              -- 1 أو 2
-        approver_name TEXT,
-        decision TEXT,              -- Approved / Rejected
-        comments TEXT,
-        decided_at TEXT,
-        FOREIGN KEY(request_id) REFERENCES requests(id)
-    );
+        INSERT INTO request_stats (scope, project_name, status, n)
+        SELECT 'project', COALESCE(project_name, ''), COALESCE(status, ''), COUNT(*)
+        FROM requests
+        GROUP BY COALESCE(project_name, ''), COALESCE(status, '')
     """)
-
     db.commit()
 
 
+def load_status_counts(db, project_name=None, archived=False):
+    """
+    يرجّع dict فيه total + عداد لكل حالة من request_stats (lookup واحد على الـ primary key)
+    project_name=None يعني كل المشاريع
+    archived=True => + request_stats بتاع الأرشيف (db لازم يكون فيه الأرشيف attached)
+    """
+    counts = {"total": 0}
+    counts.update({key: 0 for key in STATUS_COUNTERS.values()})
+    for schema in ("main", "archive") if archived else ("main",):
+        if project_name is None:
+            rows = db.execute(
+                f"SELECT status, n FROM {schema}.request_stats WHERE scope = 'all' AND project_name = ''"
+            )
+        else:
+            rows = db.execute(
+                f"SELECT status, n FROM {schema}.request_stats "
+                "WHERE scope = 'project' AND project_name = ?",
+                (project_name,)
+            )
+        for status, n in rows:
+            counts["total"] += n
+            key = STATUS_COUNTERS.get(status)
+            if key:
+                counts[key] += n
+    return counts
+
+
+# ---------- أرشيف الطلبات (archive-requests) ----------
+REQUEST_IDS_SQL = "SELECT value FROM json_each(?)"
+# الطلبات اللي خلصت (مفيش قرار تاني متوقع عليها) وآخر تعديل فيها قبل الـ cutoff، الأقدم الأول
+# status IN (...) على idx_requests_status_updated_at = فرز كل المطابق (TEMP B-TREE)، إنما
+# UNION ALL لكل status => الاتنين مترتبين من الـ index و MERGE بيقف عند الـ LIMIT
+ARCHIVE_CANDIDATES_SQL = (
+    "SELECT id, updated_at FROM main.requests WHERE status = 'Approved' AND updated_at < :cutoff "
+    "UNION ALL "
+    "SELECT id, updated_at FROM main.requests WHERE status = 'Rejected' AND updated_at < :cutoff "
+    "ORDER BY updated_at LIMIT :limit"
+)
+
+
+def table_columns(db, schema, table):
+    return [r[1] for r in db.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def copy_requests(db, req_ids, source, target):
+    """
+    ينسخ طلبات + الـ approvals بتاعتها من schema لـ schema بنفس الـ ids (الـ triggers بتاعة
+    الهدف بتبني العدادات / الـ FTS / المبالغ). أي نسخة قديمة في الهدف بتتمسح الأول =>
+    إعادة المحاولة بعد crash في النص آمنة
+    """
+    ids = json.dumps(list(req_ids))
+    delete_requests(db, req_ids, target)
+    for table, key in (("requests", "id"), ("approvals", "request_id")):
+        columns = ", ".join(table_columns(db, target, table))
+        db.execute(
+            f"INSERT INTO {target}.{table} ({columns}) SELECT {columns} FROM {source}.{table} "
+            f"WHERE {key} IN ({REQUEST_IDS_SQL}) ORDER BY id",
+            (ids,)
+        )
+
+
+def delete_requests(db, req_ids, schema):
+    """يمسح طلبات + الـ approvals بتاعتها (الطلب الأول => الـ FTS بتاع الـ approvals ما يتحدّثش على الفاضي)"""
+    ids = json.dumps(list(req_ids))
+    db.execute(f"DELETE FROM {schema}.requests WHERE id IN ({REQUEST_IDS_SQL})", (ids,))
+    db.execute(f"DELETE FROM {schema}.approvals WHERE request_id IN ({REQUEST_IDS_SQL})", (ids,))
+
+
+def archive_requests_batch(db, cutoff, batch_size):
+    """
+    دفعة واحدة: Approved / Rejected آخر تعديل فيها قبل cutoff => الأرشيف، ويرجّع عددها
+    (db = connection فيه الأرشيف attached)
+    الـ commit على أكتر من قاعدة في WAL مش atomic => transaction للنسخ وبعده transaction
+    للمسح من main: لو وقف في النص الطلب بيبقى في الاتنين (main بيكسب) ومفيش حاجة بتضيع
+    """
+    req_ids = [r[0] for r in db.execute(ARCHIVE_CANDIDATES_SQL, {"cutoff": cutoff, "limit": batch_size})]
+    if not req_ids:
+        return 0
+
+    # DEFERRED => write lock على الأرشيف بس، والكتابة العادية على main ماشية
+    with write_transaction(db, lock="DEFERRED"):
+        copy_requests(db, req_ids, "main", "archive")
+    with write_transaction(db):
+        # اتنقل فعلاً + لسه زي ما هو (مفيش قرار / تعديل حصل بين الـ transactions)
+        moved = [r[0] for r in db.execute(
+            f"SELECT r.id FROM main.requests r JOIN archive.requests a ON a.id = r.id "
+            f"WHERE r.id IN ({REQUEST_IDS_SQL}) AND a.updated_at IS r.updated_at "
+            f"AND a.status IS r.status",
+            (json.dumps(req_ids),)
+        )]
+        delete_requests(db, moved, "main")
+        # اتغيّر في النص => النسخة اللي في الأرشيف قديمة، ويتنقل في دفعة بعدين لو لسه قديم
+        delete_requests(db, set(req_ids).difference(moved), "archive")
+    return len(moved)
+
+
+def restore_archived_request(db, req_id):
+    """
+    طلب في الأرشيف => يرجع main قبل أي تعديل / قرار عليه (لينك التعديل والمدير شغالين عادي)
+    لازم يتنادى جوه write_transaction على connection فيه الأرشيف، False لو مش في الأرشيف
+    """
+    if db.execute("SELECT 1 FROM archive.requests WHERE id = ?", (req_id,)).fetchone() is None:
+        return False
+    # نفس الـ transaction => محدش بيشوف الصف ده، والـ UPDATE / القرار بعده بيطلع حدثه عادي
+    db.execute("INSERT INTO main.request_events_muted (request_id) VALUES (?)", (req_id,))
+    copy_requests(db, (req_id,), "archive", "main")
+    db.execute("DELETE FROM main.request_events_muted WHERE request_id = ?", (req_id,))
+    delete_requests(db, (req_id,), "archive")
+    return True
+
+
+@contextmanager
+def request_write_transaction(db, req_id, archived):
+    """
+    write_transaction لتعديل / قرار على طلب واحد
+    archived => connection فيه الأرشيف والطلب بيرجع main في نفس الـ transaction الأول
+    (لو العملية فشلت الـ caller يعمل rollback => الـ restore بيترجع والطلب يفضل في الأرشيف)
+    (get_db() من غير ATTACH => الكتابة العادية ما بتاخدش lock على الأرشيف)
+    """
+    if not archived:
+        with write_transaction(db):
+            yield db
+        return
+    with closing(open_db(archive=True)) as adb, write_transaction(adb):
+        restore_archived_request(adb, req_id)
+        yield adb
+
+
 # ============================================
 # أدوات مساعدة
 # ============================================
@@ -204,6 +1292,11 @@ def is_manager_logged(level: int) -> bool:
 
 
 
+def is_staff_logged() -> bool:
+    """أي مدير (1 أو 2) أو الـ viewer"""
+    return bool(session.get("viewer")) or is_manager_logged(1) or is_manager_logged(2)
+
+
 def require_manager(level: int):
     """ترجع Redirect لو المدير مش مسجل دخول، أو None لو تمام"""
     if not is_manager_logged(level):
@@ -220,6 +1313,66 @@ def form_to_namespace(form, checkboxes=None):
     return SimpleNamespace(**data)
 
 
+# القيم اللي جاية من <input type="number"/"date"> غالباً بالشكل ده بالظبط => بترجع من غير parsing
+CANONICAL_AMOUNT_RE = re.compile(r"(?:0|[1-9][0-9]*)(?:\.[0-9]?[1-9])?")
+ISO_DATE_RE = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")
+# فاصل الآلاف ("," أو مسافة) بين مجموعات 3 أرقام بس => "1.250,00" (أوروبي) مرفوض بدل ما يبقى 1.25
+AMOUNT_INPUT_RE = re.compile(r"[0-9]{1,3}(?:([, ])[0-9]{3})?(?:\1[0-9]{3})*(?:\.[0-9]*)?|[0-9]+(?:\.[0-9]*)?|\.[0-9]+")
+
+
+def normalize_amount(text):
+    """'1,250.50' / 'AED 1250.5' -> '1250.5' (مقرّب لـ 2 decimal)، None لو مش مبلغ"""
+    if text and CANONICAL_AMOUNT_RE.fullmatch(text):
+        return text
+    text = (text or "").strip()
+    if text[:3].upper() == "AED":
+        text = text[3:].strip()
+    if not AMOUNT_INPUT_RE.fullmatch(text):
+        return None
+    text = text.replace(",", "").replace(" ", "")
+    try:
+        value = Decimal(text).quantize(Decimal(1) / AMOUNT_SCALE, rounding=ROUND_HALF_UP)
+    except InvalidOperation:
+        return None
+    return format(value.normalize(), "f")
+
+
+def normalize_date(text):
+    """'09/12/2025' / '2025-12-09T10:00' -> '2025-12-09'، None لو مش تاريخ"""
+    text = (text or "").strip()
+    if ISO_DATE_RE.fullmatch(text):
+        try:
+            return date.fromisoformat(text).isoformat()
+        except ValueError:
+            return None
+    for fmt in DATE_INPUT_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date().isoformat()
+        except ValueError:
+            pass
+    try:
+        return datetime.fromisoformat(text).date().isoformat()
+    except ValueError:
+        return None
+
+
+def normalize_request_values(data):
+    """نسخة من data فيها المبالغ والتواريخ بالشكل الموحّد (القيمة اللي مش مفهومة بتفضل زي ما هي)"""
+    data = dict(data)
+    for f in AMOUNT_FIELDS:
+        if data.get(f):
+            data[f] = normalize_amount(data[f]) or data[f].strip()
+    for f in DATE_FIELDS:
+        if data.get(f):
+            data[f] = normalize_date(data[f]) or data[f].strip()
+    return data
+
+
+# (اسم الحقل, strip؟, normalizer) لكل حقل في الفورم، محسوبة مرة واحدة من الـ registry
+FIELD_NORMALIZERS = {"amount": normalize_amount, "date": normalize_date}
+FORM_PARSERS = tuple((f.name, f.required, FIELD_NORMALIZERS.get(f.kind)) for f in ALL_FIELDS)
+
+
 def validate_required(data):
     """
     data: dict من بيانات الفورم بعد المعالجة
@@ -227,222 +1380,1632 @@ def validate_required(data):
     """
     errors = []
 
-    # 1) قسم Approval Request (كلّو إجباري)
-    header_required = [
-        ("project_name", "Project Name"),
-        ("unit_number", "Unit Number"),
-        ("paid_amount", "Paid Amount"),
-        ("buyer_name", "Buyer Name"),
-        ("agent_name", "Agent Name"),
-        ("agency_name", "Agency Name"),
-        ("agent_contact", "Agent Contact Number"),
-    ]
-    for field, label in header_required:
-        if not data.get(field, "").strip():
-            errors.append(f"{label} is required.")
-
-    # 2) Requested By (إجباري)
-    if not data.get("requested_by_signature", "").strip():
-        errors.append("Agent Signature (Requested By) is required.")
-    if not data.get("requested_by_date", "").strip():
-        errors.append("Requested By Date is required.")
-
-    # 3) لكل نوع تم اختياره: كل الحقول داخله إجباري
-    types_required = {
-        "price_reduction_selected": [
-            "pr_listed_price",
-            "pr_discount_amount",
-            "pr_selling_price",
-            "pr_discount_percent",
-        ],
-        "bulk_discount_selected": [
-            "bd_listed_price",
-            "bd_discount_amount",
-            "bd_selling_price",
-            "bd_discount_percent",
-            "bd_units",
-        ],
-        "change_payment_plan_selected": [
-            "cpp_down_payment_percent",
-            "cpp_down_payment_date",
-            "cpp_2nd_payment_percent",
-            "cpp_2nd_payment_date",
-            "cpp_3rd_payment_percent",
-            "cpp_3rd_payment_date",
-            "cpp_4th_payment_percent",
-            "cpp_4th_payment_date",
-            "cpp_5th_payment_percent",
-            "cpp_5th_payment_date",
-            "cpp_6th_payment_percent",
-            "cpp_6th_payment_date",
-            "cpp_completion_percent",
-            "cpp_completion_date",
-        ],
-        "unit_switch_selected": [
-            "us_booked_unit",
-            "us_new_unit",
-            "us_new_unit_selling_price",
-        ],
-        "unit_cancellation_selected": [
-            "uc_amount_paid",
-        ],
-        "refund_selected": [
-            "rf_booking_fees_amount",
-            "rf_payment_amount",
-            "rf_refund_amount",
-        ],
-        "late_payment_selected": [
-            "lp_payment_schedule_no",
-            "lp_initial_due_date",
-            "lp_new_payment_date",
-            "lp_penalty_amount",
-            "lp_overdue_period",
-        ],
-        "waiver_late_fee_selected": [
-            "wl_penalty_amount",
-            "wl_waiver_amount",
-        ],
-        "issuance_spa_selected": [
-            "spa_down_payment_received",
-            "spa_percent",
-        ],
-        "registration_dld_selected": [
-            "dld_down_payment_received",
-            "dld_percent",
-        ],
-        "others_selected": [
-            "others_text",
-        ],
+    # 1) الحقول العامة الإجبارية (Approval Request + Requested By)
+    for f in REQUIRED_FIELDS:
+        if not data.get(f.name, "").strip():
+            errors.append(f"{f.label} is required.")
+
+    # 2) لكل نوع تم اختياره: الحقول الإجبارية بتاعته (REQUEST_TYPE_REQUIRED)
+    for flag, names in REQUEST_TYPE_REQUIRED.items():
+        if data.get(flag):
+            for name in names:
+                if not data.get(name, "").strip():
+                    errors.append(f"Field '{name}' is required because this request type is selected.")
+
+    # 3) المبالغ والتواريخ لازم تتفهم (build_data_from_form بيوحّد اللي يتفهم)
+    for f in AMOUNT_FIELDS:
+        if data.get(f) and normalize_amount(data[f]) is None:
+            errors.append(f"Field '{f}' must be an amount (e.g. 1250.50).")
+    for f in DATE_FIELDS:
+        if data.get(f) and normalize_date(data[f]) is None:
+            errors.append(f"Field '{f}' must be a date (YYYY-MM-DD).")
+
+    return errors
+
+
+def build_data_from_form(form, *, for_update=False, prev_row=None):
+    """يقرأ بيانات الفورم (حسب REQUEST_FIELDS / REQUEST_TYPES) ويجهز dict لجدول requests"""
+    now = datetime.utcnow().isoformat()
+    # MultiDict.get بيرمي exception جوّاه لكل حقل مش مبعوت (أغلب حقول الأنواع) => dict عادي مرة واحدة
+    if isinstance(form, MultiDict):
+        form = form.to_dict()
+    get = form.get
+
+    base = {}
+    for name, required, normalize in FORM_PARSERS:
+        value = get(name, "")
+        if required:
+            value = value.strip()
+        if value and normalize is not None:
+            # القيمة اللي مش مفهومة بتفضل زي ما هي و validate_required بيرفضها
+            value = normalize(value) or value.strip()
+        base[name] = value
+    for flag in REQUEST_TYPE_BITS:
+        base[flag] = 1 if get(flag) == "on" else 0
+
+    if not for_update:
+        base["created_at"] = now
+        base["status"] = "Pending L1"
+        base["current_step"] = 1
+        base["edit_token"] = secrets.token_urlsafe(24)
+
+    base["updated_at"] = now
+    return base
+
+
+# الحقول اللي بتتجمع في type_mask / details (مش أعمدة)
+PACKED_FIELDS = frozenset(REQUEST_TYPE_BITS) | frozenset(DETAIL_FIELDS)
+
+# INSERT/UPDATE جاهزين (named params من dict بتاع pack_request_data) بدل ما يتبنوا مع كل POST
+REQUEST_COLUMNS = tuple(f.name for f in REQUEST_FIELDS) + ("type_mask", "details")
+REQUEST_INSERT_SQL = (
+    f"INSERT INTO requests ({', '.join(REQUEST_COLUMNS)}, created_at, updated_at, status, current_step, edit_token) "
+    f"VALUES ({', '.join(':' + c for c in REQUEST_COLUMNS)}, :created_at, :updated_at, :status, :current_step, :edit_token)"
+)
+REQUEST_UPDATE_SQL = (
+    f"UPDATE requests SET {', '.join(f'{c} = :{c}' for c in REQUEST_COLUMNS)}, updated_at = :updated_at "
+    "WHERE id = :id"
+)
+
+
+def pack_request_data(data):
+    """
+    dict مسطّح (build_data_from_form) -> أعمدة جدول requests:
+    الـ *_selected بتبقى type_mask، وحقول الأنواع غير الفاضية بتبقى details (JSON)
+    """
+    row = {k: v for k, v in data.items() if k not in PACKED_FIELDS}
+    row["type_mask"] = sum(bit for flag, bit in REQUEST_TYPE_BITS.items() if data.get(flag))
+    details = {}
+    for key, fields in DETAIL_SECTIONS.items():
+        values = [data.get(f) or "" for f in fields]
+        if any(values):
+            details[key] = values
+    row["details"] = json.dumps(details, ensure_ascii=False, separators=(",", ":")) if details else None
+    return row
+
+
+# كل حقول الأنواع فاضية (بترتيب DETAIL_FIELDS) => نسخة واحدة لكل صف بدل loop على ~70 حقل
+EMPTY_DETAILS = dict.fromkeys(DETAIL_FIELDS, "")
+
+
+def unpack_details(details):
+    """details (JSON من القاعدة) -> dict بكل حقول الأنواع (الناقص بيرجع string فاضي)"""
+    values = EMPTY_DETAILS.copy()
+    if details:
+        for key, packed in json.loads(details).items():
+            fields = DETAIL_SECTIONS.get(key)
+            if fields and packed:
+                # zip بيقف عند الأقصر => الحقول اللي مش في الـ list بتفضل ""
+                values.update(zip(fields, packed))
+    return values
+
+
+def request_record(row):
+    """صف من requests -> dict بكل المفاتيح القديمة (flags + حقول الأنواع) للتمبليتات"""
+    rec = dict(row)
+    mask = rec.pop("type_mask", 0) or 0
+    for flag, bit in REQUEST_TYPE_BITS.items():
+        rec[flag] = 1 if mask & bit else 0
+    rec.update(unpack_details(rec.pop("details", None)))
+    return rec
+
+
+DECISIONS = ("Approved", "Rejected")
+
+
+def decision_transition(level, decision):
+    """(status, current_step) الجديدين بعد قرار المدير: L1 => L2 => Approved، وأي رفض => Rejected"""
+    if decision == "Rejected":
+        return "Rejected", 0
+    if level == 1:
+        return "Pending L2", 2
+    return "Approved", 0
+
+
+# بيانات الطلب اللي بتروح مع رسالة القرار (للوكيل أو مدير المستوى التاني)
+OUTBOX_REQUEST_COLUMNS = ("project_name", "unit_number", "buyer_name", "agent_name", "agent_contact")
+OUTBOX_INSERT_SQL = (
+    "INSERT INTO outbox (topic, idempotency_key, payload, created_at, next_attempt_at) "
+    "VALUES (?, ?, ?, ?, ?)"
+)
+
+
+def decision_outbox_row(row, level, decision, approver_name, comments, now, new_status):
+    """صف outbox لقرار: Pending L2 => مدير المستوى التاني، غير كده => الوكيل"""
+    payload = {
+        "request_id": row["id"],
+        "level": level,
+        "decision": decision,
+        "approver_name": approver_name,
+        "comments": comments,
+        "decided_at": now,
+        "status": new_status,
+        "notify": "manager_l2" if new_status == "Pending L2" else "agent",
     }
+    payload.update((c, row[c]) for c in OUTBOX_REQUEST_COLUMNS)
+    return (
+        "decision.recorded",
+        f"decision:{row['id']}:{level}:{now}",
+        json.dumps(payload, ensure_ascii=False, separators=(",", ":")),
+        now,
+        now,
+    )
+
+
+# الـ status اللي كل مستوى بيقرر فيه
+DECISION_STATUS = {1: "Pending L1", 2: "Pending L2"}
+
+
+def decision_status_error(level, status):
+    """رسالة الخطأ لو الطلب مش في الـ status اللي المستوى ده بيقرر فيه، None لو ينفع"""
+    # Manager 1 على Pending L1 بس (bulk قديم / معدّل ما يرجّعش طلب خلص لـ Pending L2)
+    # ولا تسمح لـ Manager 2 يوافق لو لسا Pending L1
+    if status != DECISION_STATUS[level]:
+        return f"Request is not ready for Level {level}."
+    return None
+
+
+def apply_decisions(db, req_ids, level, decision, approver_name, comments, now):
+    """
+    نفس القرار (level 1 / 2) على طلب أو أكتر => صفوف في approvals + status / current_step
+    SELECT واحد للحالات + executemany للـ INSERT والـ UPDATE
+    لازم يتنادى جوه write_transaction (الحالة بتتقري جوه الـ lock عشان قرارين ما يدوسوش على بعض)
+    يرجّع [(req_id, error, new_status)] بنفس ترتيب req_ids، و error = None لو القرار اتسجل
+    """
+    req_ids = list(dict.fromkeys(req_ids))
+    if decision not in DECISIONS:
+        return [(req_id, "Invalid decision", None) for req_id in req_ids]
+    if not approver_name:
+        return [(req_id, "Approver name required", None) for req_id in req_ids]
+
+    rows = {
+        row["id"]: row for row in db.execute(
+            f"SELECT id, status, {', '.join(OUTBOX_REQUEST_COLUMNS)} FROM requests "
+            "WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps(req_ids),)
+        )
+    }
+    new_status, new_step = decision_transition(level, decision)
+
+    results = []
+    decided = []
+    for req_id in req_ids:
+        error = decision_status_error(level, rows[req_id]["status"]) if req_id in rows else "Request not found"
+        if error:
+            results.append((req_id, error, None))
+        else:
+            results.append((req_id, None, new_status))
+            decided.append(req_id)
+
+    db.executemany("""
+        INSERT INTO approvals (request_id, level, approver_name, decision, comments, decided_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [(req_id, level, approver_name, decision, comments, now) for req_id in decided])
+    db.executemany(
+        "UPDATE requests SET status=?, current_step=?, updated_at=? WHERE id=?",
+        [(new_status, new_step, now, req_id) for req_id in decided]
+    )
+    # الإشعارات في نفس الـ transaction => يا القرار والرسالة مع بعض يا ولا حاجة
+    db.executemany(OUTBOX_INSERT_SQL, [
+        decision_outbox_row(rows[req_id], level, decision, approver_name, comments, now, new_status)
+        for req_id in decided
+    ])
+    return results
+
+
+def apply_decision(db, req_id, level, decision, approver_name, comments, now):
+    """قرار على طلب واحد (manager_request / الـ API) => (error, new_status)"""
+    (_, error, new_status), = apply_decisions(
+        db, (req_id,), level, decision, approver_name, comments, now
+    )
+    return error, new_status
+
+
+# ---------- فلاتر وفرز الداشبورد ----------
+# filter=... في الـ URL -> قيمة status في القاعدة
+STATUS_FILTERS = {
+    "pending_l1": "Pending L1",
+    "pending_l2": "Pending L2",
+    "approved": "Approved",
+    "rejected": "Rejected",
+}
+
+# الأعمدة اللي جدول الداشبورد بيعرضها بس (الصف الكامل في view_request / manager_request)
+LISTING_COLUMNS = ("id", "project_name", "unit_number", "buyer_name", "status", "created_at")
+
+# صف خفيف (tuple + __slots__ فاضية) بدل sqlite3.Row للـ listing
+RequestSummary = namedtuple("RequestSummary", LISTING_COLUMNS)
+# نفس الصف + ترتيب الـ FTS (لما يكون فيه بحث)
+SearchSummary = namedtuple("SearchSummary", LISTING_COLUMNS + ("rank",))
+
+
+def summary_row_factory(cursor, values):
+    return RequestSummary._make(values)
+
+
+def search_row_factory(cursor, values):
+    return SearchSummary._make(values)
+
+
+# sort=... في الـ URL -> (عمود الفرز, الاتجاه)، وid دايماً آخر مفتاح (أي قيمة تانية = latest)
+LISTING_SORTS = {
+    "project": ("project_name", "ASC"),
+    "unit": ("unit_number", "ASC"),
+    "latest": (None, "DESC"),
+    "relevance": ("rank", "ASC"),   # بس مع ?q= (bm25: الأقل = الأقرب)
+}
+
+
+def sort_key_sql(column):
+    """
+    عمود الفرز كما هو في الـ ORDER BY والـ cursor: project_name / unit_number ممكن يبقوا NULL
+    (import / طلبات قديمة) و (NULL, id) > (?, ?) عمره ما بيطابق => NULL بيتفرز كـ ''
+    (نفس التعبير في الـ indexes والفلاتر => الـ planner بيستخدمهم)
+    """
+    return column if column == "rank" else f"COALESCE({column}, '')"
+
+
+def build_request_filters(flt, project, unit):
+    """يرجّع (where, params) لفلاتر status / project / unit"""
+    where = []
+    params = []
+
+    # فلتر حالة الطلب
+    status = STATUS_FILTERS.get(flt)
+    if status:
+        where.append("status = ?")
+        params.append(status)
+
+    # فلتر Project
+    if project:
+        where.append("COALESCE(project_name, '') = ?")
+        params.append(project)
+
+    # فلتر Unit
+    if unit:
+        where.append("COALESCE(unit_number, '') = ?")
+        params.append(unit)
+
+    return where, params
+
+
+def fts_query(text):
+    """نص البحث -> تعبير FTS5 MATCH: كل كلمة prefix ("ahm"*) والكلمات كلها AND"""
+    terms = [t.replace('"', "") for t in text.split()[:8]]
+    terms = [t for t in terms if any(ch.isalnum() for ch in t)]
+    if not terms:
+        return None
+    return " ".join(f'"{t}"*' for t in terms)
+
+
+def listing_sort(sort, search=None):
+    """(column, direction) للفرز المطلوب (relevance بس لما يكون فيه بحث)"""
+    if sort == "relevance" and not search:
+        sort = "latest"
+    return LISTING_SORTS.get(sort, LISTING_SORTS["latest"])
+
+
+def build_listing_sql(flt, project, unit, sort, cursor=None, backwards=False, limit=None,
+                      search=None, archived=False, schema="main"):
+    """
+    جملة SELECT الخاصة بجدول الداشبورد (نفس الفلاتر + الفرز)
+    cursor: (sort_key, id) أو (id,) لآخر صف في الصفحة اللي قبلها => keyset بدل OFFSET
+    backwards=True يعني بنرجع للصفحة السابقة (الفرز بيتعكس وبنقلب النتيجة بعدين)
+    search: تعبير FTS5 (من fts_query). sort=relevance => الترتيب بالـ bm25 بين أحدث
+    SEARCH_MAX_CANDIDATES نتيجة، وأي فرز تاني => كل النتايج بنفس الـ keyset بتاع الداشبورد
+    archived=True => نفس الاستعلام على main وعلى الأرشيف (كل واحد بالـ keyset والـ LIMIT بتوعه)
+    والـ UNION ALL بيرتّب ويقص من بره => أول limit صف من الاتنين مع بعض
+    """
+    column, direction = listing_sort(sort, search)
+    # فلتر بالمساواة على عمود الفرز => قيمة واحدة، والترتيب الفعلي بالـ id بس (الـ cursor
+    # فيه الـ sort_key زي ما هو). من غيرها الـ index بيمشي range على العمود والـ id بيتفرز لوحده
+    if column and {"project_name": project, "unit_number": unit}.get(column):
+        column = None
+    if backwards:
+        direction = "DESC" if direction == "ASC" else "ASC"
+
+    if archived:
+        arms, params = [], []
+        for arm_schema in ("main", "archive"):
+            arm, arm_params = build_listing_sql(
+                flt, project, unit, sort, cursor, backwards, limit, search, schema=arm_schema
+            )
+            arms.append(f"SELECT * FROM ({arm})")
+            params += arm_params
+        # ORDER BY على COALESCE(...) مش مسموح على الـ UNION نفسه => select من بره
+        sql = "SELECT * FROM (" + " UNION ALL ".join(arms) + ")"
+        if column:
+            sql += f" ORDER BY {sort_key_sql(column)} {direction}, id {direction}"
+        else:
+            sql += f" ORDER BY id {direction}"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return sql, params
+
+    where, params = build_request_filters(flt, project, unit)
+    columns = ", ".join(f"r.{c}" for c in LISTING_COLUMNS)
+    if search and column == "rank":
+        # الـ FTS بيمشي بالـ rowid من الأحدث ويقف عند الحد => كلمة عامة زي "mo" ما تحسبش
+        # bm25 لمئات الآلاف من الصفوف، والـ keyset بيتطبق على النتيجة دي من بره
+        # (bm25 بتاع الأرشيف بإحصائيات الأرشيف => الترتيب بين الاتنين تقريبي)
+        # الـ cursor على rank تقريبي: أي كتابة بين صفحتين بتغيّر إحصائيات الـ bm25 فصف ممكن
+        # يتكرر أو يتنط. sort=latest بيقلّب كل النتايج بالظبط
+        inner = (f"SELECT {columns}, bm25(requests_fts) AS rank FROM {schema}.requests_fts "
+                 f"JOIN {schema}.requests r ON r.id = requests_fts.rowid "
+                 f"WHERE " + " AND ".join(["requests_fts MATCH ?"] + where) +
+                 " ORDER BY requests_fts.rowid DESC LIMIT ?")
+        params = [search] + params + [app.config["SEARCH_MAX_CANDIDATES"]]
+        sql = f"SELECT * FROM ({inner})"
+        id_column = "id"
+        where = []
+    elif search:
+        # من غير bm25: الـ FTS بيرجّع الـ rowids والفلاتر / الفرز / الـ keyset زي من غير بحث
+        where.append(f"r.id IN (SELECT rowid FROM {schema}.requests_fts WHERE requests_fts MATCH ?)")
+        params.append(search)
+        sql = f"SELECT {columns}, NULL AS rank FROM {schema}.requests r"
+        id_column = "r.id"
+    else:
+        sql = f"SELECT {columns} FROM {schema}.requests r"
+        id_column = "r.id"
+
+    if cursor:
+        op = ">" if direction == "ASC" else "<"
+        if column:
+            # (key, id) > (?, ?) مفكوكة: الـ planner ما بيعملش range على index تعبير من row-value
+            key = sort_key_sql(column)
+            where.append(f"{key} {op}= ? AND ({key} {op} ? OR {id_column} {op} ?)")
+            params.extend([cursor[0], cursor[0], cursor[-1]])
+        else:
+            where.append(f"{id_column} {op} ?")
+            params.append(cursor[-1])
+
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    if column:
+        sql += f" ORDER BY {sort_key_sql(column)} {direction}, {id_column} {direction}"
+    else:
+        sql += f" ORDER BY {id_column} {direction}"
+    if limit:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return sql, params
+
+
+def encode_cursor(values):
+    """(sort_key, id) -> نص قصير ينفع في الـ URL"""
+    raw = json.dumps(list(values), separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token):
+    """عكس encode_cursor، ويرجّع None لو النص بايظ"""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        values = json.loads(raw)
+    except ValueError:
+        return None
+    if not isinstance(values, list) or not 1 <= len(values) <= 2 or not isinstance(values[-1], int):
+        return None
+    return values
+
+
+def listing_page_size():
+    """حجم الصفحة من ?per_page= أو من الإعدادات"""
+    size = request.args.get("per_page", type=int) or app.config["DASHBOARD_PAGE_SIZE"]
+    return max(1, min(size, app.config["DASHBOARD_MAX_PAGE_SIZE"]))
+
+
+def fetch_listing_page(db, flt, project, unit, sort, page_size, search=None, archived=False):
+    """
+    يجيب صفحة واحدة من الطلبات حسب ?after= / ?before= في الـ URL
+    يرجّع (rows, next_cursor, prev_cursor) والـ rows من نوع RequestSummary (أو SearchSummary)
+    archived=True => الأرشيف كمان (db = connection القراية)
+    """
+    after = decode_cursor(request.args.get("after"))
+    before = decode_cursor(request.args.get("before")) if not after else None
+    column, _ = listing_sort(sort, search)
+    # cursor فيه sort_key لازم يطابق نوع الفرز الحالي
+    expected_len = 2 if column else 1
+    if after and len(after) != expected_len:
+        after = None
+    if before and len(before) != expected_len:
+        before = None
+
+    sql, params = build_listing_sql(
+        flt, project, unit, sort,
+        cursor=before or after,
+        backwards=before is not None,
+        limit=page_size + 1,
+        search=search,
+        archived=archived
+    )
+    cur = db.cursor()
+    cur.row_factory = search_row_factory if search else summary_row_factory
+    cur.execute(sql, params)
+    rows = cur.fetchall()
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if before:
+        rows.reverse()
+
+    def cursor_of(row):
+        if not column:
+            return encode_cursor((row.id,))
+        key = getattr(row, column)
+        return encode_cursor(("" if key is None else key, row.id))
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if has_more or before:
+            next_cursor = cursor_of(rows[-1])
+        if (has_more and before) or after:
+            prev_cursor = cursor_of(rows[0])
+    return rows, next_cursor, prev_cursor
+
+
+def page_urls(endpoint, next_cursor, prev_cursor, **args):
+    """روابط Next/Prev بنفس الفلاتر الحالية"""
+    args = {k: v for k, v in args.items() if v}
+    next_url = url_for(endpoint, after=next_cursor, **args) if next_cursor else None
+    prev_url = url_for(endpoint, before=prev_cursor, **args) if prev_cursor else None
+    return next_url, prev_url
+
+
+def include_archived():
+    """?archived=1 => الداشبورد / التصدير / التقرير بيقروا من الأرشيف كمان"""
+    return request.args.get("archived") == "1"
+
+
+def archived_toggle_url(endpoint, archived, **args):
+    """نفس الصفحة بنفس الفلاتر (من أول صفحة) مع عكس include archived"""
+    args = {k: v for k, v in args.items() if v}
+    if not archived:
+        args["archived"] = 1
+    return url_for(endpoint, **args)
+
+
+def load_filter_choices(db, archived=False):
+    """(projects, units) الموجودين فعلاً في القاعدة (والأرشيف لو archived) لقوايم الفلاتر"""
+    choices = []
+    for column in ("project_name", "unit_number"):
+        # نفس تعبير الـ index (sort_key_sql)، و '' (من غير قيمة) مش اختيار في الفلتر
+        key = sort_key_sql(column)
+        sql = f"SELECT DISTINCT {key} FROM main.requests"
+        if archived:
+            sql = f"SELECT {key} FROM main.requests UNION SELECT {key} FROM archive.requests"
+        choices.append([r[0] for r in db.execute(sql + " ORDER BY 1") if r[0]])
+    return choices
+
+
+# ---------- تصدير requests + approvals ----------
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+}
+
+
+def iter_export(db, fmt, flt="all", project="", unit="", compress=False, archived=False):
+    """
+    Generator بيرجّع bytes: صف لكل (request, approval) (الطلب من غير approvals بيطلع مرة)
+    بيقرا بـ fetchmany دفعات => الذاكرة ثابتة سواء 100 صف أو ملايين
+    compress=True => gzip on the fly
+    archived=True => الأرشيف الأول (الأقدم) وبعده main، كل واحد مترتب بالـ id
+    """
+    where, params = build_request_filters(flt, project, unit)
+    # الـ SELECTs كلها بتبدأ قبل أول fetch => نفس الـ read transaction (طلب اتأرشف في النص
+    # ما بيطلعش مرتين ولا بيضيع)
+    cursors = []
+    for schema in ("archive", "main") if archived else ("main",):
+        sql = f"""
+            SELECT r.*,
+                   a.level AS approval_level,
+                   a.approver_name AS approval_approver_name,
+                   a.decision AS approval_decision,
+                   a.comments AS approval_comments,
+                   a.decided_at AS approval_decided_at
+            FROM {schema}.requests r
+            LEFT JOIN {schema}.approvals a ON a.request_id = r.id
+        """
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY r.id, a.level, a.decided_at"
+
+        cur = db.cursor()
+        cur.row_factory = None
+        cur.execute(sql, params)
+        cursors.append(cur)
+    raw_columns = [d[0] for d in cursors[0].description]
+    batch_size = app.config["EXPORT_BATCH_SIZE"]
+
+    # type_mask / details بيتفردوا لأعمدة مسطّحة (نفس شكل الطلب في الفورم) قبل أعمدة الـ approval
+    mask_i = raw_columns.index("type_mask")
+    details_i = raw_columns.index("details")
+    split = raw_columns.index("approval_level")
+    head = [i for i in range(split) if i not in (mask_i, details_i)]
+    columns = ([raw_columns[i] for i in head] + list(REQUEST_TYPE_BITS) + list(DETAIL_FIELDS)
+               + raw_columns[split:])
+
+    def flat(row):
+        mask = row[mask_i] or 0
+        return ([row[i] for i in head]
+                + [1 if mask & bit else 0 for bit in REQUEST_TYPE_BITS.values()]
+                + list(unpack_details(row[details_i]).values())
+                + list(row[split:]))
+
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+
+    def chunk():
+        data = buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+        return gz.compress(data) if gz else data
+
+    if fmt == "csv":
+        writer.writerow(columns)
+
+    for cur in cursors:
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            rows = [flat(row) for row in rows]
+            if fmt == "csv":
+                writer.writerows(rows)
+            else:
+                for row in rows:
+                    buf.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                    buf.write("\n")
+            data = chunk()
+            if data:
+                yield data
+
+    data = chunk()
+    if gz:
+        data += gz.flush()
+    if data:
+        yield data
+
+
+# ---------- تقارير المبالغ (SUM/AVG/COUNT في SQL من request_amounts) ----------
+# field -> نوع الطلب اللي تبعه (paid_amount عام => None)
+AMOUNT_FIELD_TYPES = {
+    f: next((flag for flag, fields in REQUEST_TYPE_FIELDS.items() if f in fields), None)
+    for f in AMOUNT_FIELDS
+}
+
+
+def build_amounts_report_sql(field="", project="", flt="all", month_from="", month_to="",
+                             archived=False):
+    """
+    تجميع لكل (field, project, month)، الفلاتر الفاضية بتتشال
+    archived=True => صفوف request_amounts من main والأرشيف (UNION ALL) قبل التجميع
+    """
+    where, params = [], []
+    if field:
+        where.append("a.field = ?")
+        params.append(field)
+    if month_from:
+        where.append("a.month >= ?")
+        params.append(month_from)
+    if month_to:
+        where.append("a.month <= ?")
+        params.append(month_to)
+    if project:
+        where.append("a.project_name = ?")
+        params.append(project)
+
+    if flt in STATUS_FILTERS:
+        params.insert(0, STATUS_FILTERS[flt])
+
+    def source(schema):
+        sql = f" FROM {schema}.request_amounts a"
+        if flt in STATUS_FILTERS:
+            # الحالة بتتغير مع كل قرار => بتتقرا من requests بالـ primary key
+            sql += f" JOIN {schema}.requests r ON r.id = a.request_id AND r.status = ?"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return sql
+
+    aggregates = """
+        SELECT a.field, a.project_name, a.month,
+               COUNT(*) AS n,
+               SUM(a.amount_minor) AS sum_minor,
+               CAST(ROUND(AVG(a.amount_minor)) AS INTEGER) AS avg_minor
+    """
+    if archived:
+        rows = " UNION ALL ".join(
+            "SELECT a.field, a.project_name, a.month, a.amount_minor" + source(schema)
+            for schema in ("main", "archive")
+        )
+        sql = aggregates + f" FROM ({rows}) a"
+        params = params * 2
+    else:
+        sql = aggregates + source("main")
+    sql += " GROUP BY a.field, a.project_name, a.month ORDER BY a.field, a.project_name, a.month"
+    return sql, params
+
+
+# ---------- استيراد طلبات قديمة (import-requests) ----------
+# قيم الـ checkbox في الشيتات القديمة
+IMPORT_TRUE_VALUES = {"1", "on", "true", "yes", "y", "x"}
+
+# الحالة -> current_step (للطلبات التاريخية اللي خلصت)
+IMPORT_STATUS_STEPS = {
+    "Pending L1": 1,
+    "Pending L2": 2,
+    "Approved": 0,
+    "Rejected": 0,
+}
+
+
+def iter_import_records(fh, fmt):
+    """يرجّع (record, error) لكل صف في الملف (CSV بـ header أو JSONL)"""
+    if fmt == "csv":
+        for rec in csv.DictReader(fh):
+            yield rec, None
+        return
+
+    for line in fh:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            rec = json.loads(line)
+        except ValueError as e:
+            yield {"raw": line}, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(rec, dict):
+            yield {"raw": line}, "Each JSONL line must be an object."
+            continue
+        yield rec, None
+
+
+def import_record_to_data(rec):
+    """
+    صف من ملف الاستيراد -> (data, errors) بنفس build_data_from_form و validate_required
+    status / created_at / updated_at اختيارية عشان الطلبات التاريخية
+    """
+    form = {}
+    for key, value in rec.items():
+        if key is None:  # أعمدة زيادة في CSV
+            continue
+        value = "" if value is None else str(value)
+        if key.endswith("_selected"):
+            value = "on" if value.strip().lower() in IMPORT_TRUE_VALUES else ""
+        form[key] = value
+
+    data = build_data_from_form(form, for_update=False)
+    errors = validate_required(data)
+
+    status = form.get("status", "").strip()
+    if status:
+        if status in IMPORT_STATUS_STEPS:
+            data["status"] = status
+            data["current_step"] = IMPORT_STATUS_STEPS[status]
+        else:
+            errors.append(f"Unknown status '{status}'.")
+
+    created_at = form.get("created_at", "").strip()
+    if created_at:
+        # لازم يبدأ بـ YYYY-MM (request_amounts.month والفرز بيعتمدوا عليه)
+        if normalize_date(created_at[:10]) != created_at[:10]:
+            created_at = normalize_date(created_at) or ""
+            if not created_at:
+                errors.append(f"Invalid created_at '{form['created_at']}'.")
+        data["created_at"] = created_at
+        data["updated_at"] = form.get("updated_at", "").strip() or created_at
+
+    return data, errors
+
+
+# ---------- بيانات تجريبية (seed-requests) لقياس الأداء على حجم حقيقي ----------
+# الحالة -> وزنها (الطلبات الأقدم من SEED_PENDING_DAYS بتبقى خلصت: Approved / Rejected بس)
+SEED_STATUS_WEIGHTS = {"Pending L1": 20, "Pending L2": 10, "Approved": 55, "Rejected": 15}
+SEED_PENDING_DAYS = 30
+# عدد الأنواع المختارة في الطلب الواحد -> وزنه
+SEED_TYPE_COUNT_WEIGHTS = {1: 70, 2: 25, 3: 5}
+# flag -> وزنه (تخفيض السعر وتغيير خطة الدفع الأكتر)
+SEED_TYPE_WEIGHTS = {
+    "price_reduction_selected": 25,
+    "change_payment_plan_selected": 20,
+    "late_payment_selected": 15,
+    "waiver_late_fee_selected": 10,
+    "unit_switch_selected": 8,
+    "refund_selected": 6,
+    "unit_cancellation_selected": 5,
+    "bulk_discount_selected": 4,
+    "issuance_spa_selected": 4,
+    "registration_dld_selected": 3,
+    "others_selected": 3,
+}
+SEED_FIRST_NAMES = ("Ahmed", "Mohamed", "Omar", "Sara", "Fatima", "Khalid", "Layla", "Youssef",
+                    "Mariam", "Ali", "Hassan", "Noura", "John", "Priya", "Elena", "Ivan")
+SEED_LAST_NAMES = ("Hassan", "Al Mansouri", "Khan", "Ibrahim", "Saleh", "Haddad", "Smith",
+                   "Patel", "Petrova", "Nasser", "Farouk", "Rahman")
+SEED_AGENCIES = ("Prime Homes", "Gulf Realty", "Marina Properties", "Blue Key Real Estate",
+                 "Desert Rose Brokers", "Skyline Estates", "Direct (no agency)")
+SEED_APPROVERS = {1: ("Sales Manager", "Deputy Sales Manager"), 2: ("Sales Director", "CFO")}
+
+
+def seed_field_value(rng, field, created):
+    """قيمة شكلها حقيقي لحقل نوع (بنفس الشكل اللي الفورم بيبعته)"""
+    if field.kind == "amount":
+        return f"{rng.randrange(5000, 3000000, 500):,}.00"
+    if field.kind == "date":
+        return (created + timedelta(days=rng.randint(-180, 365))).strftime("%Y-%m-%d")
+    if field.kind == "number":
+        return str(rng.choice((5, 10, 15, 20, 25, 30))) if "percent" in field.name else str(rng.randint(1, 12))
+    if "unit" in field.name:
+        return rng.choice(UNIT_CHOICES)
+    return str(rng.randint(1, 12))
+
+
+def seed_request_form(rng, created):
+    """فورم طلب جديد (dict زي request.form) بنوع أو أكتر مختار وحقوله مليانة"""
+    agent = f"{rng.choice(SEED_FIRST_NAMES)} {rng.choice(SEED_LAST_NAMES)}"
+    form = {
+        "project_name": rng.choice(PROJECT_CHOICES),
+        "unit_number": rng.choice(UNIT_CHOICES),
+        "paid_amount": f"{rng.randrange(20000, 2000000, 1000):,}",
+        "buyer_name": f"{rng.choice(SEED_FIRST_NAMES)} {rng.choice(SEED_LAST_NAMES)}",
+        "agent_name": agent,
+        "agency_name": rng.choice(SEED_AGENCIES),
+        "agent_contact": f"+9715{rng.randrange(10 ** 7, 10 ** 8)}",
+        "doc_kyc": "Yes",
+        "doc_reservation_agreement": rng.choice(("Yes", "")),
+        "doc_spa": rng.choice(("Yes", "", "")),
+        "comments": rng.choice(("", "", "Client requested a call back.", "Urgent - handover this month.")),
+        "requested_by_signature": agent,
+        "requested_by_date": created.strftime("%Y-%m-%d"),
+    }
+
+    flags = list(SEED_TYPE_WEIGHTS)
+    weights = list(SEED_TYPE_WEIGHTS.values())
+    count = rng.choices(list(SEED_TYPE_COUNT_WEIGHTS), list(SEED_TYPE_COUNT_WEIGHTS.values()))[0]
+    chosen = set()
+    while len(chosen) < count:
+        chosen.add(rng.choices(flags, weights)[0])
+    for rtype in REQUEST_TYPES:
+        if rtype.flag not in chosen:
+            continue
+        form[rtype.flag] = "on"
+        for field in rtype.fields:
+            form[field.name] = seed_field_value(rng, field, created)
+    if "others_selected" in chosen:
+        form["others_text"] = "Change of buyer name on SPA."
+    return form
+
+
+def seed_decisions(rng, status, created, now):
+    """تاريخ الموافقات اللي يوصّل الطلب للحالة دي: [(level, decision, approver, decided_at), ...]"""
+    if status == "Pending L1":
+        return []
+    if status == "Rejected" and rng.random() < 0.5:
+        steps = ((1, "Rejected"),)
+    else:
+        steps = ((1, "Approved"),) if status == "Pending L2" else ((1, "Approved"), (2, status))
+    decided = created
+    decisions = []
+    for level, decision in steps:
+        # الطلبات اللي لسه متقدّمة النهارده ما ياخدوش قرار في المستقبل
+        decided = min(decided + timedelta(minutes=rng.randint(30, 72 * 60)), now)
+        decisions.append((level, decision, rng.choice(SEED_APPROVERS[level]), decided.isoformat()))
+    return decisions
+
+
+# ============================================
+# كاش HTML (LRU بحد أقصى للذاكرة)
+# ============================================
+
+class LRUCache:
+    """
+    LRU على حجم القيم (sys.getsizeof) مش عددها + عدادات hit/miss
+    tag => كل المفاتيح اللي تخص نفس الطلب بتتمسح مرة واحدة (invalidate)
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()     # key -> (value, size, tag)
+        self._tags = {}                 # tag -> set(keys)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, tag=None):
+        size = sys.getsizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._items[key] = (value, size, tag)
+            self.bytes += size
+            if tag is not None:
+                self._tags.setdefault(tag, set()).add(key)
+            while self.bytes > self.max_bytes:
+                self._discard(next(iter(self._items)))
+                self.evictions += 1
+
+    def invalidate(self, tag):
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._tags.clear()
+            self.bytes = 0
+
+    def _discard(self, key):
+        item = self._items.pop(key, None)
+        if item is None:
+            return
+        self.bytes -= item[1]
+        tag = item[2]
+        if tag is not None:
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._items),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+            }
+
+
+page_cache = LRUCache(app.config["PAGE_CACHE_MAX_BYTES"])
+
+
+def cached_page(key, render, tag=None):
+    """يرجّع الـ HTML من الكاش أو يرندره ويخزنه"""
+    html = page_cache.get(key)
+    if html is None:
+        html = render()
+        page_cache.set(key, html, tag=tag)
+    return html
+
+
+@app.template_global()
+def static_fragment(template_name):
+    """
+    جزء ثابت من الفورم (مثلاً datalist الـ 300 وحدة) بيترندر مرة واحدة لكل process
+    {{ static_fragment('partials/unit_datalist.html') }}
+    """
+    return cached_page(
+        ("fragment", template_name),
+        lambda: Markup(render_template(
+            template_name, project_choices=PROJECT_CHOICES, unit_choices=UNIT_CHOICES
+        )),
+    )
+
+
+# ---------- Conditional GET (ETag / Last-Modified) ----------
+def parse_utc(text):
+    """updated_at / changed_at (ISO UTC من غير timezone) -> datetime aware، None لو مش مفهوم"""
+    try:
+        return datetime.fromisoformat(text).replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return None
+
+
+def page_validators(*parts, last_modified=None):
+    """(etag, last_modified) من أجزاء بتتغير مع البيانات (version / updated_at / الفلاتر / الدور)"""
+    raw = repr((app.config["ETAG_SALT"],) + parts).encode("utf-8")
+    return hashlib.sha1(raw).hexdigest()[:24], parse_utc(last_modified)
+
+
+def not_modified(etag, last_modified):
+    """
+    304 لو نسخة المتصفح لسه صالحة (قبل أي استعلام أو render)، وإلا None
+    بالـ If-None-Match بس: Last-Modified دقته ثانية => تغيير في نفس الثانية كان بيرجع 304
+    قديم لـ If-Modified-Since (الـ header بيتبعت للمعلومة بس، والـ ETag هو الـ validator)
+    """
+    if request.method not in ("GET", "HEAD"):
+        return None
+    if not request.if_none_match or not request.if_none_match.contains_weak(etag):
+        return None
+    return with_validators(Response(status=304), etag, last_modified)
+
+
+def with_validators(response, etag, last_modified):
+    """ETag ضعيف (المحتوى نفسه ممكن يتضغط) + المتصفح يسأل كل مرة قبل ما يستخدم نسخته"""
+    response = app.make_response(response)
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+    return response
+
+
+def load_request_version(db, req_id, schema="main"):
+    """(updated_at, آخر approval id) لطلب => validator صفحته، None لو مش موجود"""
+    return db.execute(f"""
+        SELECT r.updated_at,
+               (SELECT MAX(a.id) FROM {schema}.approvals a WHERE a.request_id = r.id) AS last_approval
+        FROM {schema}.requests r WHERE r.id = ?
+    """, (req_id,)).fetchone()
+
+
+def locate_request(db, req_id):
+    """
+    (schema, version) للطلب: main الأول وبعدين الأرشيف (db = connection القراية)
+    => لينكات الطلبات القديمة شغالة بعد الأرشفة، و (None, None) لو مش موجود خالص
+    """
+    for schema in ("main", "archive"):
+        version = load_request_version(db, req_id, schema)
+        if version:
+            return schema, version
+    return None, None
+
+
+def load_change_counter(db):
+    """(version, changed_at) للعدّاد العام (lookup بالـ primary key)"""
+    row = db.execute("SELECT version, changed_at FROM change_counter WHERE id = 1").fetchone()
+    return (row[0], row[1]) if row else (0, None)
+
+
+# ---------- تفاصيل طلب (view_request / manager_request) ----------
+# الأعمدة اللي request_view.html بيعرضها بس (من غير edit_token / created_at / ...)
+REQUEST_VIEW_COLUMNS = ("id", "status") + tuple(f.name for f in REQUEST_FIELDS) + ("type_mask", "details")
+APPROVAL_JSON = "json_object('id', a.id, 'level', a.level, 'approver_name', a.approver_name, " \
+                "'decision', a.decision, 'comments', a.comments, 'decided_at', a.decided_at)"
+# استعلام واحد: الطلب + كل الـ approvals (JSON array) + آخر قرار لكل مستوى
+# الـ subqueries كلها على idx_approvals_request_level (request_id, level, decided_at)
+# (schema -> SQL) عشان الطلب المؤرشف بيتعرض بنفس الاستعلام من archive.*
+REQUEST_DETAIL_SQL = {
+    schema: f"""
+    SELECT {', '.join('r.' + c for c in REQUEST_VIEW_COLUMNS)},
+           (SELECT json_group_array({APPROVAL_JSON})
+            FROM {schema}.approvals a WHERE a.request_id = r.id) AS approvals_json,
+           (SELECT {APPROVAL_JSON} FROM {schema}.approvals a
+            WHERE a.request_id = r.id AND a.level = 1
+            ORDER BY a.decided_at DESC, a.id DESC LIMIT 1) AS manager1_json,
+           (SELECT {APPROVAL_JSON} FROM {schema}.approvals a
+            WHERE a.request_id = r.id AND a.level = 2
+            ORDER BY a.decided_at DESC, a.id DESC LIMIT 1) AS manager2_json
+    FROM {schema}.requests r
+    WHERE r.id = ?
+"""
+    for schema in ("main", "archive")
+}
+
+RequestDetail = namedtuple("RequestDetail", ("req", "approvals", "manager1_sig", "manager2_sig"))
+
+
+def load_request_detail(db, req_id, schema="main"):
+    """RequestDetail في round trip واحد، None لو الطلب مش موجود"""
+    row = db.execute(REQUEST_DETAIL_SQL[schema], (req_id,)).fetchone()
+    if row is None:
+        return None
+    req = request_record(row)
+    approvals = json.loads(req.pop("approvals_json"))
+    # json_group_array مش بيضمن الترتيب => بالمستوى والوقت زي الأول (القايمة صغيرة)
+    approvals.sort(key=lambda a: (a["level"] or 0, a["decided_at"] or "", a["id"]))
+    manager1_json = req.pop("manager1_json")
+    manager2_json = req.pop("manager2_json")
+    return RequestDetail(
+        req,
+        approvals,
+        json.loads(manager1_json) if manager1_json else None,
+        json.loads(manager2_json) if manager2_json else None,
+    )
+
+
+def render_request_view(db, req_id, manager_level=None, error=None, edit_link=None, from_submit=False,
+                        schema="main"):
+    """request_view.html لطلب (العرض العادي وصفحة المدير)"""
+    detail = load_request_detail(db, req_id, schema)
+    if detail is None:
+        abort(404)
+
+    return render_template(
+        "request_view.html",
+        req=detail.req,
+        req_id=req_id,
+        approvals=detail.approvals,
+        edit_link=edit_link,
+        from_submit=from_submit,
+        manager_level=manager_level,
+        error=error,
+        manager1_sig=detail.manager1_sig,
+        manager2_sig=detail.manager2_sig
+    )
+
+
+# ============================================
+# الملفات الثابتة (build-assets: أسماء بـ hash + webp/avif + .gz/.br)
+# ============================================
+
+ASSET_DIST_DIR = os.path.join(app.static_folder, "dist")
+ASSET_MANIFEST_PATH = os.path.join(ASSET_DIST_DIR, "manifest.json")
+# الاسم فيه hash المحتوى => أي تغيير = URL جديد، فالكاش سنة كاملة immutable
+ASSET_MAX_AGE = 365 * 24 * 3600
+# بترتيب الأفضلية في <picture> / image-set (الأصغر الأول)
+IMAGE_VARIANTS = (
+    ("avif", "image/avif", {"quality": 50}),
+    ("webp", "image/webp", {"quality": 80, "method": 6}),
+)
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg"}
+# الصور مضغوطة أصلاً، فالـ .gz/.br للملفات النصية بس
+PRECOMPRESS_EXTENSIONS = {".css", ".js", ".svg", ".json", ".txt"}
+PRECOMPRESS_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+CSS_URL_RE = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+CSS_BACKGROUND_RE = re.compile(r"""background-image\s*:\s*url\(\s*(['"]?)([^'")]+)\1\s*\)\s*;""")
+
+
+def hashed_name(path, data, ext=None):
+    """img/header.png -> img/header.<hash>.png (أو بامتداد تاني للـ variants)"""
+    root, orig_ext = os.path.splitext(path)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:10]}{ext or orig_ext}"
+
+
+def write_dist_file(out_dir, name, data):
+    target = os.path.join(out_dir, *name.split("/"))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, "wb") as fh:
+        fh.write(data)
+
+
+def precompress(data):
+    """[(suffix, bytes)] للضغطات اللي فعلاً بتصغّر الملف"""
+    packed = [(".gz", gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        packed.append((".br", brotli.compress(data, quality=11)))
+    return [(suffix, body) for suffix, body in packed if len(body) < len(data)]
+
+
+def image_variants(data):
+    """(width, height, [(fmt, bytes)]) للصيغ اللي Pillow بيدعمها وطلعت أصغر من الأصل"""
+    variants = []
+    with Image.open(io.BytesIO(data)) as im:
+        size = im.size
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA")
+        for fmt, _, options in IMAGE_VARIANTS:
+            buf = io.BytesIO()
+            try:
+                im.save(buf, fmt.upper(), **options)
+            except (KeyError, OSError):     # Pillow متبني من غير الصيغة دي
+                continue
+            if buf.tell() < len(data):
+                variants.append((fmt, buf.getvalue()))
+    return size[0], size[1], variants
+
+
+def rewrite_css_urls(text, css_path, manifest):
+    """
+    url(...) جوه الـ CSS => الأسماء الـ hashed (نسبية لمكان الـ CSS في dist)
+    background-image لصورة ليها variants بياخد image-set بعد الـ url العادي
+    (المتصفح القديم بيتجاهل السطر التاني ويفضل على الـ png)
+    """
+    base = posixpath.dirname(css_path)
+    newline = "\r\n" if "\r\n" in text else "\n"
+
+    def lookup(ref):
+        return manifest.get(posixpath.normpath(posixpath.join(base, ref)))
+
+    def background(m):
+        entry = lookup(m.group(2))
+        if entry is None:
+            return m.group(0)
+        url = posixpath.relpath(entry["file"], base)
+        decl = f"background-image: url('{url}');"
+        if entry.get("variants"):
+            options = [
+                f"url('{posixpath.relpath(entry['variants'][fmt], base)}') type(\"{mime}\")"
+                for fmt, mime, _ in IMAGE_VARIANTS if fmt in entry["variants"]
+            ]
+            options.append(f"url('{url}') type(\"{mimetypes.guess_type(url)[0]}\")")
+            decl += f"{newline}    background-image: image-set({', '.join(options)});"
+        return decl
+
+    def plain(m):
+        entry = lookup(m.group(2))
+        if entry is None:
+            return m.group(0)
+        return f"url('{posixpath.relpath(entry['file'], base)}')"
+
+    return CSS_URL_RE.sub(plain, CSS_BACKGROUND_RE.sub(background, text))
+
+
+def build_assets(static_dir, out_dir):
+    """
+    يبني static/dist من static/ ويرجّع الـ manifest:
+    {"img/x.png": {"file", "bytes", "width", "height", "variants": {fmt: file}, "encoded": {suffix: bytes}}}
+    """
+    shutil.rmtree(out_dir, ignore_errors=True)
+    sources = []
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != out_dir)
+        for fname in sorted(files):
+            sources.append(os.path.relpath(os.path.join(root, fname), static_dir).replace(os.sep, "/"))
+    # الصور قبل الـ CSS عشان الـ url(...) يتحوّل لأسمائها الجديدة
+    sources.sort(key=lambda path: path.lower().endswith(".css"))
+
+    manifest = {}
+    for path in sources:
+        with open(os.path.join(static_dir, path), "rb") as fh:
+            data = fh.read()
+        ext = os.path.splitext(path)[1].lower()
+        if ext == ".css":
+            data = rewrite_css_urls(data.decode("utf-8"), path, manifest).encode("utf-8")
+
+        entry = {"file": hashed_name(path, data), "bytes": len(data)}
+        write_dist_file(out_dir, entry["file"], data)
+
+        if ext in IMAGE_EXTENSIONS and Image is not None:
+            entry["width"], entry["height"], variants = image_variants(data)
+            entry["variants"] = {}
+            for fmt, body in variants:
+                name = hashed_name(path, body, "." + fmt)
+                write_dist_file(out_dir, name, body)
+                entry["variants"][fmt] = name
+                entry[f"{fmt}_bytes"] = len(body)
+
+        if ext in PRECOMPRESS_EXTENSIONS:
+            entry["encoded"] = {}
+            for suffix, body in precompress(data):
+                write_dist_file(out_dir, entry["file"] + suffix, body)
+                entry["encoded"][suffix] = len(body)
+
+        manifest[path] = entry
+
+    # الـ manifest آخر حاجة => مفيش process يقرا manifest بيشاور على ملفات لسه ما اتكتبتش
+    manifest_path = os.path.join(out_dir, "manifest.json")
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return manifest
+
+
+_asset_manifest = None
+
+
+def load_asset_manifest():
+    """الـ manifest بيتقرا مرة لكل process (بيتغير بس مع deploy جديد)؛ {} لو build-assets ما اشتغلش"""
+    global _asset_manifest
+    if _asset_manifest is None:
+        try:
+            with open(ASSET_MANIFEST_PATH, encoding="utf-8") as fh:
+                _asset_manifest = json.load(fh)
+        except (OSError, ValueError):
+            _asset_manifest = {}
+    return _asset_manifest
+
+
+@app.template_global()
+def asset_url(path):
+    """{{ asset_url('css/approval.css') }} => /static/dist/css/approval.<hash>.css (أو /static/... من غير build)"""
+    entry = load_asset_manifest().get(path)
+    if entry is None:
+        return url_for("static", filename=path)
+    return url_for("static_dist", filename=entry["file"])
+
+
+@app.template_global()
+def picture(path, alt="", **attrs):
+    """
+    {{ picture('img/header_amwaj.png', class='header-img') }}
+    => <picture> بـ avif/webp + <img> بالـ width/height (مفيش layout shift لما الصورة توصل)
+    """
+    entry = load_asset_manifest().get(path, {})
+    img = {"src": asset_url(path), "alt": alt}
+    if "width" in entry:
+        img["width"], img["height"] = entry["width"], entry["height"]
+    img["decoding"] = "async"
+    img.update((key.rstrip("_"), value) for key, value in attrs.items())
+
+    sources = [
+        f'<source type="{mime}" srcset="{escape(url_for("static_dist", filename=entry["variants"][fmt]))}">'
+        for fmt, mime, _ in IMAGE_VARIANTS if fmt in entry.get("variants", {})
+    ]
+    img_tag = "<img " + " ".join(f'{key}="{escape(value)}"' for key, value in img.items()) + ">"
+    if not sources:
+        return Markup(img_tag)
+    return Markup("<picture>" + "".join(sources) + img_tag + "</picture>")
+
+
+# ============================================
+# قياسات الأداء (/metrics بصيغة Prometheus)
+# ============================================
+
+# حدود الـ histogram بالثواني (le)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics:
+    """
+    counters + histogram زمن الطلب لكل endpoint (لكل process زي page_cache:
+    مع أكتر من worker كل scrape بيقرا الـ worker اللي رد عليه)
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._requests = {}     # (endpoint, method, status) -> count
+        self._latency = {}      # endpoint -> [count لكل bucket ..., +Inf, sum]
+        self._queries = {}      # endpoint -> [queries, seconds]
+        self._slow = {}         # endpoint -> slow queries
+
+    def observe_request(self, endpoint, method, status, seconds, queries, query_seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            key = (endpoint, method, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            hist = self._latency.get(endpoint)
+            if hist is None:
+                hist = self._latency[endpoint] = [0] * (len(self.buckets) + 1) + [0.0]
+            hist[i] += 1
+            hist[-1] += seconds
+            totals = self._queries.get(endpoint)
+            if totals is None:
+                totals = self._queries[endpoint] = [0, 0.0]
+            totals[0] += queries
+            totals[1] += query_seconds
+
+    def observe_slow_query(self, endpoint):
+        with self._lock:
+            self._slow[endpoint] = self._slow.get(endpoint, 0) + 1
+
+    def render(self):
+        with self._lock:
+            requests_total = sorted(self._requests.items())
+            latency = sorted((endpoint, list(hist)) for endpoint, hist in self._latency.items())
+            queries = sorted((endpoint, list(totals)) for endpoint, totals in self._queries.items())
+            slow = sorted(self._slow.items())
+
+        lines = [
+            "# HELP approval_http_requests_total HTTP requests by endpoint, method and status.",
+            "# TYPE approval_http_requests_total counter",
+        ]
+        for (endpoint, method, status), count in requests_total:
+            lines.append(
+                f'approval_http_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}'
+            )
+
+        lines += [
+            "# HELP approval_http_request_duration_seconds Time until the response is returned "
+            "(headers only for streamed responses).",
+            "# TYPE approval_http_request_duration_seconds histogram",
+        ]
+        for endpoint, hist in latency:
+            cumulative = 0
+            for le, count in zip(self.buckets + ("+Inf",), hist):
+                cumulative += count
+                lines.append(
+                    f'approval_http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{le}"}} {cumulative}'
+                )
+            lines.append(f'approval_http_request_duration_seconds_sum{{endpoint="{endpoint}"}} {hist[-1]:.6f}')
+            lines.append(f'approval_http_request_duration_seconds_count{{endpoint="{endpoint}"}} {cumulative}')
+
+        lines += [
+            "# HELP approval_db_queries_total SQL statements executed while serving requests.",
+            "# TYPE approval_db_queries_total counter",
+        ]
+        lines += [f'approval_db_queries_total{{endpoint="{endpoint}"}} {n}' for endpoint, (n, _) in queries]
+        lines += [
+            "# HELP approval_db_query_duration_seconds_total Time spent in execute() while serving requests.",
+            "# TYPE approval_db_query_duration_seconds_total counter",
+        ]
+        lines += [
+            f'approval_db_query_duration_seconds_total{{endpoint="{endpoint}"}} {seconds:.6f}'
+            for endpoint, (_, seconds) in queries
+        ]
+        lines += [
+            "# HELP approval_db_slow_queries_total Statements slower than SLOW_QUERY_MS.",
+            "# TYPE approval_db_slow_queries_total counter",
+        ]
+        lines += [f'approval_db_slow_queries_total{{endpoint="{endpoint}"}} {n}' for endpoint, n in slow]
+
+        cache = page_cache.stats()
+        for name, kind, value in (
+            ("hits_total", "counter", cache["hits"]),
+            ("misses_total", "counter", cache["misses"]),
+            ("evictions_total", "counter", cache["evictions"]),
+            ("entries", "gauge", cache["entries"]),
+            ("bytes", "gauge", cache["bytes"]),
+        ):
+            lines.append(f"# TYPE approval_page_cache_{name} {kind}")
+            lines.append(f"approval_page_cache_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(LATENCY_BUCKETS)
+
+
+def record_query(sql, seconds):
+    """بيتنده من InstrumentedCursor بعد كل execute (أي thread، جوه طلب أو لأ)"""
+    state = _local
+    state.queries += 1
+    state.query_seconds += seconds
+    if seconds * 1000 >= app.config["SLOW_QUERY_MS"]:
+        metrics.observe_slow_query(state.endpoint)
+        app.logger.warning(
+            "slow query %.1f ms [%s]: %s", seconds * 1000, state.endpoint, " ".join(sql.split())
+        )
+
+
+# متسجّلين قبل compress_response => Flask بيشغّل after_request بالعكس فده بيتحسب بعد الضغط
+# الـ streamed responses (التصدير / SSE) بيتحسبوا لحد الـ headers بس، واستعلامات الـ body مش جوه العدّاد
+@app.before_request
+def start_request_metrics():
+    state = _local
+    state.request_started = time.perf_counter()
+    state.endpoint = request.endpoint or "unmatched"     # 404 => label واحد مش URL لكل طلب
+    state.queries = 0
+    state.query_seconds = 0.0
+
+
+@app.after_request
+def record_request_metrics(response):
+    state = _local
+    if state.request_started is not None:
+        metrics.observe_request(
+            state.endpoint, request.method, response.status_code,
+            time.perf_counter() - state.request_started, state.queries, state.query_seconds,
+        )
+        state.request_started = None
+    return response
+
+
+def metrics_authorized():
+    token = app.config["METRICS_TOKEN"]
+    if token:
+        scheme, _, value = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and secrets.compare_digest(
+                value.strip().encode("utf-8"), token.encode("utf-8")):
+            return True
+    return is_staff_logged()
+
+
+# ============================================
+# ضغط الـ responses (br / gzip)
+# ============================================
+
+# text/event-stream مش هنا: الضغط بيحبس الأحداث جوه buffer
+COMPRESS_MIMETYPES = {
+    "text/html", "text/css", "text/plain", "text/csv", "text/javascript",
+    "application/javascript", "application/json", "application/x-ndjson", "image/svg+xml",
+}
+
+
+def pick_encoding():
+    """br لو المتصفح بيقبله و brotli متسطب، بعده gzip، وإلا None"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+
+def make_compressor(encoding):
+    """(compress(chunk), flush(), finish()) بنفس الشكل لـ br و gzip"""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=app.config["COMPRESS_BR_QUALITY"])
+        return compressor.process, compressor.flush, compressor.finish
+    compressor = zlib.compressobj(app.config["COMPRESS_GZIP_LEVEL"], zlib.DEFLATED, 31)  # 31 => gzip header
+    return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+def compress_stream(chunks, encoding):
+    """
+    ضغط دفعة دفعة للـ streamed responses (التصدير): flush بعد كل chunk
+    عشان كل دفعة توصل على طول ومفيش حاجة بتتجمّع في الذاكرة
+    """
+    compress, flush, finish = make_compressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            out = compress(chunk) + flush()
+            if out:
+                yield out
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+@app.after_request
+def compress_response(response):
+    """br/gzip حسب Accept-Encoding لأي response نصي أكبر من COMPRESS_MIN_SIZE"""
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough              # send_file (static/dist عنده .br/.gz جاهزين)
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES
+            or response.cache_control.no_transform):
+        return response
+    if not response.is_streamed and len(response.get_data()) < app.config["COMPRESS_MIN_SIZE"]:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = pick_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        compress, _, finish = make_compressor(encoding)
+        response.set_data(compress(response.get_data()) + finish())
+    response.headers["Content-Encoding"] = encoding
+
+    # نفس الـ ETag للنسختين (مضغوطة وعادية) لازم يبقى weak
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+# ============================================
+# أحداث الداشبورد اللحظية (SSE)
+# ============================================
 
-    for flag, field_list in types_required.items():
-        if data.get(flag):
-            for f in field_list:
-                if not data.get(f, "").strip():
-                    errors.append(f"Field '{f}' is required because this request type is selected.")
+REQUEST_EVENTS_SQL = (
+    f"SELECT seq, kind, {REQUEST_EVENT_COLUMNS} FROM request_events "
+    "WHERE seq > ? ORDER BY seq LIMIT ?"
+)
+# أكتر من كده في رسالة واحدة => المتصفح يعمل reload أحسن من إنه يرقّع الصفحة
+REQUEST_EVENTS_BATCH = 500
+SSE_QUEUE_SIZE = 100
+# 503 (SSE_MAX_STREAMS) => الداشبورد بيحاول يتصل تاني بعد كده (ثواني)
+SSE_RETRY_AFTER = 30
+
+
+def load_last_event_seq(db):
+    return db.execute("SELECT COALESCE(MAX(seq), 0) FROM request_events").fetchone()[0]
+
+
+def sse_message(event, data, event_id=None):
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines.append(f"event: {event}")
+    lines.append("data: " + json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+    return "\n".join(lines) + "\n\n"
+
+
+def changes_message(rows, counts):
+    """رسالة changes واحدة: الأحداث (صف الداشبورد بعد التغيير) + العدادات الحالية كاملة"""
+    events = [
+        {
+            "seq": r["seq"], "kind": r["kind"], "id": r["request_id"],
+            "status": r["status"], "old_status": r["old_status"],
+            "project_name": r["project_name"], "unit_number": r["unit_number"],
+            "buyer_name": r["buyer_name"], "created_at": r["created_at"],
+        }
+        for r in rows
+    ]
+    return sse_message("changes", {"events": events, "counts": counts}, event_id=rows[-1]["seq"])
 
-    return errors
 
+class Subscriber:
+    __slots__ = ("queue", "closed")
 
-def build_data_from_form(form, *, for_update=False, prev_row=None):
-    """يقرأ بيانات الفورم ويجهز dict لجدول requests"""
-    now = datetime.utcnow().isoformat()
-    cb_names = [
-        "price_reduction_selected",
-        "bulk_discount_selected",
-        "change_payment_plan_selected",
-        "unit_switch_selected",
-        "unit_cancellation_selected",
-        "refund_selected",
-        "late_payment_selected",
-        "waiver_late_fee_selected",
-        "issuance_spa_selected",
-        "registration_dld_selected",
-        "others_selected",
-    ]
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+        self.closed = False
 
-    def cb(name):
-        return 1 if form.get(name) == "on" else 0
-
-    base = {
-        "project_name": form.get("project_name", "").strip(),
-        "unit_number": form.get("unit_number", "").strip(),
-        "paid_amount": form.get("paid_amount", "").strip(),
-        "buyer_name": form.get("buyer_name", "").strip(),
-        "agent_name": form.get("agent_name", "").strip(),
-        "agency_name": form.get("agency_name", "").strip(),
-        "agent_contact": form.get("agent_contact", "").strip(),
-
-        "price_reduction_selected": cb("price_reduction_selected"),
-        "bulk_discount_selected": cb("bulk_discount_selected"),
-        "change_payment_plan_selected": cb("change_payment_plan_selected"),
-        "unit_switch_selected": cb("unit_switch_selected"),
-        "unit_cancellation_selected": cb("unit_cancellation_selected"),
-        "refund_selected": cb("refund_selected"),
-        "late_payment_selected": cb("late_payment_selected"),
-        "waiver_late_fee_selected": cb("waiver_late_fee_selected"),
-        "issuance_spa_selected": cb("issuance_spa_selected"),
-        "registration_dld_selected": cb("registration_dld_selected"),
-        "others_selected": cb("others_selected"),
-
-        "pr_listed_price": form.get("pr_listed_price", ""),
-        "pr_discount_amount": form.get("pr_discount_amount", ""),
-        "pr_selling_price": form.get("pr_selling_price", ""),
-        "pr_discount_percent": form.get("pr_discount_percent", ""),
-
-        "bd_listed_price": form.get("bd_listed_price", ""),
-        "bd_discount_amount": form.get("bd_discount_amount", ""),
-        "bd_selling_price": form.get("bd_selling_price", ""),
-        "bd_discount_percent": form.get("bd_discount_percent", ""),
-        "bd_units": form.get("bd_units", ""),
-
-        "cpp_down_payment_percent": form.get("cpp_down_payment_percent", ""),
-        "cpp_down_payment_date": form.get("cpp_down_payment_date", ""),
-        "cpp_2nd_payment_percent": form.get("cpp_2nd_payment_percent", ""),
-        "cpp_2nd_payment_date": form.get("cpp_2nd_payment_date", ""),
-        "cpp_3rd_payment_percent": form.get("cpp_3rd_payment_percent", ""),
-        "cpp_3rd_payment_date": form.get("cpp_3rd_payment_date", ""),
-        "cpp_4th_payment_percent": form.get("cpp_4th_payment_percent", ""),
-        "cpp_4th_payment_date": form.get("cpp_4th_payment_date", ""),
-        "cpp_5th_payment_percent": form.get("cpp_5th_payment_percent", ""),
-        "cpp_5th_payment_date": form.get("cpp_5th_payment_date", ""),
-        "cpp_6th_payment_percent": form.get("cpp_6th_payment_percent", ""),
-        "cpp_6th_payment_date": form.get("cpp_6th_payment_date", ""),
-        "cpp_completion_percent": form.get("cpp_completion_percent", ""),
-        "cpp_completion_date": form.get("cpp_completion_date", ""),
-
-        "us_booked_unit": form.get("us_booked_unit", ""),
-        "us_new_unit": form.get("us_new_unit", ""),
-        "us_new_unit_selling_price": form.get("us_new_unit_selling_price", ""),
-
-        "uc_amount_paid": form.get("uc_amount_paid", ""),
-
-        "rf_booking_fees_amount": form.get("rf_booking_fees_amount", ""),
-        "rf_payment_amount": form.get("rf_payment_amount", ""),
-        "rf_refund_amount": form.get("rf_refund_amount", ""),
-
-        "lp_payment_schedule_no": form.get("lp_payment_schedule_no", ""),
-        "lp_initial_due_date": form.get("lp_initial_due_date", ""),
-        "lp_new_payment_date": form.get("lp_new_payment_date", ""),
-        "lp_penalty_amount": form.get("lp_penalty_amount", ""),
-        "lp_overdue_period": form.get("lp_overdue_period", ""),
-
-        "wl_downpayment_spa_date": form.get("wl_downpayment_spa_date", ""),
-        "wl_2nd_payment_spa_date": form.get("wl_2nd_payment_spa_date", ""),
-        "wl_3rd_payment_spa_date": form.get("wl_3rd_payment_spa_date", ""),
-        "wl_4th_payment_spa_date": form.get("wl_4th_payment_spa_date", ""),
-        "wl_5th_payment_spa_date": form.get("wl_5th_payment_spa_date", ""),
-        "wl_6th_payment_spa_date": form.get("wl_6th_payment_spa_date", ""),
-
-        "wl_penalty_amount": form.get("wl_penalty_amount", ""),
-        "wl_waiver_amount": form.get("wl_waiver_amount", ""),
-
-        "spa_down_payment_received": form.get("spa_down_payment_received", ""),
-        "spa_percent": form.get("spa_percent", ""),
-
-        "dld_down_payment_received": form.get("dld_down_payment_received", ""),
-        "dld_percent": form.get("dld_percent", ""),
-
-        "others_text": form.get("others_text", ""),
-
-        "doc_kyc": form.get("doc_kyc", ""),
-        "doc_reservation_agreement": form.get("doc_reservation_agreement", ""),
-        "doc_spa": form.get("doc_spa", ""),
-        "doc_others": form.get("doc_others", ""),
-        "comments": form.get("comments", ""),
-
-        "requested_by_signature": form.get("requested_by_signature", ""),
-        "requested_by_date": form.get("requested_by_date", ""),
-    }
 
-    if not for_update:
-        base["created_at"] = now
-        base["status"] = "Pending L1"
-        base["current_step"] = 1
-        base["edit_token"] = secrets.token_urlsafe(24)
+class ChangeFeed:
+    """
+    thread واحد لكل process بيقرا request_events (lookup على الـ primary key) كل interval
+    ويوزّع نفس الرسالة على كل المتصفحات المفتوحة => استعلام واحد مهما كان عدد المديرين
+    الـ thread بيقوم مع أول مشترك وبيقفل لما آخر واحد يخرج
+    """
 
-    base["updated_at"] = now
-    return base
+    def __init__(self, interval):
+        self.interval = interval
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, limit=None):
+        """مشترك جديد، أو None لو فيه limit مشترك بالفعل (SSE_MAX_STREAMS)"""
+        sub = Subscriber()
+        with self._lock:
+            if limit is not None and len(self._subscribers) >= limit:
+                return None
+            self._subscribers.add(sub)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="change-feed", daemon=True)
+                self._thread.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def _publish(self, subscribers, message):
+        for sub in subscribers:
+            try:
+                sub.queue.put_nowait(message)
+            except queue.Full:
+                # متصفح مش بيقرا => نقفله، ولما يرجع بيكمّل من Last-Event-ID
+                sub.closed = True
+                self.unsubscribe(sub)
+
+    def _run(self):
+        db = open_db(readonly=True)
+        try:
+            last_seq = load_last_event_seq(db)
+            while True:
+                with self._lock:
+                    if not self._subscribers:
+                        self._thread = None
+                        return
+                    subscribers = list(self._subscribers)
+
+                rows = db.execute(REQUEST_EVENTS_SQL, (last_seq, REQUEST_EVENTS_BATCH)).fetchall()
+                if rows:
+                    last_seq = rows[-1]["seq"]
+                    self._publish(subscribers, changes_message(rows, load_status_counts(db)))
+                time.sleep(self.interval)
+        except Exception:
+            app.logger.exception("change feed stopped")
+            with self._lock:
+                self._thread = None
+                for sub in self._subscribers:
+                    sub.closed = True
+                self._subscribers.clear()
+        finally:
+            db.close()
+
+
+change_feed = ChangeFeed(app.config["SSE_POLL_INTERVAL"])
+
+
+def iter_change_events(sub, backlog):
+    """
+    generator الـ SSE لمتصفح واحد: اللي فاته (backlog) وبعدين اللي الـ feed بيبعته
+    لحد SSE_STREAM_SECONDS وبعدها بيخلص (المتصفح بيعيد الاتصال من Last-Event-ID)
+    """
+    keepalive = app.config["SSE_KEEPALIVE_SECONDS"]
+    deadline = time.monotonic() + app.config["SSE_STREAM_SECONDS"]
+    try:
+        # المتصفح بيستنى كده قبل ما يعيد الاتصال
+        yield "retry: 3000\n\n"
+        for message in backlog:
+            yield message
+        while not sub.closed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                yield sub.queue.get(timeout=min(keepalive, remaining))
+            except queue.Empty:
+                yield ": keepalive\n\n"
+    finally:
+        change_feed.unsubscribe(sub)
 
 
 # ============================================
@@ -454,6 +3017,35 @@ def index():
     return redirect(url_for("new_request"))
 
 
+# ---------- ملفات build-assets (hashed) ----------
+@app.route("/static/dist/<path:filename>")
+def static_dist(filename):
+    """كاش سنة immutable + النسخة .br/.gz الجاهزة لو المتصفح بيقبلها"""
+    path = safe_join(ASSET_DIST_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    encoding, suffix = None, ""
+    for name, ext in PRECOMPRESS_ENCODINGS:
+        if request.accept_encodings[name] and os.path.isfile(path + ext):
+            encoding, suffix = name, ext
+            break
+
+    response = send_file(
+        path + suffix,
+        mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+        max_age=ASSET_MAX_AGE,
+        conditional=True,
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if os.path.splitext(filename)[1].lower() in PRECOMPRESS_EXTENSIONS:
+        response.vary.add("Accept-Encoding")
+    return response
+
+
 # ---------- إنشاء طلب جديد ----------
 @app.route("/request/new", methods=["GET", "POST"])
 def new_request():
@@ -468,25 +3060,21 @@ def new_request():
         if errors:
             existing = SimpleNamespace(**data)
         else:
-            columns = ", ".join(data.keys())
-            placeholders = ", ".join(["?"] * len(data))
-            cur = db.cursor()
-            cur.execute(
-                f"INSERT INTO requests ({columns}) VALUES ({placeholders})",
-                list(data.values())
-            )
-            db.commit()
+            with write_transaction(db):
+                cur = db.execute(REQUEST_INSERT_SQL, pack_request_data(data))
             req_id = cur.lastrowid
 
             # Redirect لمنع إعادة الإرسال عند الـ Refresh
             return redirect(url_for("view_request", req_id=req_id, submitted=1))
 
+    if request.method == "GET":
+        # الفورم الفاضي ثابت => بيترندر مرة واحدة لكل process
+        return cached_page(("form", "new"), lambda: render_template("request_form.html", errors=[]))
+
     return render_template(
         "request_form.html",
         existing=existing,
-        errors=errors,
-        project_choices=PROJECT_CHOICES,
-        unit_choices=UNIT_CHOICES
+        errors=errors
     )
 
 
@@ -497,8 +3085,15 @@ def edit_request(token):
     cur = db.cursor()
     cur.execute("SELECT * FROM requests WHERE edit_token = ?", (token,))
     row = cur.fetchone()
+    archived = row is None
+    if archived:
+        # اتأرشف => الفورم من الأرشيف، والحفظ بيرجّعه main
+        row = get_read_db().execute(
+            "SELECT * FROM archive.requests WHERE edit_token = ?", (token,)
+        ).fetchone()
     if not row:
         abort(404)
+    row = request_record(row)
 
     errors = []
     existing = row
@@ -508,12 +3103,11 @@ def edit_request(token):
         errors = validate_required(data)
 
         if not errors:
-            set_clause = ", ".join([f"{k}=?" for k in data.keys()])
-            cur.execute(
-                f"UPDATE requests SET {set_clause} WHERE id = ?",
-                list(data.values()) + [row["id"]]
-            )
-            db.commit()
+            packed = pack_request_data(data)
+            packed["id"] = row["id"]
+            with request_write_transaction(db, row["id"], archived) as conn:
+                conn.execute(REQUEST_UPDATE_SQL, packed)
+            page_cache.invalidate(row["id"])
             return redirect(url_for("view_request", req_id=row["id"]))
 
         existing = SimpleNamespace(**data)
@@ -522,51 +3116,38 @@ def edit_request(token):
         "request_form.html",
         existing=existing,
         edit_token=token,
-        errors=errors,
-        project_choices=PROJECT_CHOICES,
-        unit_choices=UNIT_CHOICES
+        errors=errors
     )
 
 
 # ---------- عرض طلب (قراءة فقط) ----------
 @app.route("/request/<int:req_id>")
 def view_request(req_id):
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("SELECT * FROM requests WHERE id = ?", (req_id,))
-    row = cur.fetchone()
-    if not row:
-        abort(404)
-
-    cur.execute("SELECT * FROM approvals WHERE request_id = ? ORDER BY level, decided_at", (req_id,))
-    approvals = cur.fetchall()
-
-    submitted = request.args.get("submitted") == "1"
-    edit_link = None
-    if submitted:
-        edit_link = url_for("edit_request", token=row["edit_token"], _external=True)
-
-    # signatures for managers (من جدول approvals)
-    manager1_sig = None
-    manager2_sig = None
-    for a in approvals:
-        if a["level"] == 1:
-            manager1_sig = a
-        elif a["level"] == 2:
-            manager2_sig = a
-
-    return render_template(
-        "request_view.html",
-        req=row,
-        req_id=req_id,
-        approvals=approvals,
-        edit_link=edit_link,
-        from_submit=submitted,
-        manager_level=None,
-        error=None,
-        manager1_sig=manager1_sig,
-        manager2_sig=manager2_sig
-    )
+    # الـ version (مفتاح الكاش / ETag) والتفاصيل من نفس الـ snapshot
+    with read_snapshot() as db:
+        schema, version = locate_request(db, req_id)
+        if not version:
+            abort(404)
+
+        if request.args.get("submitted") == "1":
+            # فيه لينك التعديل (token) => ما بيتخزنش في الكاش
+            row = db.execute(f"SELECT edit_token FROM {schema}.requests WHERE id = ?", (req_id,)).fetchone()
+            edit_link = url_for("edit_request", token=row["edit_token"], _external=True)
+            return render_request_view(db, req_id, edit_link=edit_link, from_submit=True, schema=schema)
+
+        etag, last_modified = page_validators("view", req_id, *version, last_modified=version["updated_at"])
+        resp = not_modified(etag, last_modified)
+        if resp:
+            return resp
+
+        # updated_at بيتغير مع أي تعديل أو قرار => الـ workers التانية ما بتشوفش نسخة قديمة
+        # (الأرشفة بتنقل الصف زي ما هو => نفس المفتاح ونفس الصفحة)
+        html = cached_page(
+            ("view", req_id, version["updated_at"], None),
+            lambda: render_request_view(db, req_id, schema=schema),
+            tag=req_id,
+        )
+    return with_validators(html, etag, last_modified)
 
 
 # ---------- لوجين المدير ----------
@@ -621,94 +3202,129 @@ def manager_dashboard(level):
         )
 
        # --------- LOGGED IN ---------
-    flt = request.args.get("filter", "all")
-    sort = request.args.get("sort", "latest")
-
-    # فلاتر جديدة لاختيار Project و Unit
-    flt_project = request.args.get("project", "")
-    flt_unit = request.args.get("unit", "")
-
-    conn = sqlite3.connect("approval_requests.db")
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
-    # ---------- إحصائيات ----------
-    def scalar(q, params=()):
-        cur.execute(q, params)
-        return cur.fetchone()[0]
-
-    total       = scalar("SELECT COUNT(*) FROM requests")
-    pending_l1  = scalar("SELECT COUNT(*) FROM requests WHERE status='Pending L1'")
-    pending_l2  = scalar("SELECT COUNT(*) FROM requests WHERE status='Pending L2'")
-    approved    = scalar("SELECT COUNT(*) FROM requests WHERE status='Approved'")
-    rejected    = scalar("SELECT COUNT(*) FROM requests WHERE status='Rejected'")
-
-    # ----------- بناء SQL ديناميكي -------------
-    where = []
-    params = []
-
-    # فلتر حالة الطلب
-    if flt == "pending_l1":
-        where.append("status='Pending L1'")
-    elif flt == "pending_l2":
-        where.append("status='Pending L2'")
-    elif flt == "approved":
-        where.append("status='Approved'")
-    elif flt == "rejected":
-        where.append("status='Rejected'")
+    # كل القراية من snapshot واحد على connection القراية (mode=ro) => ما بتزاحمش القرارات
+    with read_snapshot() as conn:
+        # أي كتابة بتزوّد العدّاد => نفس العدّاد + نفس الـ URL = نفس الصفحة (304 من غير استعلامات)
+        version, changed_at = load_change_counter(conn)
+        etag, last_modified = page_validators(
+            "manager_dashboard", level, version, request.query_string, last_modified=changed_at
+        )
+        resp = not_modified(etag, last_modified)
+        if resp:
+            return resp
 
-    # فلتر Project
-    if flt_project:
-        where.append("project_name = ?")
-        params.append(flt_project)
+        flt = request.args.get("filter", "all")
+        sort = request.args.get("sort", "latest")
 
-    # فلتر Unit
-    if flt_unit:
-        where.append("unit_number = ?")
-        params.append(flt_unit)
+        # فلاتر جديدة لاختيار Project و Unit
+        flt_project = request.args.get("project", "")
+        flt_unit = request.args.get("unit", "")
 
-    # بناء جملة SELECT
-    sql = "SELECT * FROM requests"
-    if where:
-        sql += " WHERE " + " AND ".join(where)
+        # بحث نصي (buyer / agent / agency / comments) - النتائج بالأقرب إلا لو اختار فرز تاني
+        q = request.args.get("q", "").strip()
+        search = fts_query(q)
+        if search and "sort" not in request.args:
+            sort = "relevance"
 
-    # ---------- فرز ----------
-    if sort == "project":
-        sql += " ORDER BY project_name ASC"
-    elif sort == "unit":
-        sql += " ORDER BY unit_number ASC"
-    else:  # latest
-        sql += " ORDER BY id DESC"
+        # الطلبات المؤرشفة (قديمة وخلصت) مش ظاهرة إلا لو اختار "Include archived"
+        archived = include_archived()
 
-    cur.execute(sql, params)
-    all_requests = cur.fetchall()
+        # ---------- إحصائيات (من request_stats بدل COUNT على الجدول كله) ----------
+        stats = load_status_counts(conn, archived=archived)
 
-    # استخراج قائمة project / unit موجودة فعلياً في قاعدة البيانات
-    cur.execute("SELECT DISTINCT project_name FROM requests ORDER BY project_name")
-    project_list = [r[0] for r in cur.fetchall()]
+        # ----------- صفحة واحدة بس (keyset على (sort_key, id)) -------------
+        page_size = listing_page_size()
+        all_requests, next_cursor, prev_cursor = fetch_listing_page(
+            conn, flt, flt_project, flt_unit, sort, page_size, search=search, archived=archived
+        )
+        next_url, prev_url = page_urls(
+            "manager_dashboard", next_cursor, prev_cursor,
+            level=level, filter=flt, project=flt_project, unit=flt_unit, sort=sort, q=q,
+            per_page=request.args.get("per_page"), archived=int(archived)
+        )
+        archived_url = archived_toggle_url(
+            "manager_dashboard", archived,
+            level=level, filter=flt, project=flt_project, unit=flt_unit, sort=sort, q=q,
+            per_page=request.args.get("per_page")
+        )
 
-    cur.execute("SELECT DISTINCT unit_number FROM requests ORDER BY unit_number")
-    unit_list = [r[0] for r in cur.fetchall()]
+        # استخراج قائمة project / unit موجودة فعلياً في قاعدة البيانات
+        project_list, unit_list = load_filter_choices(conn, archived)
 
-    conn.close()
+        events_since = load_last_event_seq(conn)
 
-    return render_template(
+    html = render_template(
         "manager_dashboard.html",
         login_only=False,
         level=level,
-        total=total,
-        pending_l1=pending_l1,
-        pending_l2=pending_l2,
-        approved=approved,
-        rejected=rejected,
+        total=stats["total"],
+        pending_l1=stats["pending_l1"],
+        pending_l2=stats["pending_l2"],
+        approved=stats["approved"],
+        rejected=stats["rejected"],
         all_requests=all_requests,
         active_filter=flt,
         active_sort=sort,
         projects=project_list,
         units=unit_list,
         active_project=flt_project,
-        active_unit=flt_unit
+        active_unit=flt_unit,
+        active_q=q,
+        next_url=next_url,
+        prev_url=prev_url,
+        include_archived=archived,
+        archived_url=archived_url,
+        filter_status=STATUS_FILTERS.get(flt, ""),
+        events_since=events_since,
+    )
+    return with_validators(html, etag, last_modified)
+
+
+# ---------- تحديثات الداشبورد اللحظية (SSE) ----------
+@app.route("/manager/<int:level>/events")
+def manager_events(level):
+    """
+    text/event-stream: رسالة changes لكل دفعة تغييرات (id = آخر seq)
+    أول اتصال بيبدأ من ?since= (آخر seq وقت رندر الصفحة)، والـ reconnect من Last-Event-ID
+    """
+    if level not in (1, 2):
+        abort(404)
+    if not is_manager_logged(level):
+        abort(403)
+
+    since = request.headers.get("Last-Event-ID", type=int)
+    if since is None:
+        since = request.args.get("since", type=int)
+
+    # الاشتراك قبل قراية اللي فات => مفيش حدث بيضيع بينهم (المتكرر المتصفح بيتجاهله بالـ seq)
+    sub = change_feed.subscribe(limit=app.config["SSE_MAX_STREAMS"])
+    if sub is None:
+        # الـ worker مليان streams => باقي الـ threads للصفحات، والمتصفح بيحاول تاني بعد Retry-After
+        return Response("Too many live connections", 503, {"Retry-After": str(SSE_RETRY_AFTER)})
+    backlog = []
+    try:
+        if since is not None:
+            with read_snapshot() as db:
+                rows = db.execute(REQUEST_EVENTS_SQL, (since, REQUEST_EVENTS_BATCH + 1)).fetchall()
+                oldest = db.execute("SELECT MIN(seq) FROM request_events").fetchone()[0]
+                if len(rows) > REQUEST_EVENTS_BATCH or (oldest is not None and oldest > since + 1):
+                    # فاته أكتر من اللي محفوظ => الصفحة تتحمل من جديد
+                    backlog.append(sse_message("reset", {}))
+                elif rows:
+                    backlog.append(changes_message(rows, load_status_counts(db)))
+    except BaseException:
+        # القاعدة locked / busy => المكان يرجع للـ streams التانية بدل ما يفضل محجوز لحد ما الـ queue يتملى
+        change_feed.unsubscribe(sub)
+        raise
+
+    resp = Response(
+        iter_change_events(sub, backlog),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
+    # الـ generator اللي ما بدأش (العميل قفل قبل أول byte) الـ finally بتاعه ما بيتنفذش
+    resp.call_on_close(lambda: change_feed.unsubscribe(sub))
+    return resp
 
 
 # -------- Viewer Dashboard ----------
@@ -717,33 +3333,116 @@ def viewer_dashboard():
     if not session.get("viewer"):
         return redirect(url_for("viewer_login"))
 
-    conn = sqlite3.connect("approval_requests.db")
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
-    # نفس إحصائيات المدير
-    stats = {
-        "total": cur.execute("SELECT COUNT(*) FROM requests").fetchone()[0],
-        "pending_l1": cur.execute("SELECT COUNT(*) FROM requests WHERE status='Pending L1'").fetchone()[0],
-        "pending_l2": cur.execute("SELECT COUNT(*) FROM requests WHERE status='Pending L2'").fetchone()[0],
-        "approved": cur.execute("SELECT COUNT(*) FROM requests WHERE status='Approved'").fetchone()[0],
-        "rejected": cur.execute("SELECT COUNT(*) FROM requests WHERE status='Rejected'").fetchone()[0],
-    }
+    with read_snapshot() as conn:
+        version, changed_at = load_change_counter(conn)
+        etag, last_modified = page_validators(
+            "viewer_dashboard", version, request.query_string, last_modified=changed_at
+        )
+        resp = not_modified(etag, last_modified)
+        if resp:
+            return resp
 
-    # يجلب الكل مثل admin
-    cur.execute("SELECT * FROM requests ORDER BY id DESC")
-    all_requests = cur.fetchall()
-    conn.close()
+        # نفس إحصائيات المدير
+        archived = include_archived()
+        stats = load_status_counts(conn, archived=archived)
 
-    return render_template(
+        # نفس ترتيب admin (الأحدث أولاً) صفحة صفحة
+        all_requests, next_cursor, prev_cursor = fetch_listing_page(
+            conn, "all", "", "", "latest", listing_page_size(), archived=archived
+        )
+
+        next_url, prev_url = page_urls(
+            "viewer_dashboard", next_cursor, prev_cursor,
+            per_page=request.args.get("per_page"), archived=int(archived)
+        )
+        archived_url = archived_toggle_url(
+            "viewer_dashboard", archived, per_page=request.args.get("per_page")
+        )
+
+    html = render_template(
         "viewer_dashboard.html",
         login_only=False,
         stats=stats,
-        all_requests=all_requests
+        all_requests=all_requests,
+        next_url=next_url,
+        prev_url=prev_url,
+        include_archived=archived,
+        archived_url=archived_url
     )
+    return with_validators(html, etag, last_modified)
 
 
 
+# -------- Export (CSV / JSONL) ----------
+@app.route("/export/requests")
+def export_requests():
+    if not is_staff_logged():
+        abort(403)
+
+    fmt = request.args.get("format", "csv")
+    if fmt not in EXPORT_FORMATS:
+        abort(400)
+    compress = request.args.get("gzip") == "1"
+
+    # SELECT واحد => snapshot واحد لحد آخر صف، على connection القراية
+    body = iter_export(
+        get_read_db(), fmt,
+        flt=request.args.get("filter", "all"),
+        project=request.args.get("project", ""),
+        unit=request.args.get("unit", ""),
+        compress=compress,
+        archived=include_archived()
+    )
+
+    filename = f"requests-{datetime.utcnow():%Y%m%d-%H%M%S}.{fmt}"
+    mimetype = EXPORT_FORMATS[fmt]
+    if compress:
+        filename += ".gz"
+        mimetype = "application/gzip"
+
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+# ---------- تقرير المبالغ (JSON) ----------
+@app.route("/reports/amounts")
+def amounts_report():
+    """
+    ?field=pr_discount_amount&project=...&filter=approved&from=2025-01&to=2025-03&archived=1
+    كل القيم بالـ minor units (تقسم على scale)
+    """
+    if not is_staff_logged():
+        abort(403)
+
+    field = request.args.get("field", "")
+    if field and field not in AMOUNT_FIELDS:
+        abort(400)
+    sql, params = build_amounts_report_sql(
+        field=field,
+        project=request.args.get("project", ""),
+        flt=request.args.get("filter", "all"),
+        month_from=request.args.get("from", ""),
+        month_to=request.args.get("to", ""),
+        archived=include_archived(),
+    )
+    rows = [
+        {
+            "field": r["field"],
+            "request_type": AMOUNT_FIELD_TYPES[r["field"]],
+            "project_name": r["project_name"],
+            "month": r["month"],
+            "count": r["n"],
+            "sum_minor": r["sum_minor"],
+            "avg_minor": r["avg_minor"],
+        }
+        for r in get_read_db().execute(sql, params)
+    ]
+    return {"scale": AMOUNT_SCALE, "rows": rows}
+
+
 # ---------- صفحة طلب للمدير + Approve/Reject ----------
 @app.route("/manager/<int:level>/request/<int:req_id>", methods=["GET", "POST"])
 def manager_request(level, req_id):
@@ -754,93 +3453,121 @@ def manager_request(level, req_id):
     if redir:
         return redir
 
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("SELECT * FROM requests WHERE id = ?", (req_id,))
-    row = cur.fetchone()
-    if not row:
-        abort(404)
+    if request.method == "POST":
+        db = get_db()
+        archived = not load_request_version(db, req_id)
+        if archived:
+            row = get_read_db().execute("SELECT status FROM archive.requests WHERE id = ?", (req_id,)).fetchone()
+            if row is None:
+                abort(404)
+            # اللي في الأرشيف Approved / Rejected => القرار مرفوض من غير write lock على القاعدتين
+            error = decision_status_error(level, row["status"])
+            if error:
+                return render_request_view(get_read_db(), req_id, manager_level=level, error=error,
+                                           schema="archive")
+        with request_write_transaction(db, req_id, archived) as conn:
+            error, _ = apply_decision(
+                conn, req_id, level,
+                request.form.get("decision"),
+                request.form.get("approver_name", "").strip(),
+                request.form.get("comments", "").strip(),
+                datetime.utcnow().isoformat(),
+            )
+            if error:
+                # القرار اترفض => ولا حاجة تتكتب: الطلب المؤرشف يفضل في الأرشيف
+                # (الـ commit بتاع write_transaction بعد كده مش بيعمل حاجة)
+                conn.rollback()
 
-    cur.execute("SELECT * FROM approvals WHERE request_id = ? ORDER BY level, decided_at", (req_id,))
-    approvals = cur.fetchall()
+        if not error:
+            page_cache.invalidate(req_id)
+            return redirect(url_for("manager_dashboard", level=level))
 
-    error = None
+        # خطأ في القرار => الصفحة بالرسالة من غير كاش
+        if archived:
+            return render_request_view(get_read_db(), req_id, manager_level=level, error=error,
+                                       schema="archive")
+        return render_request_view(db, req_id, manager_level=level, error=error)
+
+    with read_snapshot() as db:
+        schema, version = locate_request(db, req_id)
+        if not version:
+            abort(404)
+        etag, last_modified = page_validators(
+            "manager", level, req_id, *version, last_modified=version["updated_at"]
+        )
+        resp = not_modified(etag, last_modified)
+        if resp:
+            return resp
+
+        html = cached_page(
+            ("view", req_id, version["updated_at"], level),
+            lambda: render_request_view(db, req_id, manager_level=level, schema=schema),
+            tag=req_id,
+        )
+    return with_validators(html, etag, last_modified)
 
-    if request.method == "POST":
-        decision = request.form.get("decision")
-        approver_name = request.form.get("approver_name", "").strip()
-        comments = request.form.get("comments", "").strip()
-
-        if decision not in ("Approved", "Rejected"):
-            error = "Invalid decision"
-        elif not approver_name:
-            error = "Approver name required"
-        else:
-            now = datetime.utcnow().isoformat()
 
-            # لا تسمح لـ Manager 2 يوافق لو لسا Pending L1
-            if level == 2 and row["status"] != "Pending L2":
-                error = "Request is not ready for Level 2."
-            else:
-                cur.execute("""
-                    INSERT INTO approvals (request_id, level, approver_name, decision, comments, decided_at)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (req_id, level, approver_name, decision, comments, now))
-
-                # تحديث حالة الطلب
-                new_status = row["status"]
-                new_step = row["current_step"]
-
-                if level == 1:
-                    if decision == "Approved":
-                        new_status = "Pending L2"
-                        new_step = 2
-                    else:
-                        new_status = "Rejected"
-                        new_step = 0
-                elif level == 2:
-                    if decision == "Approved":
-                        new_status = "Approved"
-                        new_step = 0
-                    else:
-                        new_status = "Rejected"
-                        new_step = 0
-
-                cur.execute(
-                    "UPDATE requests SET status=?, current_step=?, updated_at=? WHERE id=?",
-                    (new_status, new_step, now, req_id)
-                )
-                db.commit()
-                return redirect(url_for("manager_dashboard", level=level))
+# ---------- قرار واحد على طلبات كتير من الداشبورد ----------
+@app.route("/manager/<int:level>/bulk", methods=["POST"])
+def manager_bulk_decision(level):
+    if level not in (1, 2):
+        abort(404)
 
-    # إعادة جلب بعد أي عملية
-    cur.execute("SELECT * FROM requests WHERE id = ?", (req_id,))
-    row = cur.fetchone()
-    cur.execute("SELECT * FROM approvals WHERE request_id = ? ORDER BY level, decided_at", (req_id,))
-    approvals = cur.fetchall()
+    redir = require_manager(level)
+    if redir:
+        return redir
+
+    req_ids = request.form.getlist("ids", type=int)
+    if not req_ids:
+        abort(400)
+    if len(req_ids) > app.config["DASHBOARD_MAX_PAGE_SIZE"]:
+        abort(413)
+
+    db = get_db()
+    with write_transaction(db):
+        results = apply_decisions(
+            db, req_ids, level,
+            request.form.get("decision"),
+            request.form.get("approver_name", "").strip(),
+            request.form.get("comments", "").strip(),
+            datetime.utcnow().isoformat(),
+        )
 
-    manager1_sig = None
-    manager2_sig = None
-    for a in approvals:
-        if a["level"] == 1:
-            manager1_sig = a
-        elif a["level"] == 2:
-            manager2_sig = a
+    for req_id, error, _ in results:
+        if not error:
+            page_cache.invalidate(req_id)
+
+    # يرجع لنفس الصفحة (نفس الفلاتر) بعد ما يشوف النتيجة
+    back = request.form.get("back", "")
+    if not back.startswith(f"/manager/{level}?") and back != f"/manager/{level}":
+        back = url_for("manager_dashboard", level=level)
 
     return render_template(
-        "request_view.html",
-        req=row,
-        req_id=req_id,
-        approvals=approvals,
-        manager_level=level,
-        error=error,
-        edit_link=None,
-        from_submit=False,
-        manager1_sig=manager1_sig,
-        manager2_sig=manager2_sig
+        "manager_bulk_result.html",
+        level=level,
+        decision=request.form.get("decision"),
+        results=results,
+        decided=sum(1 for _, error, _ in results if not error),
+        back=back,
     )
 
 
+# ---------- عدادات كاش الصفحات ----------
+@app.route("/cache/stats")
+def cache_stats():
+    if not is_staff_logged():
+        abort(403)
+    return page_cache.stats()
+
+
+# ---------- قياسات الأداء (Prometheus) ----------
+@app.route("/metrics")
+def metrics_endpoint():
+    if not metrics_authorized():
+        abort(403)
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
 # -------- Viewer Login ----------
 @app.route("/viewer/login", methods=["GET", "POST"])
 def viewer_login():
@@ -857,11 +3584,852 @@ def viewer_login():
     return render_template("viewer_dashboard.html", login_only=True, error=error)
 
 
+# ============================================
+# Outbox worker (flask --app app outbox-worker)
+# ============================================
+# القرار بيكتب في outbox جوه نفس الـ commit، والـ worker (process منفصل) بيسلّم دفعات:
+# claim (lease) => deliver لكل الـ sinks => delivered أو retry بـ backoff أو dead بعد MAX_ATTEMPTS
+# التسليم at-least-once، والـ sink بياخد idempotency_key عشان يتجاهل المكرر
+
+
+class FileSink:
+    """سطر JSON لكل رسالة (للتجربة / تكامل بسيط بيقرا الملف)"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def deliver(self, message):
+        with open(self.path, "a", encoding="utf-8") as fh:
+            fh.write(json.dumps(message, ensure_ascii=False) + "\n")
+
+
+class WebhookSink:
+    """POST JSON، و Idempotency-Key في الـ header؛ أي رد غير 2xx = فشل ويتعاد"""
+
+    def __init__(self, url):
+        self.url = url
+
+    def deliver(self, message):
+        req = urllib_request.Request(
+            self.url,
+            data=json.dumps(message, ensure_ascii=False).encode("utf-8"),
+            headers={"Content-Type": "application/json", "Idempotency-Key": message["idempotency_key"]},
+            method="POST",
+        )
+        with urllib_request.urlopen(req, timeout=app.config["OUTBOX_WEBHOOK_TIMEOUT"]):
+            pass
+
+
+class LogSink:
+    """بيكتب الرسالة في اللوج بس"""
+
+    def __init__(self, _target=None):
+        pass
+
+    def deliver(self, message):
+        app.logger.info("outbox %s %s", message["topic"], message["idempotency_key"])
+
+
+OUTBOX_SINK_TYPES = {"file": FileSink, "webhook": WebhookSink, "log": LogSink}
+
+
+def load_outbox_sinks(spec):
+    """"file:/path,webhook:https://..." => [sink, ...]"""
+    sinks = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        kind, _, target = item.partition(":")
+        if kind not in OUTBOX_SINK_TYPES:
+            raise click.ClickException(f"unknown outbox sink '{kind}'")
+        sinks.append(OUTBOX_SINK_TYPES[kind](target))
+    return sinks
+
+
+def utc_after(seconds):
+    return (datetime.utcnow() + timedelta(seconds=seconds)).isoformat()
+
+
+def claim_outbox_batch(db, batch_size):
+    """
+    الرسايل المستحقة + lease (next_attempt_at لقدام) في transaction واحدة
+    => worker تاني ما ياخدهاش، ولو الـ worker وقع بترجع بعد OUTBOX_LEASE_SECONDS
+    """
+    with write_transaction(db):
+        rows = db.execute(
+            "SELECT id, topic, idempotency_key, payload, attempts FROM outbox "
+            "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT ?",
+            (datetime.utcnow().isoformat(), batch_size)
+        ).fetchall()
+        db.executemany(
+            "UPDATE outbox SET next_attempt_at = ? WHERE id = ?",
+            [(utc_after(app.config["OUTBOX_LEASE_SECONDS"]), row["id"]) for row in rows]
+        )
+    return rows
+
+
+def renew_outbox_lease(db, outbox_ids):
+    """lease جديد لرسايل الدفعة اللي في إيد الـ worker (webhooks بطيئة ما تعدّيش الـ lease)"""
+    with write_transaction(db):
+        db.execute(
+            "UPDATE outbox SET next_attempt_at = ? "
+            f"WHERE status = 'pending' AND id IN ({REQUEST_IDS_SQL})",
+            (utc_after(app.config["OUTBOX_LEASE_SECONDS"]), json.dumps(outbox_ids))
+        )
+
+
+def outbox_backoff(attempts):
+    """5s, 10s, 20s ... لحد OUTBOX_BACKOFF_MAX_SECONDS + jitter عشان الـ retries ما تتجمعش"""
+    delay = min(app.config["OUTBOX_BACKOFF_SECONDS"] * 2 ** (attempts - 1),
+                app.config["OUTBOX_BACKOFF_MAX_SECONDS"])
+    return delay * random.uniform(0.8, 1.2)
+
+
+def deliver_outbox_batch(db, sinks, batch_size):
+    """دفعة واحدة: claim => deliver => نتايج الدفعة كلها في commit واحد. يرجّع (delivered, failed)"""
+    rows = claim_outbox_batch(db, batch_size)
+    if not rows:
+        return 0, 0
+
+    # دفعة كاملة x timeout الـ webhook ممكن تعدّي الـ lease => worker تاني ياخد نفس الرسايل
+    # ويسلّمها مرتين، فالـ lease بيتجدد كل نص المدة للدفعة كلها (اللي اتسلم لسه pending في
+    # القاعدة لحد الـ commit اللي في الآخر)
+    lease = app.config["OUTBOX_LEASE_SECONDS"]
+    renew_at = time.monotonic() + lease / 2
+    delivered, retries, dead = [], [], []
+    for row in rows:
+        if time.monotonic() >= renew_at:
+            renew_outbox_lease(db, [r["id"] for r in rows])
+            renew_at = time.monotonic() + lease / 2
+        message = {
+            "id": row["id"],
+            "topic": row["topic"],
+            "idempotency_key": row["idempotency_key"],
+            "payload": json.loads(row["payload"]),
+        }
+        attempts = row["attempts"] + 1
+        try:
+            for sink in sinks:
+                sink.deliver(message)
+        except Exception as exc:
+            error = f"{type(exc).__name__}: {exc}"[:500]
+            if attempts >= app.config["OUTBOX_MAX_ATTEMPTS"]:
+                dead.append((attempts, error, row["id"]))
+            else:
+                retries.append((attempts, utc_after(outbox_backoff(attempts)), error, row["id"]))
+        else:
+            delivered.append((attempts, datetime.utcnow().isoformat(), row["id"]))
+
+    with write_transaction(db):
+        db.executemany(
+            "UPDATE outbox SET status = 'delivered', attempts = ?, delivered_at = ?, last_error = NULL "
+            "WHERE id = ?", delivered
+        )
+        db.executemany(
+            "UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?", retries
+        )
+        db.executemany(
+            "UPDATE outbox SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?", dead
+        )
+    for _, error, outbox_id in dead:
+        app.logger.error("outbox message %s dead after max attempts: %s", outbox_id, error)
+    return len(delivered), len(retries) + len(dead)
+
+
+def prune_outbox(db):
+    cutoff = (datetime.utcnow() - timedelta(days=app.config["OUTBOX_KEEP_DAYS"])).isoformat()
+    with write_transaction(db):
+        return db.execute(
+            "DELETE FROM outbox WHERE status = 'delivered' AND delivered_at < ?", (cutoff,)
+        ).rowcount
+
+
+# ============================================
+# JSON API (/api/v1) للتكاملات (CRM)
+# ============================================
+# Authorization: Bearer <token> (API_TOKENS / API_DECIDE_L1_TOKENS / API_DECIDE_L2_TOKENS)
+# الطلب في الـ JSON بنفس أسماء حقول الفورم، والـ *_selected true/false
+# نفس build_data_from_form / validate_required بتوع الفورم => نفس الرسايل ونفس التوحيد
+
+api = Blueprint("api_v1", __name__, url_prefix="/api/v1")
+
+API_INPUT_FIELDS = frozenset(f.name for f in ALL_FIELDS) | frozenset(REQUEST_TYPE_BITS)
+
+
+# (scope, مستوى القرار, مفتاح الإعدادات): توكن في القايمتين بياخد أول مستوى بس
+API_TOKEN_SCOPES = (
+    ("decide", 1, "API_DECIDE_L1_TOKENS"),
+    ("decide", 2, "API_DECIDE_L2_TOKENS"),
+    ("write", None, "API_TOKENS"),
+)
+API_LEVEL_ERROR = "Token is not allowed to decide at this level"
+
+
+def api_token_scope():
+    """(scope, level) حسب التوكن ("decide" ومعاه 1 / 2، أو "write")، None لو مش موجود أو غلط"""
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    token = token.strip().encode("utf-8")
+    for scope, level, key in API_TOKEN_SCOPES:
+        if any(secrets.compare_digest(token, t.encode("utf-8")) for t in app.config[key]):
+            return scope, level
+    return None
+
+
+@api.before_request
+def require_api_token():
+    scope = api_token_scope()
+    if scope is None:
+        return {"error": "Invalid or missing API token"}, 401, {"WWW-Authenticate": "Bearer"}
+    g.api_scope, g.api_level = scope
+
+
+@api.errorhandler(HTTPException)
+def api_error(exc):
+    """أخطاء الـ API JSON مش صفحة HTML"""
+    return {"error": exc.description}, exc.code
+
+
+def api_body(key=None):
+    """الـ JSON object بتاع الطلب (أو list جوه key بحد API_BATCH_MAX)، وإلا 400"""
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400, "Request body must be a JSON object")
+    if key is None:
+        return body
+    items = body.get(key)
+    if not isinstance(items, list) or not items:
+        abort(400, f"'{key}' must be a non-empty list")
+    if len(items) > app.config["API_BATCH_MAX"]:
+        abort(400, f"At most {app.config['API_BATCH_MAX']} items per batch")
+    return items
+
+
+def api_request_data(item):
+    """JSON طلب -> (data, errors) بنفس مسار الفورم"""
+    if not isinstance(item, dict):
+        return None, ["Request must be a JSON object"]
+    errors = [f"Unknown field '{name}'." for name in sorted(set(item) - API_INPUT_FIELDS)]
+
+    form = {}
+    for name, value in item.items():
+        if name in REQUEST_TYPE_BITS:
+            if value:
+                form[name] = "on"
+        elif value is None or name not in API_INPUT_FIELDS:
+            continue
+        elif isinstance(value, (str, int, float)) and not isinstance(value, bool):
+            form[name] = str(value)
+        else:
+            errors.append(f"Field '{name}' must be a string or number.")
+    if errors:
+        return None, errors
+
+    data = build_data_from_form(form, for_update=False)
+    errors = validate_required(data)
+    return (None, errors) if errors else (data, [])
+
+
+def api_request_json(row, approvals):
+    """صف requests + approvals بتاعته -> JSON (من غير edit_token)"""
+    rec = request_record(row)
+    rec.pop("edit_token", None)
+    for flag in REQUEST_TYPE_BITS:
+        rec[flag] = bool(rec[flag])
+    rec["approvals"] = [
+        {k: a[k] for k in ("level", "approver_name", "decision", "comments", "decided_at")}
+        for a in approvals
+    ]
+    return rec
+
+
+def api_created(req_id, data):
+    return {
+        "id": req_id,
+        "status": data["status"],
+        "url": url_for("view_request", req_id=req_id, _external=True),
+        "edit_url": url_for("edit_request", token=data["edit_token"], _external=True),
+    }
+
+
+# main + الأرشيف: الناحيتين مترتبين من index الـ updated_at و MERGE بيقف عند الـ LIMIT
+# (الطلب اللي في الاتنين بعد archive-requests وقف في النص => بتاع main بس)
+API_CHANGES_SQL = (
+    "SELECT id, status, current_step, updated_at FROM main.requests "
+    "WHERE (updated_at, id) > (:since, :after_id) "
+    "UNION ALL "
+    "SELECT a.id, a.status, a.current_step, a.updated_at FROM archive.requests a "
+    "WHERE (a.updated_at, a.id) > (:since, :after_id) "
+    "AND NOT EXISTS (SELECT 1 FROM main.requests m WHERE m.id = a.id) "
+    "ORDER BY updated_at, id LIMIT :limit"
+)
+
+
+def parse_api_timestamp(text):
+    """updated_since (ISO، بـ timezone أو من غيرها = UTC) -> نفس شكل updated_at في القاعدة"""
+    try:
+        value = datetime.fromisoformat(text)
+    except ValueError:
+        abort(400, "updated_since must be an ISO 8601 timestamp")
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat()
+
+
+def api_decide(db, req_id, item, now):
+    """قرار واحد من JSON (جوه write_transaction الـ caller) -> (error, new_status)"""
+    level = item.get("level")
+    if level not in (1, 2) or isinstance(level, bool):
+        return "Invalid level", None
+    if level != g.api_level:
+        return API_LEVEL_ERROR, None
+    approver_name = item.get("approver_name")
+    comments = item.get("comments") or ""
+    if not isinstance(approver_name, str) or not isinstance(comments, str):
+        return "approver_name and comments must be strings", None
+    return apply_decision(
+        db, req_id, level, item.get("decision"), approver_name.strip(), comments.strip(), now
+    )
+
+
+@api.post("/requests")
+def api_create_request():
+    data, errors = api_request_data(api_body())
+    if errors:
+        return {"errors": errors}, 422
+
+    db = get_db()
+    with write_transaction(db):
+        req_id = db.execute(REQUEST_INSERT_SQL, pack_request_data(data)).lastrowid
+    result = api_created(req_id, data)
+    return result, 201, {"Location": result["url"]}
+
+
+@api.post("/requests/batch")
+def api_create_requests_batch():
+    """
+    {"requests": [...], "atomic": false} => كلهم في transaction واحدة + نتيجة لكل عنصر
+    atomic=true: أي عنصر غلط => ولا واحد بيتسجل (422)
+    """
+    body = api_body()
+    parsed = [api_request_data(item) for item in api_body("requests")]
+
+    if body.get("atomic") and any(errors for _, errors in parsed):
+        results = [
+            {"index": i, "ok": not errors, "errors": errors} for i, (_, errors) in enumerate(parsed)
+        ]
+        return {"created": 0, "results": results}, 422
+
+    db = get_db()
+    results = []
+    with write_transaction(db):
+        for i, (data, errors) in enumerate(parsed):
+            if errors:
+                results.append({"index": i, "ok": False, "errors": errors})
+                continue
+            req_id = db.execute(REQUEST_INSERT_SQL, pack_request_data(data)).lastrowid
+            results.append({"index": i, "ok": True, **api_created(req_id, data)})
+
+    return {"created": sum(r["ok"] for r in results), "results": results}
+
+
+@api.get("/requests/<int:req_id>")
+def api_get_request(req_id):
+    # main الأول وبعدين الأرشيف (زي view_request) => الطلب المؤرشف بيرجع عادي
+    with read_snapshot() as db:
+        for schema in ("main", "archive"):
+            row = db.execute(f"SELECT * FROM {schema}.requests WHERE id = ?", (req_id,)).fetchone()
+            if row is not None:
+                break
+        else:
+            abort(404, "Request not found")
+        approvals = db.execute(
+            f"SELECT * FROM {schema}.approvals WHERE request_id = ? ORDER BY level, decided_at", (req_id,)
+        ).fetchall()
+    return api_request_json(row, approvals)
+
+
+@api.get("/requests")
+def api_get_requests():
+    """?ids=1,2,3 => الطلبات بالترتيب اللي اتطلب + missing (استعلامين مهما كان العدد)"""
+    try:
+        ids = [int(x) for x in request.args.get("ids", "").split(",") if x.strip()]
+    except ValueError:
+        abort(400, "ids must be a comma separated list of integers")
+    if not ids:
+        abort(400, "ids is required")
+    if len(ids) > app.config["API_BATCH_MAX"]:
+        abort(400, f"At most {app.config['API_BATCH_MAX']} ids per call")
+
+    rows, approvals = {}, {}
+    with read_snapshot() as db:
+        # main الأول، واللي مش فيه بيتدور عليه في الأرشيف (الاتنين موجودين => main بيكسب)
+        for schema in ("main", "archive"):
+            id_list = json.dumps([i for i in ids if i not in rows])
+            if id_list == "[]":
+                break
+            found = {
+                row["id"]: row for row in db.execute(
+                    f"SELECT * FROM {schema}.requests WHERE id IN (SELECT value FROM json_each(?))", (id_list,)
+                )
+            }
+            rows.update(found)
+            for a in db.execute(
+                f"SELECT * FROM {schema}.approvals WHERE request_id IN (SELECT value FROM json_each(?)) "
+                "ORDER BY request_id, level, decided_at", (json.dumps(list(found)),)
+            ):
+                approvals.setdefault(a["request_id"], []).append(a)
+
+    return {
+        "requests": [api_request_json(rows[i], approvals.get(i, ())) for i in dict.fromkeys(ids) if i in rows],
+        "missing": [i for i in dict.fromkeys(ids) if i not in rows],
+    }
+
+
+@api.get("/requests/changes")
+def api_request_changes():
+    """
+    sync تدريجي: الطلبات اللي updated_at بتاعها بعد (updated_since, after_id) بالترتيب
+    الـ CRM بيبعت next في الطلب الجاي لحد has_more = false
+    """
+    since = request.args.get("updated_since", "")
+    if since:
+        since = parse_api_timestamp(since)
+    after_id = request.args.get("after_id", 0, type=int)
+    limit = max(1, min(request.args.get("limit", app.config["API_BATCH_MAX"], type=int),
+                       app.config["API_BATCH_MAX"]))
+
+    with read_snapshot() as db:
+        changes = [dict(row) for row in db.execute(
+            API_CHANGES_SQL, {"since": since, "after_id": after_id, "limit": limit}
+        )]
+    if changes:
+        since, after_id = changes[-1]["updated_at"], changes[-1]["id"]
+    return {
+        "changes": changes,
+        "next": {"updated_since": since, "after_id": after_id},
+        "has_more": len(changes) == limit,
+    }
+
+
+@api.post("/requests/<int:req_id>/decision")
+def api_decision(req_id):
+    """{"level": 1, "decision": "Approved", "approver_name": "...", "comments": ""}"""
+    if g.api_scope != "decide":
+        abort(403, "Token is not allowed to decide")
+    db = get_db()
+    with write_transaction(db):
+        error, status = api_decide(db, req_id, api_body(), datetime.utcnow().isoformat())
+    if error == "Request not found":
+        abort(404, error)
+    if error == API_LEVEL_ERROR:
+        abort(403, error)
+    if error:
+        return {"error": error}, 422
+    page_cache.invalidate(req_id)
+    return {"id": req_id, "status": status}
+
+
+@api.post("/decisions/batch")
+def api_decisions_batch():
+    """{"decisions": [{"id": 1, "level": 1, ...}, ...]} => transaction واحدة + نتيجة لكل عنصر بالترتيب"""
+    if g.api_scope != "decide":
+        abort(403, "Token is not allowed to decide")
+    items = api_body("decisions")
+
+    db = get_db()
+    now = datetime.utcnow().isoformat()
+    results = []
+    with write_transaction(db):
+        for i, item in enumerate(items):
+            req_id = item.get("id") if isinstance(item, dict) else None
+            if not isinstance(req_id, int) or isinstance(req_id, bool):
+                results.append({"index": i, "ok": False, "error": "id is required"})
+                continue
+            error, status = api_decide(db, req_id, item, now)
+            if error:
+                results.append({"index": i, "id": req_id, "ok": False, "error": error})
+            else:
+                results.append({"index": i, "id": req_id, "ok": True, "status": status})
+
+    for r in results:
+        if r["ok"]:
+            page_cache.invalidate(r["id"])
+    return {"decided": sum(r["ok"] for r in results), "results": results}
+
+
+app.register_blueprint(api)
+
+
+# ============================================
+# أوامر CLI (flask --app app <command>)
+# ============================================
+
+@app.cli.command("rebuild-stats")
+def rebuild_stats_command():
+    """يعيد حساب جدول request_stats من جدول requests"""
+    create_app()
+    db = get_db()
+    rebuild_request_stats(db)
+    counts = load_status_counts(db)
+    click.echo(", ".join(f"{k}={v}" for k, v in counts.items()))
+
+
+@app.cli.command("export-requests")
+@click.option("--format", "fmt", type=click.Choice(sorted(EXPORT_FORMATS)), default="csv")
+@click.option("--output", "-o", type=click.File("wb"), default="-", help="الملف (- = stdout)")
+@click.option("--filter", "flt", default="all", help="all / pending_l1 / pending_l2 / approved / rejected")
+@click.option("--project", default="")
+@click.option("--unit", default="")
+@click.option("--gzip", "compress", is_flag=True, help="ضغط gzip أثناء الكتابة")
+@click.option("--archived", is_flag=True, help="الطلبات المؤرشفة كمان")
+def export_requests_command(fmt, output, flt, project, unit, compress, archived):
+    """يصدّر requests + approvals (نفس فلاتر manager_dashboard) بدون تحميل الكل في الذاكرة"""
+    create_app()
+    db = get_read_db() if archived else get_db()
+    for chunk in iter_export(db, fmt, flt, project, unit, compress=compress, archived=archived):
+        output.write(chunk)
+
+
+@app.cli.command("import-requests")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]), default=None,
+              help="الافتراضي من امتداد الملف")
+@click.option("--rejects", type=click.Path(dir_okay=False), default=None,
+              help="الصفوف المرفوضة (الافتراضي PATH.rejects.jsonl)")
+@click.option("--batch-size", default=5000, show_default=True)
+@click.option("--resume", is_flag=True, help="يكمل من آخر دفعة اتحفظت لنفس الملف")
+def import_requests_command(path, fmt, rejects, batch_size, resume):
+    """يستورد طلبات قديمة من CSV/JSONL على دفعات (executemany + transaction لكل دفعة)"""
+    create_app()
+    db = get_db()
+    source = os.path.abspath(path)
+    fmt = fmt or ("jsonl" if path.lower().endswith((".jsonl", ".ndjson")) else "csv")
+    rejects = rejects or path + ".rejects.jsonl"
+
+    start = 0
+    if resume:
+        row = db.execute("SELECT position FROM import_progress WHERE source = ?", (source,)).fetchone()
+        start = row["position"] if row else 0
+        if start:
+            click.echo(f"resuming after record {start}")
+
+    totals = {"imported": 0, "rejected": 0}
+    batch, batch_rejects = [], []
+    position = start
+
+    def flush():
+        with write_transaction(db):
+            if batch:
+                db.executemany(REQUEST_INSERT_SQL, batch)
+            db.execute("""
+                INSERT INTO import_progress (source, position, imported, rejected, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (source) DO UPDATE SET
+                    position = excluded.position,
+                    imported = import_progress.imported + excluded.imported,
+                    rejected = import_progress.rejected + excluded.rejected,
+                    updated_at = excluded.updated_at
+            """, (source, position, len(batch), len(batch_rejects), datetime.utcnow().isoformat()))
+        # المرفوضات بتتكتب بعد الـ commit بس => --resume ما يكررهاش
+        for item in batch_rejects:
+            rejects_fh.write(json.dumps(item, ensure_ascii=False) + "\n")
+        rejects_fh.flush()
+        totals["imported"] += len(batch)
+        totals["rejected"] += len(batch_rejects)
+        batch.clear()
+        batch_rejects.clear()
+
+    started = datetime.utcnow()
+    with open(path, encoding="utf-8-sig", newline="") as fh, \
+            open(rejects, "a" if resume else "w", encoding="utf-8") as rejects_fh:
+        for index, (rec, error) in enumerate(iter_import_records(fh, fmt)):
+            if index < start:
+                continue
+            position = index + 1
+
+            if error:
+                batch_rejects.append({"record": position, "errors": [error], "data": rec})
+            else:
+                data, errors = import_record_to_data(rec)
+                if errors:
+                    batch_rejects.append({"record": position, "errors": errors, "data": rec})
+                else:
+                    batch.append(pack_request_data(data))
+
+            if len(batch) + len(batch_rejects) >= batch_size:
+                flush()
+
+        flush()
+
+    seconds = max((datetime.utcnow() - started).total_seconds(), 1e-6)
+    click.echo(
+        f"imported={totals['imported']} rejected={totals['rejected']} "
+        f"({totals['imported'] / seconds:.0f} rows/s), rejects -> {rejects}"
+    )
+
+
+@app.cli.command("seed-requests")
+@click.option("--count", default=10000, show_default=True, help="عدد الطلبات")
+@click.option("--days", default=730, show_default=True, help="created_at موزّع على آخر كام يوم")
+@click.option("--seed", default=1, show_default=True, help="نفس الـ seed => نفس البيانات")
+@click.option("--batch-size", default=5000, show_default=True)
+def seed_requests_command(count, days, seed, batch_size):
+    """
+    يملا القاعدة بطلبات تجريبية (أنواع / مشاريع / وحدات / تاريخ موافقات L1 و L2)
+    لقياس الأداء على 10k .. 1M طلب (bench.py) -- ما تشغّلوش على قاعدة الإنتاج
+    """
+    create_app()
+    db = get_db()
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    start = now - timedelta(days=days)
+    statuses = list(SEED_STATUS_WEIGHTS)
+    weights = list(SEED_STATUS_WEIGHTS.values())
+    finalized_weights = [w if s in ("Approved", "Rejected") else 0 for s, w in SEED_STATUS_WEIGHTS.items()]
+
+    approvals = 0
+    started = time.perf_counter()
+    for offset in range(0, count, batch_size):
+        rows, histories = [], []
+        for i in range(offset, min(offset + batch_size, count)):
+            # ids بتزيد مع created_at زي الطلبات الحقيقية
+            created = start + timedelta(seconds=(i + rng.random()) * days * 86400 / count)
+            data = build_data_from_form(seed_request_form(rng, created))
+            recent = (now - created).days < SEED_PENDING_DAYS
+            status = rng.choices(statuses, weights if recent else finalized_weights)[0]
+            decisions = seed_decisions(rng, status, created, now)
+            data["status"] = status
+            data["current_step"] = IMPORT_STATUS_STEPS[status]
+            data["created_at"] = created.isoformat()
+            data["updated_at"] = decisions[-1][3] if decisions else data["created_at"]
+            rows.append(pack_request_data(data))
+            histories.append(decisions)
+
+        with write_transaction(db):
+            last_id = db.execute("SELECT COALESCE(MAX(id), 0) FROM requests").fetchone()[0]
+            db.executemany(REQUEST_INSERT_SQL, rows)
+            ids = [r[0] for r in db.execute("SELECT id FROM requests WHERE id > ? ORDER BY id", (last_id,))]
+            history_rows = [
+                (req_id, level, approver, decision, "", decided_at)
+                for req_id, decisions in zip(ids, histories)
+                for level, decision, approver, decided_at in decisions
+            ]
+            db.executemany("""
+                INSERT INTO approvals (request_id, level, approver_name, decision, comments, decided_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, history_rows)
+        approvals += len(history_rows)
+        click.echo(f"{offset + len(rows)}/{count}")
+
+    seconds = max(time.perf_counter() - started, 1e-6)
+    click.echo(f"seeded requests={count} approvals={approvals} ({count / seconds:.0f} rows/s)")
+
+
+@app.cli.command("archive-requests")
+@click.option("--older-than-days", type=int, default=None,
+              help="آخر تعديل أقدم من كده (الافتراضي ARCHIVE_AFTER_DAYS)")
+@click.option("--batch-size", type=int, default=None, help="طلبات لكل transaction (ARCHIVE_BATCH_SIZE)")
+@click.option("--vacuum", is_flag=True, help="VACUUM للقاعدة الأساسية بعد النقل (الملف نفسه يصغر)")
+def archive_requests_command(older_than_days, batch_size, vacuum):
+    """
+    ينقل الطلبات اللي خلصت (Approved / Rejected) والقديمة + الـ approvals بتاعتها لقاعدة الأرشيف
+    بدفعات صغيرة (كل دفعة transaction قصير => الداشبورد والقرارات شغالين عادي وقت التشغيل)
+    """
+    create_app()
+    days = app.config["ARCHIVE_AFTER_DAYS"] if older_than_days is None else older_than_days
+    batch_size = batch_size or app.config["ARCHIVE_BATCH_SIZE"]
+    cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
+
+    with closing(open_db(archive=True)) as db:
+        size_before = os.path.getsize(DB_PATH)
+        total = 0
+        while True:
+            moved = archive_requests_batch(db, cutoff, batch_size)
+            if not moved:
+                break
+            total += moved
+            click.echo(f"archived {total} requests", err=True)
+
+        if total:
+            # الـ FTS بيمسح بـ tombstones ودفعات الأرشيف segments كتير => دمج في segment واحد
+            for schema in ("main", "archive"):
+                db.execute(f"INSERT INTO {schema}.requests_fts (requests_fts) VALUES ('optimize')")
+            db.commit()
+        if vacuum and total:
+            # الصفحات الفاضية بتتعاد لوحدها للطلبات الجديدة، الـ VACUUM بيرجّعها للـ OS
+            db.execute("VACUUM main")
+        db.execute("PRAGMA main.wal_checkpoint(TRUNCATE)")
+        counts = {
+            schema: db.execute(f"SELECT COUNT(*) FROM {schema}.requests").fetchone()[0]
+            for schema in ("main", "archive")
+        }
+        size_after = os.path.getsize(DB_PATH)
+
+    click.echo(
+        f"archived {total} requests updated before {cutoff[:10]}: "
+        f"main {counts['main']} rows ({size_before / 2**20:.1f} -> {size_after / 2**20:.1f} MiB), "
+        f"archive {counts['archive']} rows ({os.path.getsize(ARCHIVE_DB_PATH) / 2**20:.1f} MiB)"
+    )
+
+
+@app.cli.command("outbox-worker")
+@click.option("--once", is_flag=True, help="يسلّم اللي مستحق دلوقتي ويخرج")
+@click.option("--batch-size", type=int, default=None)
+@click.option("--interval", type=float, default=None, help="ثواني بين كل poll لما مفيش رسايل")
+def outbox_worker_command(once, batch_size, interval):
+    """يسلّم رسايل outbox للـ sinks (OUTBOX_SINKS) لحد SIGTERM / Ctrl+C"""
+    create_app()
+    batch_size = batch_size or app.config["OUTBOX_BATCH_SIZE"]
+    interval = interval if interval is not None else app.config["OUTBOX_POLL_INTERVAL"]
+    sinks = load_outbox_sinks(app.config["OUTBOX_SINKS"])
+    db = get_db()
+
+    stopping = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stopping.set())
+
+    app.logger.info("outbox worker started (%s)", app.config["OUTBOX_SINKS"])
+    last_prune = 0.0
+    while not stopping.is_set():
+        delivered, failed = deliver_outbox_batch(db, sinks, batch_size)
+        if delivered or failed:
+            app.logger.info("outbox: delivered=%s failed=%s", delivered, failed)
+        if time.monotonic() - last_prune > 3600:
+            pruned = prune_outbox(db)
+            if pruned:
+                app.logger.info("outbox: pruned %s delivered messages", pruned)
+            last_prune = time.monotonic()
+        if once and delivered + failed < batch_size:
+            break
+        # دفعة كاملة => غالباً فيه تاني، فمن غير انتظار
+        if delivered + failed < batch_size:
+            stopping.wait(interval)
+
+
+@app.cli.command("check-indexes")
+def check_indexes_command():
+    """يتأكد بـ EXPLAIN QUERY PLAN إن استعلامات الراوتات بتستخدم الـ indexes"""
+    create_app()
+    db = open_db(archive=True)      # استعلامات الأرشيف كمان
+
+    queries = [
+        ("edit_request", "SELECT * FROM requests WHERE edit_token = ?", ("x",)),
+        ("approvals", "SELECT * FROM approvals WHERE request_id = ? ORDER BY level, decided_at", (1,)),
+        ("request detail", REQUEST_DETAIL_SQL["main"], (1,)),
+        ("archived request detail", REQUEST_DETAIL_SQL["archive"], (1,)),
+        ("archive candidates", ARCHIVE_CANDIDATES_SQL, {"cutoff": "2000-01-01", "limit": 500}),
+        ("distinct projects", "SELECT DISTINCT COALESCE(project_name, '') FROM requests ORDER BY 1", ()),
+        ("distinct units", "SELECT DISTINCT COALESCE(unit_number, '') FROM requests ORDER BY 1", ()),
+        ("outbox claim", "SELECT id, topic, idempotency_key, payload, attempts FROM outbox "
+                         "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at, id "
+                         "LIMIT 100", ("9999",)),
+        ("api changes", API_CHANGES_SQL, {"since": "", "after_id": 0, "limit": 500}),
+    ]
+    for report_args in ({}, {"field": "pr_discount_amount", "month_from": "2025-01", "month_to": "2025-03"},
+                        {"field": "paid_amount", "project": "Project A", "flt": "approved"}):
+        sql, params = build_amounts_report_sql(**report_args)
+        queries.append((f"amounts report {sorted(report_args)}", sql, params))
+    for search_flt in ("all", "approved"):
+        sql, params = build_listing_sql(search_flt, "", "", "relevance", limit=50, search='"ahm"*')
+        queries.append((f"dashboard search filter={search_flt}", sql, params))
+    # بحث بفرز تاني (كل النتايج، صفحة بعد cursor)
+    for sort, cursor in (("latest", (10,)), ("project", ("Project A", 10))):
+        sql, params = build_listing_sql("all", "", "", sort, cursor=cursor, limit=50, search='"ahm"*')
+        queries.append((f"dashboard search sort={sort} cursor=True", sql, params))
+    # include archived: نفس الـ indexes على الناحيتين
+    for sort in ("latest", "project"):
+        sql, params = build_listing_sql("approved", "Project A", "", sort, limit=50, archived=True)
+        queries.append((f"dashboard archived filter=approved project=True sort={sort}", sql, params))
+    # كل تركيبة فلاتر + فرز في الداشبورد، أول صفحة وصفحة بعد cursor
+    # (الترتيب لازم يطلع من الـ index: TEMP B-TREE = فرز كل الصفوف المطابقة في كل صفحة)
+    # archive-requests بيشتغل على main كله كل دفعة، و api changes بيلف على الجدولين كلهم
+    ordered = {"archive candidates", "api changes"}
+    for flt in ("all", "pending_l1"):
+        for project in ("", "Project A"):
+            for unit in ("", "1"):
+                for sort, (column, _) in LISTING_SORTS.items():
+                    if sort == "relevance":
+                        continue
+                    cursor = ("Project A", 10) if column else (10,)
+                    for page_cursor in (None, cursor):
+                        # أول صفحة بدون أي فلتر = قراءة أول 50 صف بالـ primary key
+                        if (flt, project, unit, sort, page_cursor) == ("all", "", "", "latest", None):
+                            continue
+                        sql, params = build_listing_sql(
+                            flt, project, unit, sort, cursor=page_cursor, limit=50
+                        )
+                        label = (f"dashboard filter={flt} project={bool(project)} "
+                                 f"unit={bool(unit)} sort={sort} cursor={bool(page_cursor)}")
+                        queries.append((label, sql, params))
+                        ordered.add(label)
+
+    failed = 0
+    for label, sql, params in queries:
+        plan = [row[3] for row in db.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        full_scan = [
+            p for p in plan
+            # "SCAN main.requests" نفس "SCAN requests"
+            if p.split()[0] == "SCAN"
+            and p.split()[1].split(".")[-1] in ("requests", "r", "approvals", "a", "outbox")
+            and "INDEX" not in p
+        ]
+        temp_sort = label in ordered and any("TEMP B-TREE" in p for p in plan)
+        if full_scan or temp_sort:
+            failed += 1
+        click.echo(f"[{'FAIL' if full_scan or temp_sort else 'ok'}] {label}: {' | '.join(plan)}")
+
+    if failed:
+        raise click.ClickException(f"{failed} queries do a full table scan or sort without an index")
+
+
+@app.cli.command("build-assets")
+def build_assets_command():
+    """static/ => static/dist (أسماء بـ hash + webp/avif + .gz/.br) + manifest.json"""
+    if Image is None:
+        click.echo("Pillow مش متسطب: من غير webp/avif", err=True)
+    if brotli is None:
+        click.echo("brotli مش متسطب: .gz بس", err=True)
+
+    global _asset_manifest
+    manifest = build_assets(app.static_folder, ASSET_DIST_DIR)
+    _asset_manifest = None
+
+    for path, entry in manifest.items():
+        sizes = [f"{entry['bytes']} B"]
+        sizes += [f"{fmt} {entry[f'{fmt}_bytes']} B" for fmt in entry.get("variants", {})]
+        sizes += [f"{suffix} {size} B" for suffix, size in entry.get("encoded", {}).items()]
+        click.echo(f"{path} -> dist/{entry['file']} ({', '.join(sizes)})")
+
+
 # ============================================
 # تشغيل التطبيق
 # ============================================
 
+_schema_ready = False
+
+
+def create_app():
+    """
+    الـ app جاهز للشغل: الجداول والـ migrations (PRAGMA user_version) مرة واحدة لكل process
+    مش وقت الـ import (build-assets / bench.py / أي import ما يلمسش القاعدة): gunicorn.conf.py
+    بيناديها في on_starting (الـ master قبل الـ fork)، وأوامر القاعدة و init-db في أولها
+    ومن غير connections مفتوحة تتورث للـ workers
+    """
+    global _schema_ready
+    if not _schema_ready:
+        with app.app_context():
+            init_db()
+            close_thread_db()
+        _schema_ready = True
+    return app
+
+
+@app.cli.command("init-db")
+def init_db_command():
+    """الجداول والـ migrations (قبل flask run على قاعدة جديدة، gunicorn بيعملها لوحده)"""
+    create_app()
+    click.echo(f"{DB_PATH}: schema version {SCHEMA_VERSION}")
+
+
 if __name__ == "__main__":
-    with app.app_context():
-        init_db()
-    app.run(host="0.0.0.0", port=5000, debug=False)
+    create_app().run(host="0.0.0.0", port=5000, debug=False)
@@ -0,0 +1,736 @@
+# -*- coding: utf-8 -*-
+"""
+قياس أداء الراوتات الأساسية على قاعدة تجريبية (flask seed-requests)
+
+    APPROVAL_DB_PATH=/tmp/bench.db flask --app app seed-requests --count 100000
+    python bench.py run --db /tmp/bench.db --out before.json
+    ... (commit تاني) ...
+    python bench.py run --db /tmp/bench.db --out after.json
+    python bench.py compare before.json after.json
+    python bench.py contention --db /tmp/bench.db --readers 0,8,32
+    python bench.py snapshot-check --db /tmp/bench.db
+    python bench.py run --db /tmp/bench.db --mode gunicorn --gunicorn-config gunicorn.conf.py
+    python bench.py run --db /tmp/bench.db --mode gunicorn --gunicorn-config gunicorn.conf.py --sse-clients 8
+
+الطلبات بتتبعت مرتين: Flask test client (نفس الـ process، من غير شبكة) و gunicorn
+محلي بأكتر من worker (HTTP keep-alive من threads). النتيجة JSON: p50/p95/p99 بالـ ms،
+throughput (طلب/ثانية) و peak RSS. new_request_submit بيضيف طلبات => استخدم نسخة من القاعدة.
+contention: زمن قرارات الموافقة وجنبها قرّاء كتير على الداشبوردات (بيكتب قرارات في القاعدة)،
+exit code 1 لو p95 الموافقة مع القرّاء زاد عن جولة 0 قارئ بأكتر من --max-increase % + --slack-ms.
+snapshot-check: نفس الادعاء من غير توقيت CPU: قارئ ماسك snapshot والقرارات لازم تعمل commit
+قبل busy_timeout قصير (--journal-mode delete = الـ baseline => لازم يفشل).
+"""
+import http.client
+import json
+import os
+import platform
+import random
+import resource
+import runpy
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import urlencode
+
+import click
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+# عينة الطلبات اللي view / edit / manager_request بيختاروا منها عشوائي
+SAMPLE_SIZE = 2000
+
+
+def percentile(sorted_values, pct):
+    """nearest-rank على list مترتبة"""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(latencies, wall_seconds, errors):
+    values = sorted(latencies)
+    return {
+        "requests": len(values),
+        "errors": errors,
+        "p50_ms": round(percentile(values, 50) * 1000, 3) if values else None,
+        "p95_ms": round(percentile(values, 95) * 1000, 3) if values else None,
+        "p99_ms": round(percentile(values, 99) * 1000, 3) if values else None,
+        "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else None,
+        "throughput_rps": round(len(values) / wall_seconds, 1) if wall_seconds else None,
+    }
+
+
+def load_sample(db_path):
+    """عينة عشوائية (ids, edit_tokens, أسماء المشترين) من القاعدة + عدد الطلبات"""
+    db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        max_id = db.execute("SELECT COALESCE(MAX(id), 0) FROM requests").fetchone()[0]
+        rng = random.Random(1)
+        candidates = [rng.randint(1, max_id) for _ in range(SAMPLE_SIZE)] if max_id else []
+        rows = db.execute(
+            "SELECT id, edit_token, buyer_name FROM requests WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps(candidates),),
+        ).fetchall()
+        count = db.execute("SELECT COUNT(*) FROM requests").fetchone()[0]
+    finally:
+        db.close()
+    if not rows:
+        raise click.ClickException("Database is empty: run `flask --app app seed-requests` first")
+    return {
+        "ids": [r[0] for r in rows],
+        "tokens": [r[1] for r in rows],
+        "buyers": [r[2] for r in rows],
+        "count": count,
+    }
+
+
+def scenarios(app_module, sample, rng):
+    """
+    (اسم, role, method, path(), body()) لكل سيناريو
+    role: None / manager1 / viewer (الـ session بتتعمل مرة واحدة قبل القياس)
+    """
+    def pick(key):
+        return lambda: sample[key][rng.randrange(len(sample[key]))]
+
+    req_id, token, buyer = pick("ids"), pick("tokens"), pick("buyers")
+    project = lambda: rng.choice(app_module.PROJECT_CHOICES)  # noqa: E731
+
+    def new_form():
+        return urlencode(app_module.seed_request_form(rng, datetime.utcnow()))
+
+    return [
+        ("new_request_form", None, "GET", lambda: "/request/new", None),
+        ("new_request_submit", None, "POST", lambda: "/request/new", new_form),
+        ("view_request", None, "GET", lambda: f"/request/{req_id()}", None),
+        ("edit_request", None, "GET", lambda: f"/request/edit/{token()}", None),
+        ("manager_dashboard", "manager1", "GET", lambda: "/manager/1", None),
+        ("manager_dashboard_pending", "manager1", "GET", lambda: "/manager/1?filter=pending&sort=oldest", None),
+        ("manager_dashboard_project", "manager1", "GET", lambda: "/manager/1?" + urlencode({"project": project()}), None),
+        ("manager_dashboard_search", "manager1", "GET",
+         lambda: "/manager/1?" + urlencode({"q": buyer().split()[-1]}), None),
+        ("manager_request", "manager1", "GET", lambda: f"/manager/1/request/{req_id()}", None),
+        ("viewer_dashboard", "viewer", "GET", lambda: "/viewer", None),
+    ]
+
+
+def is_error(status):
+    # الـ POST الناجح redirect (302)، وأي 4xx/5xx غلط
+    return status >= 400
+
+
+# ---------- Flask test client (نفس الـ process) ----------
+def run_test_client(app_module, sample, requests_per_scenario, warmup, only):
+    rng = random.Random(2)
+    clients = {None: app_module.app.test_client()}
+    for role, key in (("manager1", "mgr1"), ("viewer", "viewer")):
+        clients[role] = app_module.app.test_client()
+        with clients[role].session_transaction() as sess:
+            sess[key] = True
+
+    results = {}
+    for name, role, method, path, body in scenarios(app_module, sample, rng):
+        if only and name not in only:
+            continue
+        client = clients[role]
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+        def send():
+            if method == "POST":
+                return client.post(path(), data=body(), headers=headers)
+            return client.get(path())
+
+        for _ in range(warmup):
+            send()
+        latencies, errors = [], 0
+        started = time.perf_counter()
+        for _ in range(requests_per_scenario):
+            t0 = time.perf_counter()
+            response = send()
+            response.get_data()
+            latencies.append(time.perf_counter() - t0)
+            errors += is_error(response.status_code)
+        results[name] = summarize(latencies, time.perf_counter() - started, errors)
+        click.echo(f"  test_client {name:28s} p50={results[name]['p50_ms']}ms "
+                   f"p99={results[name]['p99_ms']}ms {results[name]['throughput_rps']} rps", err=True)
+    return results
+
+
+# ---------- gunicorn محلي (HTTP) ----------
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, proc, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise click.ClickException("gunicorn exited before it started listening")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise click.ClickException("gunicorn did not start in time")
+
+
+def process_tree(pid):
+    """الـ master + الـ workers (Linux /proc)"""
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as fh:
+            pids += [int(p) for p in fh.read().split()]
+    except OSError:
+        pass
+    return pids
+
+
+def peak_rss_mb(pid):
+    """VmHWM (أعلى RSS وصله الـ process) بالـ MB، None لو مش Linux"""
+    try:
+        with open(f"/proc/{pid}/status") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+    return None
+
+
+def http_login(port, path, form):
+    """POST لصفحة الدخول -> قيمة الـ Cookie header"""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        conn.request("POST", path, body=urlencode(form),
+                     headers={"Content-Type": "application/x-www-form-urlencoded"})
+        response = conn.getresponse()
+        response.read()
+        cookie = response.getheader("Set-Cookie", "")
+    finally:
+        conn.close()
+    return cookie.split(";", 1)[0]
+
+
+def login_cookies(port, app_module):
+    """role -> Cookie header"""
+    return {
+        None: "",
+        # الداشبورد بيشوف session["mgr1"] بس (اللي POST /manager/1 بيعمله)
+        "manager1": http_login(port, "/manager/1", {"password": app_module.MANAGER1_PASSWORD}),
+        "viewer": http_login(port, "/viewer/login", {
+            "username": app_module.VIEWER_USERNAME, "password": app_module.VIEWER_PASSWORD,
+        }),
+    }
+
+
+@contextmanager
+def gunicorn_server(db_path, workers, threads, config=None):
+    """
+    gunicorn محلي على port فاضي => (port, process)، وبيتقفل في الآخر
+    config => gunicorn.conf.py (الـ app والـ workers / threads من الملف)
+    """
+    port = free_port()
+    env = dict(os.environ, APPROVAL_DB_PATH=db_path)
+    cmd = [sys.executable, "-m", "gunicorn"]
+    if config:
+        cmd += ["--config", config]
+    else:
+        cmd += ["app:app", "--workers", str(workers), "--threads", str(threads)]
+    cmd += ["--bind", f"127.0.0.1:{port}", "--log-level", "warning"]
+    proc = subprocess.Popen(cmd, cwd=BASE_DIR, env=env)
+    try:
+        wait_for_port(port, proc)
+        yield port, proc
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+@contextmanager
+def sse_streams(port, app_module, count):
+    """
+    count اتصال SSE (/manager/1/events) مفتوحين طول الـ block، زي داشبوردات مفتوحة في متصفحات:
+    الـ stream اللي خلص (SSE_STREAM_SECONDS) بيتصل تاني على طول، والـ 503 بعد SSE_RETRY_AFTER
+    => list بأول status لكل اتصال (200 = ماسك thread، 503 = فوق SSE_MAX_STREAMS)
+    """
+    stop = threading.Event()
+    statuses, conns = [], []
+    cookie = http_login(port, "/manager/1", {"password": app_module.MANAGER1_PASSWORD}) if count else ""
+
+    def stream():
+        first = True
+        while not stop.is_set():
+            # keepalive كل SSE_KEEPALIVE_SECONDS، والـ read بيخلص لما الـ block يقفل الـ socket
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            conns.append(conn)
+            try:
+                conn.request("GET", "/manager/1/events", headers={"Cookie": cookie})
+                response = conn.getresponse()
+                if first:
+                    statuses.append(response.status)
+                    first = False
+                if response.status != 200:
+                    response.read()
+                    stop.wait(app_module.SSE_RETRY_AFTER)
+                    continue
+                while response.read1(4096):
+                    pass
+            except (OSError, http.client.HTTPException):
+                # بعد ما الـ block خلص ده الـ shutdown نفسه
+                if first:
+                    statuses.append(None)
+                return
+            finally:
+                conn.close()
+
+    pool = [threading.Thread(target=stream, daemon=True) for _ in range(count)]
+    for t in pool:
+        t.start()
+    deadline = time.monotonic() + 30
+    while len(statuses) < count and time.monotonic() < deadline:
+        time.sleep(0.05)
+    try:
+        yield statuses
+    finally:
+        stop.set()
+        for conn in conns:
+            sock = conn.sock
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        for t in pool:
+            t.join()
+
+
+def run_gunicorn(app_module, sample, db_path, requests_per_scenario, warmup, only, workers, threads, concurrency,
+                 config=None, sse_clients=0):
+    # الـ streams بتتفتح الأول وتفضل ماسكة threads طول القياس
+    with gunicorn_server(db_path, workers, threads, config) as (port, proc), \
+            sse_streams(port, app_module, sse_clients) as sse_statuses:
+        cookies = login_cookies(port, app_module)
+        results = {}
+        rng = random.Random(3)
+        lock = threading.Lock()
+        for name, role, method, path, body in scenarios(app_module, sample, rng):
+            if only and name not in only:
+                continue
+            headers = {"Cookie": cookies[role], "Accept-Encoding": "gzip, br"}
+            if method == "POST":
+                headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+            def next_request():
+                # rng مش thread-safe
+                with lock:
+                    return path(), body() if body else None
+
+            def client(count, out):
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+                latencies, errors = [], 0
+                try:
+                    for _ in range(count):
+                        url, data = next_request()
+                        t0 = time.perf_counter()
+                        conn.request(method, url, body=data, headers=headers)
+                        response = conn.getresponse()
+                        response.read()
+                        latencies.append(time.perf_counter() - t0)
+                        errors += is_error(response.status)
+                finally:
+                    conn.close()
+                out.append((latencies, errors))
+
+            client(warmup, [])
+            outputs = []
+            share, extra = divmod(requests_per_scenario, concurrency)
+            pool = [
+                threading.Thread(target=client, args=(share + (i < extra), outputs))
+                for i in range(concurrency)
+            ]
+            started = time.perf_counter()
+            for t in pool:
+                t.start()
+            for t in pool:
+                t.join()
+            wall = time.perf_counter() - started
+            latencies = [x for lat, _ in outputs for x in lat]
+            results[name] = summarize(latencies, wall, sum(err for _, err in outputs))
+            click.echo(f"  gunicorn    {name:28s} p50={results[name]['p50_ms']}ms "
+                       f"p99={results[name]['p99_ms']}ms {results[name]['throughput_rps']} rps", err=True)
+
+        rss = {str(pid): peak_rss_mb(pid) for pid in process_tree(proc.pid)}
+        sse = {str(status): sse_statuses.count(status) for status in set(sse_statuses)}
+    return results, rss, sse
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.group()
+def cli():
+    """bench.py run / contention / snapshot-check / compare"""
+
+
+@cli.command()
+@click.option("--db", "db_path", required=True, type=click.Path(exists=True, dir_okay=False),
+              help="قاعدة اتعملت بـ seed-requests (بتتكتب فيها طلبات جديدة)")
+@click.option("--requests", "requests_per_scenario", default=500, show_default=True, help="لكل سيناريو")
+@click.option("--warmup", default=20, show_default=True)
+@click.option("--mode", type=click.Choice(["all", "test-client", "gunicorn"]), default="all", show_default=True)
+@click.option("--workers", default=max(2, os.cpu_count() or 1), show_default=True, help="gunicorn workers")
+@click.option("--threads", default=4, show_default=True, help="threads لكل worker")
+@click.option("--concurrency", default=8, show_default=True, help="اتصالات متوازية على gunicorn")
+@click.option("--gunicorn-config", "config", type=click.Path(exists=True, dir_okay=False), default=None,
+              help="gunicorn.conf.py بدل --workers / --threads")
+@click.option("--sse-clients", default=0, show_default=True,
+              help="اتصالات SSE مفتوحة طول قياس gunicorn (داشبوردات مفتوحة)")
+@click.option("--scenario", "only", multiple=True, help="سيناريو واحد أو أكتر بس (بالاسم)")
+@click.option("--out", type=click.Path(dir_okay=False), default=None, help="الافتراضي stdout")
+def run(db_path, requests_per_scenario, warmup, mode, workers, threads, concurrency, config, sse_clients, only,
+        out):
+    """يقيس السيناريوهات ويطلع JSON"""
+    db_path = os.path.abspath(db_path)
+    # app.py بيقرا APPROVAL_DB_PATH وقت الـ import
+    os.environ["APPROVAL_DB_PATH"] = db_path
+    sys.path.insert(0, BASE_DIR)
+    import app as app_module
+    # الـ import ما بيعملش migrations => القاعدة تتجهز هنا قبل القياس (و gunicorn app:app بعده)
+    app_module.create_app()
+
+    sample = load_sample(db_path)
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "started_at": datetime.utcnow().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "cpu_count": os.cpu_count(),
+            "db_rows": sample["count"],
+            "db_bytes": os.path.getsize(db_path),
+            "requests_per_scenario": requests_per_scenario,
+        },
+    }
+    if mode in ("all", "test-client"):
+        report["test_client"] = {
+            "results": run_test_client(app_module, sample, requests_per_scenario, warmup, only),
+            # ru_maxrss بالـ KB على Linux
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+    if mode in ("all", "gunicorn"):
+        results, rss, sse = run_gunicorn(
+            app_module, sample, db_path, requests_per_scenario, warmup, only, workers, threads, concurrency,
+            config, sse_clients,
+        )
+        if config:
+            # نفس القيم اللي gunicorn قراها من الملف (CPU count / env)
+            settings = runpy.run_path(config)
+            workers, threads = settings["workers"], settings["threads"]
+        report["gunicorn"] = {
+            "config": config,
+            "workers": workers,
+            "threads": threads,
+            "concurrency": concurrency,
+            "sse_clients": sse_clients,
+            # status -> عدد (200 = اتقبل وماسك thread، 503 = اترفض من SSE_MAX_STREAMS)
+            "sse_statuses": sse,
+            "results": results,
+            "peak_rss_mb": rss,
+        }
+
+    text = json.dumps(report, indent=2)
+    if out:
+        with open(out, "w", encoding="utf-8") as fh:
+            fh.write(text + "\n")
+    else:
+        click.echo(text)
+
+
+# الداشبوردات اللي القرّاء بيلفّوا عليها في contention
+READER_PATHS = (
+    ("manager1", "/manager/1"),
+    ("manager1", "/manager/1?filter=pending&sort=oldest"),
+    ("manager1", "/manager/2?filter=approved"),
+    ("viewer", "/viewer"),
+    ("viewer", "/reports/amounts"),
+)
+
+
+def reader_loop(port, cookies, stop, out):
+    """قارئ واحد: داشبوردات ورا بعض لحد stop (كل طلب بـ ?r= مختلف => مفيش 304 / كاش)"""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    done = errors = 0
+    try:
+        while not stop.is_set():
+            role, path = READER_PATHS[done % len(READER_PATHS)]
+            sep = "&" if "?" in path else "?"
+            conn.request("GET", f"{path}{sep}r={done}", headers={"Cookie": cookies[role]})
+            response = conn.getresponse()
+            response.read()
+            done += 1
+            errors += is_error(response.status)
+    finally:
+        conn.close()
+    out.append((done, errors))
+
+
+@cli.command()
+@click.option("--db", "db_path", required=True, type=click.Path(exists=True, dir_okay=False),
+              help="قاعدة اتعملت بـ seed-requests (القرارات بتتكتب فيها فعلاً)")
+@click.option("--readers", default="0,8,32", show_default=True, help="عدد القرّاء في كل جولة")
+@click.option("--decisions", default=50, show_default=True, help="قرارات L1 في كل جولة")
+@click.option("--workers", default=max(2, os.cpu_count() or 1), show_default=True)
+@click.option("--threads", default=8, show_default=True)
+@click.option("--max-increase", default=50.0, show_default=True,
+              help="أقصى % زيادة في p95 الموافقة عن جولة 0 قارئ")
+@click.option("--slack-ms", default=5.0, show_default=True,
+              help="سماحية ثابتة بالـ ms فوق الـ % (الـ baseline صغير والـ jitter بالـ ms)")
+@click.option("--out", type=click.Path(dir_okay=False), default=None, help="الافتراضي stdout")
+def contention(db_path, readers, decisions, workers, threads, max_increase, slack_ms, out):
+    """
+    زمن الموافقة (POST قرار L1) لوحده وجنبه N قارئ بيلفّوا على الداشبوردات والتقارير
+    الطلبات Pending L1 بتتاخد من القاعدة (كل جولة على طلبات جديدة)
+    جولة 0 قارئ هي الـ baseline (بتتضاف لو مش في --readers)، وأي جولة p95 بتاعها
+    أكتر من baseline * (1 + max_increase%) + slack_ms => FAIL و exit code 1
+    """
+    db_path = os.path.abspath(db_path)
+    os.environ["APPROVAL_DB_PATH"] = db_path
+    sys.path.insert(0, BASE_DIR)
+    import app as app_module
+    # الـ import ما بيعملش migrations => القاعدة تتجهز هنا قبل القياس (و gunicorn app:app بعده)
+    app_module.create_app()
+
+    rounds = [int(n) for n in readers.split(",") if n.strip()]
+    if 0 not in rounds:
+        rounds.insert(0, 0)
+    db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        pending = [r[0] for r in db.execute(
+            "SELECT id FROM requests WHERE status = 'Pending L1' ORDER BY id LIMIT ?",
+            (decisions * len(rounds),),
+        )]
+    finally:
+        db.close()
+    if len(pending) < decisions * len(rounds):
+        raise click.ClickException(
+            f"Need {decisions * len(rounds)} 'Pending L1' requests, found {len(pending)}: "
+            "seed a bigger database or lower --decisions"
+        )
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "started_at": datetime.utcnow().isoformat(timespec="seconds"),
+            "cpu_count": os.cpu_count(),
+            "workers": workers,
+            "threads": threads,
+            "decisions_per_round": decisions,
+            "max_increase_pct": max_increase,
+            "slack_ms": slack_ms,
+        },
+        "rounds": [],
+    }
+    with gunicorn_server(db_path, workers, threads) as (port, _):
+        cookies = login_cookies(port, app_module)
+        form = urlencode({"decision": "Approved", "approver_name": "bench", "comments": ""})
+        headers = {"Cookie": cookies["manager1"], "Content-Type": "application/x-www-form-urlencoded"}
+
+        for index, count in enumerate(rounds):
+            stop = threading.Event()
+            outputs = []
+            pool = [threading.Thread(target=reader_loop, args=(port, cookies, stop, outputs))
+                    for _ in range(count)]
+            for t in pool:
+                t.start()
+            time.sleep(1 if count else 0)   # القرّاء يوصلوا لحالة ثابتة
+
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            latencies, errors = [], 0
+            started = time.perf_counter()
+            try:
+                for req_id in pending[index * decisions:(index + 1) * decisions]:
+                    t0 = time.perf_counter()
+                    conn.request("POST", f"/manager/1/request/{req_id}", body=form, headers=headers)
+                    response = conn.getresponse()
+                    response.read()
+                    latencies.append(time.perf_counter() - t0)
+                    # القرار الناجح redirect للداشبورد
+                    errors += response.status != 302
+            finally:
+                conn.close()
+            wall = time.perf_counter() - started
+            stop.set()
+            for t in pool:
+                t.join()
+
+            reads = sum(done for done, _ in outputs)
+            result = {
+                "readers": count,
+                "approvals": summarize(latencies, wall, errors),
+                "reader_requests": reads,
+                "reader_errors": sum(err for _, err in outputs),
+                "reader_throughput_rps": round(reads / wall, 1),
+            }
+            report["rounds"].append(result)
+            click.echo(f"  readers={count:3d} approval p50={result['approvals']['p50_ms']}ms "
+                       f"p99={result['approvals']['p99_ms']}ms  reads={result['reader_throughput_rps']} rps",
+                       err=True)
+
+    baseline = next(r for r in report["rounds"] if r["readers"] == 0)["approvals"]["p95_ms"]
+    limit = round(baseline * (1 + max_increase / 100) + slack_ms, 3)
+    report["p95_limit_ms"] = limit
+    failures = 0
+    for result in report["rounds"]:
+        p95 = result["approvals"]["p95_ms"]
+        # القرار اللي فشل (مش 302) يبقى FAIL حتى لو سريع
+        result["ok"] = p95 <= limit and not result["approvals"]["errors"]
+        failures += not result["ok"]
+        click.echo(f"  {'ok  ' if result['ok'] else 'FAIL'} readers={result['readers']:3d} "
+                   f"approval p95={p95}ms (limit {limit}ms)", err=True)
+    report["ok"] = not failures
+
+    text = json.dumps(report, indent=2)
+    if out:
+        with open(out, "w", encoding="utf-8") as fh:
+            fh.write(text + "\n")
+    else:
+        click.echo(text)
+    sys.exit(1 if failures else 0)
+
+
+@cli.command("snapshot-check")
+@click.option("--db", "db_path", required=True, type=click.Path(exists=True, dir_okay=False),
+              help="قاعدة اتعملت بـ seed-requests (القرارات بتتكتب فيها فعلاً)")
+@click.option("--decisions", default=20, show_default=True, help="قرارات L1 والقارئ ماسك الـ snapshot")
+@click.option("--busy-timeout-ms", default=200, show_default=True,
+              help="busy_timeout الكاتب: قرار أبطأ من كده = اتمسك ورا القارئ")
+@click.option("--journal-mode", type=click.Choice(["wal", "delete"]), default="wal", show_default=True,
+              help="delete = زي الـ baseline (rollback journal) => لازم يفشل")
+def snapshot_check(db_path, decisions, busy_timeout_ms, journal_mode):
+    """
+    check ثابت (مش توقيت CPU): thread ماسك read_snapshot() مفتوح على استعلام الداشبورد طول
+    الوقت، وقرارات L1 بـ write_transaction لازم تعمل commit قبل busy_timeout قصير، والقارئ
+    لازم يفضل شايف نفس الـ snapshot. exit code 1 لو أي قرار اتمسك / فشل
+    """
+    db_path = os.path.abspath(db_path)
+    os.environ["APPROVAL_DB_PATH"] = db_path
+    sys.path.insert(0, BASE_DIR)
+    import app as app_module
+    app_module.create_app()
+    app_module.app.config["SQLITE_BUSY_TIMEOUT_MS"] = busy_timeout_ms
+
+    db = app_module.get_db()
+    pending = [r[0] for r in db.execute(
+        "SELECT id FROM requests WHERE status = 'Pending L1' ORDER BY id LIMIT ?", (decisions,)
+    )]
+    if len(pending) < decisions:
+        raise click.ClickException(
+            f"Need {decisions} 'Pending L1' requests, found {len(pending)}: "
+            "seed a bigger database or lower --decisions"
+        )
+    if journal_mode == "delete":
+        # قبل ما القارئ يفتح connection (الخروج من WAL محتاج القاعدة لوحدها)
+        db.execute("PRAGMA journal_mode = DELETE")
+
+    count_sql = "SELECT COUNT(*) FROM requests WHERE status = 'Pending L1'"
+    listing_sql, listing_params = app_module.build_listing_sql("all", "", "", "latest", limit=50)
+    holding, release = threading.Event(), threading.Event()
+    seen = {}
+
+    def reader():
+        with app_module.read_snapshot() as rdb:
+            # أول SELECT بيبدأ الـ read transaction (زي داشبورد في نص الرندر)
+            rdb.execute(listing_sql, listing_params).fetchall()
+            seen["before"] = rdb.execute(count_sql).fetchone()[0]
+            holding.set()
+            release.wait(60)
+            seen["after"] = rdb.execute(count_sql).fetchone()[0]
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    holding.wait(30)
+
+    latencies, failures = [], []
+    try:
+        for req_id in pending:
+            t0 = time.perf_counter()
+            try:
+                with app_module.write_transaction(db):
+                    error, _ = app_module.apply_decision(
+                        db, req_id, 1, "Approved", "bench", "", datetime.utcnow().isoformat()
+                    )
+            except sqlite3.OperationalError as exc:
+                # COMMIT اللي فشل بيسيب الـ transaction مفتوح
+                if db.in_transaction:
+                    db.rollback()
+                error = str(exc)
+            latencies.append(time.perf_counter() - t0)
+            if error:
+                failures.append(f"request {req_id}: {error}")
+    finally:
+        release.set()
+        thread.join()
+        if journal_mode == "delete":
+            db.execute("PRAGMA journal_mode = WAL")
+
+    values = sorted(latencies)
+    slowest = values[-1] * 1000
+    click.echo(f"  journal_mode={journal_mode} decisions={len(values)} failed={len(failures)} "
+               f"p50={percentile(values, 50) * 1000:.2f}ms max={slowest:.2f}ms "
+               f"(busy_timeout {busy_timeout_ms}ms)", err=True)
+    for failure in failures[:5]:
+        click.echo(f"  FAIL {failure}", err=True)
+    # القارئ ما شافش ولا قرار من اللي اتسجلوا بعد ما الـ snapshot بدأ
+    if seen.get("before") != seen.get("after"):
+        failures.append(f"snapshot changed: {seen.get('before')} -> {seen.get('after')} Pending L1")
+        click.echo(f"  FAIL {failures[-1]}", err=True)
+    if slowest >= busy_timeout_ms:
+        failures.append(f"slowest decision {slowest:.2f}ms >= busy_timeout")
+    click.echo("ok" if not failures else "FAIL")
+    sys.exit(1 if failures else 0)
+
+
+@cli.command()
+@click.argument("before", type=click.File())
+@click.argument("after", type=click.File())
+@click.option("--threshold", default=10.0, show_default=True, help="% تغيير في p95 يعتبر regression")
+def compare(before, after, threshold):
+    """يقارن نتيجتين (commit قديم / جديد)، exit code 1 لو فيه regression"""
+    old, new = json.load(before), json.load(after)
+    click.echo(f"{old['meta'].get('commit')} -> {new['meta'].get('commit')}")
+    regressions = 0
+    for mode in ("test_client", "gunicorn"):
+        if mode not in old or mode not in new:
+            continue
+        click.echo(f"\n{mode}: {'scenario':28s} {'p50':>16s} {'p95':>16s} {'p99':>16s} {'rps':>16s}")
+        for name, a in old[mode]["results"].items():
+            b = new[mode]["results"].get(name)
+            if b is None or a["p95_ms"] is None or b["p95_ms"] is None:
+                continue
+            cols = [f"{a[k]:7.2f}->{b[k]:7.2f}" for k in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps")]
+            change = (b["p95_ms"] - a["p95_ms"]) / a["p95_ms"] * 100 if a["p95_ms"] else 0.0
+            flag = "  REGRESSION" if change > threshold else ""
+            regressions += bool(flag)
+            click.echo(f"{'':{len(mode) + 2}s}{name:28s} {' '.join(f'{c:>16s}' for c in cols)} ({change:+.1f}% p95){flag}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    cli()
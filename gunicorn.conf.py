@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+إعدادات gunicorn للإنتاج (render.yaml):
+
+    gunicorn -c gunicorn.conf.py
+
+- gthread: الـ SSE (/manager/<level>/events) بيمسك thread طول ما الداشبورد مفتوح، وSQLite
+  بيسيب الـ GIL وقت الاستعلام => threads في كل worker، و worker لكل CPU للـ Python نفسه
+- preload_app: app.py بيتحمّل مرة واحدة في الـ master، والـ workers بيتقاسموا ذاكرة الـ import
+  (copy-on-write)
+- on_starting: create_app() => init_db والـ migrations (PRAGMA user_version) مرة واحدة في الـ
+  master قبل الـ fork (الـ import نفسه ما بيلمسش القاعدة، فـ build-assets في الـ build مش بيعمل ملف)
+- post_fork: مفيش connection SQLite بيعدّي الـ fork، كل worker بيفتح بتوعه أول ما يحتاجهم
+- max_requests + jitter: الـ workers بيتجددوا واحد واحد (أي تسريب ذاكرة ما بيتراكمش)،
+  والمتصفح بيكمّل الـ SSE من Last-Event-ID بعد الـ reconnect
+
+- RUN_OUTBOX_WORKER=1: الـ master بيشغّل "flask --app app outbox-worker" كـ process تابع ليه،
+  بيقومه تاني لو وقع وبيقفله مع gunicorn (SIGTERM) => مفيش worker سايب من غير مراقبة
+
+كل قيمة ليها environment variable (WEB_CONCURRENCY / GUNICORN_THREADS / ...) للـ override
+"""
+import os
+import subprocess
+import sys
+import threading
+
+
+def available_cpus():
+    """الـ CPUs المسموحة للـ process (الـ container) مش بتاعة الجهاز كله"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+CPUS = available_cpus()
+
+wsgi_app = "app:app"
+bind = os.environ.get("GUNICORN_BIND", f"0.0.0.0:{os.environ.get('PORT', '8000')}")
+
+worker_class = "gthread"
+# worker لكل CPU: على CPU واحد worker تاني بيزوّد الـ p99 من غير throughput (bench.py)
+workers = int(os.environ.get("WEB_CONCURRENCY", CPUS))
+# كل stream SSE مفتوح ماسك thread لحد SSE_STREAM_SECONDS، والـ cap لكل worker SSE_MAX_STREAMS
+# (نفس الـ env اللي app.py بيقراه) => threads = GUNICORN_THREADS للطلبات العادية + الـ streams،
+# فمهما اتفتح داشبوردات الطلبات العادية ليها GUNICORN_THREADS thread (الزيادة بترجع 503)
+SSE_MAX_STREAMS = int(os.environ.get("SSE_MAX_STREAMS", 4))
+threads = int(os.environ.get("GUNICORN_THREADS", 8)) + SSE_MAX_STREAMS
+preload_app = True
+
+# الـ proxy قدام (Render) بيعيد استخدام الاتصال => أطول من الافتراضي (2)
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 2000))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 200))
+timeout = 30
+# اتصالات الـ SSE ما بتخلصش لوحدها => ما نستناش عليها كتير وقت الـ restart
+graceful_timeout = 10
+
+# heartbeat الـ workers على tmpfs بدل الديسك
+if os.path.isdir("/dev/shm"):
+    worker_tmp_dir = "/dev/shm"
+
+
+def on_starting(server):
+    import app
+    app.create_app()
+
+
+def post_fork(server, worker):
+    # الـ master اتعمل فيه import لـ app.py (preload) => أي connection موروث بيتساب من غير close
+    import app
+    app.close_thread_db()
+
+
+# ---------- outbox-worker تحت الـ master ----------
+# لازم يشوف نفس ملف SQLite => نفس الـ service (الـ disk مش بيتشارك بين services)
+OUTBOX_COMMAND = [sys.executable, "-m", "flask", "--app", "app", "outbox-worker"]
+OUTBOX_RESTART_DELAY = 5        # ثواني قبل ما يقوم تاني (ما يلفّش لو بيقع وقت البداية)
+OUTBOX_STOP_TIMEOUT = 15        # بيخلّص الرسالة اللي في إيده (webhook timeout 10) قبل SIGKILL
+
+
+class OutboxSupervisor:
+    """
+    thread في الـ master: يشغّل outbox-worker ويستنى، ولو خرج من غير stop يقوم تاني
+    (الـ arbiter بيعمل waitpid(-1) للـ workers بتوعه وممكن يلم الـ process ده قبلنا => wait()
+    بيرجع برضه، وده كفاية نعرف إنه خرج)
+    """
+
+    def __init__(self, log):
+        self.log = log
+        self.proc = None
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="outbox-supervisor", daemon=True)
+
+    def _run(self):
+        while not self.stopping.is_set():
+            self.proc = subprocess.Popen(OUTBOX_COMMAND)
+            self.log.info("outbox-worker started (pid: %s)", self.proc.pid)
+            code = self.proc.wait()
+            if self.stopping.is_set():
+                return
+            self.log.error("outbox-worker exited (%s), restarting in %ss", code, OUTBOX_RESTART_DELAY)
+            self.stopping.wait(OUTBOX_RESTART_DELAY)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        self.proc.terminate()
+        try:
+            self.proc.wait(OUTBOX_STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+outbox_supervisor = None
+
+
+def when_ready(server):
+    global outbox_supervisor
+    if os.environ.get("RUN_OUTBOX_WORKER") == "1":
+        outbox_supervisor = OutboxSupervisor(server.log)
+        outbox_supervisor.start()
+
+
+def on_exit(server):
+    if outbox_supervisor is not None:
+        outbox_supervisor.stop()